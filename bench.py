@@ -0,0 +1,361 @@
+"""Benchmark the database at the scale of a whole world.
+
+Makes up a world of however many dimensions, places, portals, things,
+journeys, spots and pawns you like, with rows shaped like the ones in
+DefaultParameters, and times how long it takes to make the schema,
+insert the world, load each board, sync a round of changes, and close
+the database. Also counts how much memory the loaded places, things
+and portals take up, and the peak RSS. With --unslotted, also counts
+what they'd take up without __slots__ and shared strings and empty
+lists, for comparison. Prints the results as JSON.
+
+    python bench.py --dimensions 2 --places 10000 --out bench_output.txt
+
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from database import Database, default, Item, Img
+from graph import Dimension, Journey, Place, Portal
+from thing import Thing
+from widgets import Spot, Pawn, Board
+
+
+class SyntheticWorld:
+    """A made-up world, in the form of tabdicts like the ones in
+DefaultParameters.
+
+Each dimension is a square grid of places, with portals both ways
+between neighbors, until there are as many portals as asked for.
+Things are scattered about the places that have spots, so there have
+to be some of those if there are any things. Journeys walk their
+things right, then up, across the grid.
+
+"""
+    def __init__(self, dimensions=1, places=1000, portals=4000,
+                 things=1000, journeys=100, steps=8, spots=1000,
+                 pawns=1000, seed=0):
+        if things > 0 and min(places, spots) <= 0:
+            raise ValueError(
+                "%d things need at least one place with a spot to be in" %
+                (things,))
+        rand = random.Random(seed)
+        side = 1
+        while side * side < places:
+            side += 1
+        self.dimensions = []
+        self.places = []
+        self.portals = []
+        self.things = []
+        self.locations = []
+        self.journeys = []
+        self.steps = []
+        self.spots = []
+        self.pawns = []
+        self.boards = []
+        for d in xrange(0, dimensions):
+            dim = "Dimension%d" % (d,)
+            self.dimensions.append({"name": dim})
+            self.boards.append({"dimension": dim,
+                                "width": side * 32,
+                                "height": side * 32,
+                                "wallpaper": "wall"})
+
+            def placename(x, y):
+                return "place(%d,%d)" % (x, y)
+
+            def portalname(orig, dest):
+                return "portal[%s->%s]" % (orig, dest)
+
+            coords = [(i % side, i / side) for i in xrange(0, places)]
+            placed = set(coords)
+            for (x, y) in coords:
+                self.places.append({"dimension": dim,
+                                    "name": placename(x, y)})
+            n = 0
+            for (x, y) in coords:
+                for (dx, dy) in ((1, 0), (0, 1), (-1, 0), (0, -1)):
+                    if n >= portals:
+                        break
+                    if (x + dx, y + dy) not in placed:
+                        continue
+                    orig = placename(x, y)
+                    dest = placename(x + dx, y + dy)
+                    self.portals.append({"dimension": dim,
+                                         "name": portalname(orig, dest),
+                                         "from_place": orig,
+                                         "to_place": dest})
+                    n += 1
+            for (x, y) in coords[:spots]:
+                self.spots.append({"dimension": dim,
+                                   "place": placename(x, y),
+                                   "img": "orb",
+                                   "x": x * 32,
+                                   "y": y * 32,
+                                   "visible": True,
+                                   "interactive": True})
+            portalnames = set([port["name"] for port in self.portals
+                               if port["dimension"] == dim])
+            for i in xrange(0, things):
+                thing = "thing%d" % (i,)
+                (x, y) = rand.choice(coords[:spots])
+                self.things.append({"dimension": dim,
+                                    "name": thing})
+                self.locations.append({"dimension": dim,
+                                       "thing": thing,
+                                       "place": placename(x, y)})
+                if i < pawns:
+                    self.pawns.append({"dimension": dim,
+                                       "thing": thing,
+                                       "img": "troll_m",
+                                       "visible": True,
+                                       "interactive": True})
+                if i >= journeys:
+                    continue
+                idx = 0
+                while idx < steps:
+                    if idx % 2 == 0:
+                        (nx, ny) = (x + 1, y)
+                    else:
+                        (nx, ny) = (x, y + 1)
+                    port = portalname(placename(x, y), placename(nx, ny))
+                    if port not in portalnames:
+                        break
+                    self.steps.append({"dimension": dim,
+                                       "thing": thing,
+                                       "idx": idx,
+                                       "portal": port})
+                    (x, y) = (nx, ny)
+                    idx += 1
+                if idx > 0:
+                    self.journeys.append({"dimension": dim,
+                                          "thing": thing,
+                                          "curstep": 0,
+                                          "progress": 0.0})
+        self.items = (
+            self.places + self.things +
+            [{"dimension": port["dimension"], "name": port["name"]}
+             for port in self.portals])
+        self.tabdicts = {
+            Dimension: {"dimension": self.dimensions},
+            Item: {"item": self.items},
+            Img: {"img": default.imgs},
+            Place: {"place": self.places},
+            Portal: {"portal": self.portals},
+            Thing: {"thing": self.things,
+                    "location": self.locations,
+                    "containment": []},
+            Spot: {"spot": self.spots},
+            Pawn: {"pawn": self.pawns},
+            Journey: {"journey": self.journeys,
+                      "journeystep": self.steps},
+            Board: {"board": self.boards}}
+
+    def rows(self):
+        return sum([sum([len(rowdicts) for rowdicts in tabdict.itervalues()])
+                    for tabdict in self.tabdicts.itervalues()])
+
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    r = f(*args, **kwargs)
+    return (r, (time.time() - start) * 1000)
+
+
+def slot_names(clas):
+    r = []
+    for c in clas.__mro__:
+        slots = c.__dict__.get("__slots__", ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+        r.extend(slots)
+    return r
+
+
+def footprint(objs):
+    """Return how many bytes the objects take up: each object, its
+__dict__ if it has one, and the lists, tuples, dicts and strings its
+attributes hold. Anything shared is only counted once, so strings
+that are the same object, and empty lists that are the same tuple,
+cost nothing after the first."""
+    seen = set()
+    total = 0
+    for obj in objs:
+        held = [obj]
+        if hasattr(obj, "__dict__"):
+            held.append(obj.__dict__)
+            vals = obj.__dict__.values()
+        else:
+            vals = [getattr(obj, name) for name in slot_names(type(obj))
+                    if hasattr(obj, name)]
+        held.extend([val for val in vals
+                     if isinstance(val, (list, tuple, dict, basestring))])
+        for it in held:
+            if id(it) not in seen:
+                seen.add(id(it))
+                total += sys.getsizeof(it)
+    return total
+
+
+class Unslotted(object):
+    pass
+
+
+def unshared(val):
+    """Return a copy of val that isn't shared with anything: a new list
+for the empty tuple, a new string for a string."""
+    if val == ():
+        return []
+    elif isinstance(val, basestring):
+        return (val + u"x")[:-1]
+    else:
+        return val
+
+
+def unslotted(obj):
+    """Return an object with a __dict__ holding what obj holds in its
+slots, none of it shared, the way places, things and portals were
+before they had __slots__."""
+    r = Unslotted()
+    for name in slot_names(type(obj)):
+        if hasattr(obj, name):
+            r.__dict__[name] = unshared(getattr(obj, name))
+    return r
+
+
+def memory(db, compare=False):
+    """Return the count and footprint of the places, things and portals
+the database has loaded. With compare, also the footprint of unslotted
+copies of them."""
+    r = {}
+    for (name, d) in (("place", db.placedict),
+                      ("thing", db.thingdict),
+                      ("portal", db.portaldict)):
+        objs = [obj for dimd in d.itervalues() for obj in dimd.itervalues()]
+        nbytes = footprint(objs)
+        r[name] = {"count": len(objs),
+                   "bytes": nbytes,
+                   "bytes_each": float(nbytes) / max(len(objs), 1)}
+        if compare:
+            nbytes = footprint([unslotted(obj) for obj in objs])
+            r[name]["unslotted_bytes"] = nbytes
+            r[name]["unslotted_bytes_each"] = (
+                float(nbytes) / max(len(objs), 1))
+    return r
+
+
+def run(dbfile, world, lazy=False, profile="game", changes=1000,
+        columns=False, unslotted=False):
+    """Run each step of the benchmark on a fresh database, and return a
+dict of the results. With columns, also time loading the ColumnStore
+and a couple of queries on it. With unslotted, also measure the loaded
+objects as they'd be without __slots__; see memory."""
+    results = {"rows": world.rows()}
+    (db, results["connect_ms"]) = timed(
+        Database, dbfile, lazy=lazy, profile=profile)
+    (r, results["mkschema_ms"]) = timed(db.mkschema)
+    (rate, results["insert_ms"]) = timed(db.insert_tabdicts, world.tabdicts)
+    results["insert_rows_per_sec"] = rate
+    results["boards"] = {}
+    for dimrow in world.dimensions:
+        dim = dimrow["name"]
+        (board, ms) = timed(db.load_board, dim)
+        results["boards"][dim] = {
+            "load_ms": ms,
+            "stages": [{"stage": stage, "ms": secs * 1000, "rows": rows}
+                       for (stage, secs, rows)
+                       in db.load_timings[dim].report()]}
+    results["memory"] = memory(db, unslotted)
+    if columns:
+        (store, results["columns_ms"]) = timed(db.load_columns)
+        dim = world.dimensions[0]["name"]
+        placenames = store["place"].values(
+            "name", store["place"].eq("dimension", dim))[:100]
+        (things, results["columns_things_in_ms"]) = timed(
+            store.things_in, dim, placenames)
+        (portals, results["columns_portals_from_ms"]) = timed(
+            store.portals_from, dim, placenames[0])
+    # Move some spots and advance some journeys, then save them.
+    moved = 0
+    for dimrow in world.dimensions:
+        dim = dimrow["name"]
+        for spot in db.spotdict[dim].values()[:changes]:
+            spot.x += 1
+            db.remember(spot, "x")
+            moved += 1
+        for journey in db.journeydict[dim].values()[:changes]:
+            journey.progress = 0.5
+            db.remember(journey, "progress")
+            moved += 1
+    (stats, results["sync_ms"]) = timed(db.sync)
+    results["sync_objects"] = moved
+    results["sync_tables"] = dict([
+        (tabname, {"rows": stats.rows[tabname], "ms": stats.ms(tabname)})
+        for tabname in stats.tables])
+    (r, results["close_ms"]) = timed(db.close)
+    results["maxrss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Time the database with a made-up world.")
+    parser.add_argument("--dimensions", type=int, default=1)
+    parser.add_argument("--places", type=int, default=10000)
+    parser.add_argument("--portals", type=int, default=40000)
+    parser.add_argument("--things", type=int, default=10000)
+    parser.add_argument("--journeys", type=int, default=1000)
+    parser.add_argument("--steps", type=int, default=8)
+    parser.add_argument("--spots", type=int, default=10000)
+    parser.add_argument("--pawns", type=int, default=10000)
+    parser.add_argument("--changes", type=int, default=1000,
+                        help="how many spots and journeys to change "
+                        "before syncing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", default="game")
+    parser.add_argument("--lazy", action="store_true")
+    parser.add_argument("--columns", action="store_true",
+                        help="also load and query a ColumnStore")
+    parser.add_argument("--unslotted", action="store_true",
+                        help="also measure the loaded places, things and "
+                        "portals as they'd be without __slots__")
+    parser.add_argument("--memory", action="store_true",
+                        help="use an in-memory database instead of a file")
+    parser.add_argument("--out", help="write the JSON here, not stdout")
+    args = parser.parse_args(argv)
+    try:
+        world = SyntheticWorld(args.dimensions, args.places, args.portals,
+                               args.things, args.journeys, args.steps,
+                               args.spots, args.pawns, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.memory:
+        dbfile = ":memory:"
+    else:
+        (fd, dbfile) = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        os.remove(dbfile)
+    try:
+        results = run(dbfile, world, args.lazy, args.profile, args.changes,
+                      args.columns, args.unslotted)
+    finally:
+        if not args.memory:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(dbfile + suffix):
+                    os.remove(dbfile + suffix)
+    results["args"] = vars(args)
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if args.out is None:
+        print out
+    else:
+        with open(args.out, "w") as f:
+            f.write(out + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,380 @@
+"""Holding whole tables in memory a column at a time, for queries that
+look at a lot of rows at once.
+
+Each table the SaveableMetaclass declares gets an array per column.
+A row is an index into the arrays. Text is kept as ints, codes from a
+table of strings that every column shares, so that comparing a column
+with a string is comparing ints. Integers, booleans and floats are
+kept as themselves, with another array saying which are NULL.
+
+A query is a mask: a boolean array with one element per row, made by
+comparing columns and combined with & and |. rows and values turn
+masks back into rowdicts and Python values.
+
+"""
+from itertools import imap, izip
+import numpy
+from syncplan import owner_keys, rows_of
+
+
+def column_dtype(decl):
+    """Return the dtype of the array for a column declared decl, or None
+if it's text."""
+    typ = decl.split()[0].lower()
+    if typ == "integer":
+        return numpy.int64
+    elif typ == "boolean":
+        return numpy.bool_
+    elif typ == "float":
+        return numpy.float64
+    else:
+        return None
+
+
+class StringCodes:
+    """Gives every string an int of its own, and gives it back. NULL is
+-1."""
+    def __init__(self):
+        self.codes = {None: -1}
+        self.strings = []
+        self.order = None
+
+    def code(self, s):
+        if s not in self.codes:
+            self.codes[s] = len(self.strings)
+            self.strings.append(s)
+        return self.codes[s]
+
+    def encode(self, values):
+        """Return an array of the codes of the values."""
+        for s in set(values).difference(self.codes):
+            self.code(s)
+        return numpy.fromiter(imap(self.codes.__getitem__, values),
+                              dtype=numpy.int32, count=len(values))
+
+    def decode(self, code):
+        if code < 0:
+            return None
+        return self.strings[code]
+
+    def codes_of(self, values):
+        """Return an array of the codes of the values that have them.
+Values no row has are left out."""
+        return numpy.array([self.codes[s] for s in values
+                            if s in self.codes], dtype=numpy.int32)
+
+    def sorted_codes(self):
+        """Return an array of the strings, sorted, and an array of their
+codes in the same order. They're sorted again only when there are
+strings that weren't there last time."""
+        if self.order is None or len(self.order[0]) != len(self.strings):
+            # Objects, so they're compared the way Python compares them.
+            strings = numpy.empty(len(self.strings), dtype=object)
+            strings[:] = self.strings
+            # A string's code is its index in strings.
+            codes = numpy.argsort(strings, kind="mergesort").astype(
+                numpy.int32)
+            self.order = (strings[codes], codes)
+        return self.order
+
+    def codes_between(self, lo, hi):
+        """Return an array of the codes of every string from lo to hi,
+inclusive."""
+        (strings, codes) = self.sorted_codes()
+        start = numpy.searchsorted(strings, lo, side="left")
+        end = numpy.searchsorted(strings, hi, side="right")
+        return codes[start:end]
+
+
+class ColumnTable:
+    """One table, a column to an array.
+
+Rows are never moved. A deleted row is only marked dead, in live, and
+its key taken out of index, which maps each primary key--a tuple of
+its values, in the order of keynames--to its row. Masks have one
+element for every row there has ever been, n; the dead ones are
+always False.
+
+"""
+    def __init__(self, clas, tabname, strings, capacity=64):
+        self.name = tabname
+        self.colnames = clas.colnames[tabname]
+        self.keynames = clas.keynames[tabname]
+        self.strings = strings
+        self.dtypes = dict([(col, column_dtype(decl)) for (col, decl)
+                            in clas.coldecls[tabname].iteritems()])
+        self.n = 0
+        self.index = {}
+        self.allocate(capacity)
+
+    def __len__(self):
+        return len(self.index)
+
+    def allocate(self, capacity):
+        """Make empty arrays with room for capacity rows."""
+        self.columns = {}
+        self.nulls = {}
+        for col in self.colnames:
+            if self.dtypes[col] is None:
+                self.columns[col] = numpy.empty(capacity, dtype=numpy.int32)
+                self.columns[col].fill(-1)
+            else:
+                self.columns[col] = numpy.zeros(
+                    capacity, dtype=self.dtypes[col])
+                self.nulls[col] = numpy.zeros(capacity, dtype=bool)
+        self.live = numpy.zeros(capacity, dtype=bool)
+
+    def grow(self):
+        capacity = len(self.live) * 2
+        for d in (self.columns, self.nulls):
+            for (col, old) in d.items():
+                new = numpy.zeros(capacity, dtype=old.dtype)
+                if d is self.columns and self.dtypes[col] is None:
+                    new.fill(-1)
+                new[:len(old)] = old
+                d[col] = new
+        live = numpy.zeros(capacity, dtype=bool)
+        live[:len(self.live)] = self.live
+        self.live = live
+
+    def load(self, conn):
+        """Read the whole table with one query and one fetchall, into
+arrays just big enough for it."""
+        rows = conn.execute("SELECT %s FROM %s" % (
+            ", ".join(self.colnames), self.name)).fetchall()
+        n = len(rows)
+        self.allocate(max(n, 1))
+        self.n = n
+        self.live[:n] = True
+        if n == 0:
+            self.index = {}
+            return
+        cols = zip(*rows)
+        del rows
+        # colnames starts with the primary key.
+        self.index = dict(izip(izip(*cols[:len(self.keynames)]),
+                               xrange(0, n)))
+        i = 0
+        for vals in cols:
+            col = self.colnames[i]
+            if self.dtypes[col] is None:
+                self.columns[col][:n] = self.strings.encode(vals)
+            else:
+                nulls = numpy.array([val is None for val in vals])
+                self.nulls[col][:n] = nulls
+                if nulls.any():
+                    vals = [0 if val is None else val for val in vals]
+                self.columns[col][:n] = vals
+            i += 1
+
+    def key_of(self, rowdict):
+        return tuple([rowdict[col] for col in self.keynames])
+
+    def put(self, rowdict):
+        """Write the row over the one with the same key, or add it. Columns
+the rowdict doesn't have are left as they were, or NULL."""
+        key = self.key_of(rowdict)
+        if key in self.index:
+            i = self.index[key]
+        else:
+            if self.n == len(self.live):
+                self.grow()
+            i = self.n
+            self.n += 1
+            self.index[key] = i
+            self.live[i] = True
+        for (col, val) in rowdict.iteritems():
+            if col not in self.columns:
+                continue
+            if self.dtypes[col] is None:
+                self.columns[col][i] = self.strings.code(val)
+            else:
+                self.nulls[col][i] = val is None
+                self.columns[col][i] = 0 if val is None else val
+
+    def update(self, rowdict):
+        """Write the rowdict's columns over the row with its key, if there
+is one, the way an UPDATE would. If there isn't, do nothing."""
+        if self.key_of(rowdict) in self.index:
+            self.put(rowdict)
+
+    def delete(self, rowdict):
+        """Delete the row with the rowdict's key, if there is one."""
+        i = self.index.pop(self.key_of(rowdict), None)
+        if i is not None:
+            self.live[i] = False
+
+    def delete_where(self, keydict):
+        """Delete every row whose columns have the values in the keydict."""
+        mask = self.all()
+        for (col, val) in keydict.iteritems():
+            mask &= self.eq(col, val)
+        for i in numpy.flatnonzero(mask).tolist():
+            self.live[i] = False
+            del self.index[self.key_of(self.row(i))]
+
+    def get(self, *key):
+        """Return the rowdict with the primary key, or None."""
+        if key not in self.index:
+            return None
+        return self.row(self.index[key])
+
+    def row(self, i):
+        r = {}
+        for col in self.colnames:
+            val = self.columns[col][i]
+            if self.dtypes[col] is None:
+                r[col] = self.strings.decode(val)
+            elif self.nulls[col][i]:
+                r[col] = None
+            else:
+                r[col] = val.item()
+        return r
+
+    def all(self):
+        return self.live[:self.n].copy()
+
+    def eq(self, col, value):
+        """Return the mask of the rows whose col is value."""
+        column = self.columns[col][:self.n]
+        if self.dtypes[col] is None:
+            if value not in self.strings.codes:
+                return numpy.zeros(self.n, dtype=bool)
+            return (column == self.strings.code(value)) & self.live[:self.n]
+        if value is None:
+            return self.nulls[col][:self.n] & self.live[:self.n]
+        return ((column == value) & ~self.nulls[col][:self.n] &
+                self.live[:self.n])
+
+    def isin(self, col, values):
+        """Return the mask of the rows whose col is one of the values."""
+        column = self.columns[col][:self.n]
+        if self.dtypes[col] is None:
+            found = numpy.in1d(column, self.strings.codes_of(values))
+        else:
+            found = (numpy.in1d(column, list(values)) &
+                     ~self.nulls[col][:self.n])
+        return found & self.live[:self.n]
+
+    def between(self, col, lo, hi):
+        """Return the mask of the rows whose col is from lo to hi,
+inclusive. Text is compared as strings."""
+        column = self.columns[col][:self.n]
+        if self.dtypes[col] is None:
+            found = numpy.in1d(column, self.strings.codes_between(lo, hi))
+        else:
+            found = ((column >= lo) & (column <= hi) &
+                     ~self.nulls[col][:self.n])
+        return found & self.live[:self.n]
+
+    def rows(self, mask):
+        """Return the rowdicts of the rows in the mask."""
+        return [self.row(i) for i in numpy.flatnonzero(mask).tolist()]
+
+    def values(self, col, mask):
+        """Return a list of the col of every row in the mask."""
+        rowids = numpy.flatnonzero(mask)
+        column = self.columns[col][rowids]
+        if self.dtypes[col] is None:
+            return [self.strings.decode(code) for code in column.tolist()]
+        vals = column.tolist()
+        for j in numpy.flatnonzero(self.nulls[col][rowids]).tolist():
+            vals[j] = None
+        return vals
+
+
+class ColumnStore:
+    """Every table of the classes, as a ColumnTable, by name."""
+    def __init__(self, classes):
+        self.strings = StringCodes()
+        self.tables = {}
+        self.classes = {}
+        for clas in classes:
+            for tabname in clas.colnames.iterkeys():
+                self.tables[tabname] = ColumnTable(
+                    clas, tabname, self.strings)
+                self.classes[tabname] = clas
+
+    def __getitem__(self, tabname):
+        return self.tables[tabname]
+
+    def load(self, conn):
+        for table in self.tables.itervalues():
+            table.load(conn)
+
+    def changes(self, altered, removed):
+        """Return what a sync of these would do, to apply once the sync
+has succeeded: a list of (tabname, rowdict) to delete by key, a list
+of (tabname, keydict) to delete every row matching--the rows owned by
+objects removed or written whole--a list of (tabname, rowdict) to
+write, and a list of (tabname, rowdict) to update.
+
+Objects with only some columns altered were saved with UPDATEs, which
+change nothing if the row isn't there. Their rowdicts have only the
+key and the altered columns, and are only written over rows the table
+has.
+
+The rowdicts are made now, so the objects changing again before then
+doesn't matter.
+
+"""
+        deleted = []
+        disowned = []
+        for obj in removed:
+            tabdict = obj.tabdict
+            disowned.extend(owner_keys(obj, tabdict))
+            for tabname in tabdict.iterkeys():
+                for rowdict in rows_of(tabdict, tabname):
+                    deleted.append((tabname, rowdict))
+        written = []
+        updated = []
+        for (obj, cols) in altered.iteritems():
+            tabdict = obj.tabdict
+            if cols is None:
+                disowned.extend(owner_keys(obj, tabdict))
+                for tabname in tabdict.iterkeys():
+                    for rowdict in rows_of(tabdict, tabname):
+                        written.append((tabname, rowdict))
+                continue
+            for tabname in tabdict.iterkeys():
+                keep = set(obj.keynames[tabname]).union(
+                    [col for col in obj.valnames[tabname] if col in cols])
+                if len(keep) == len(obj.keynames[tabname]):
+                    continue
+                for rowdict in rows_of(tabdict, tabname):
+                    updated.append((tabname, dict(
+                        [(col, val) for (col, val) in rowdict.iteritems()
+                         if col in keep])))
+        return (deleted, disowned, written, updated)
+
+    def apply(self, changes):
+        """Make the changes that changes returned: delete the rows, then
+write and update the others."""
+        (deleted, disowned, written, updated) = changes
+        for (tabname, rowdict) in deleted:
+            self.tables[tabname].delete(rowdict)
+        for (tabname, keydict) in disowned:
+            self.tables[tabname].delete_where(keydict)
+        for (tabname, rowdict) in written:
+            self.tables[tabname].put(rowdict)
+        for (tabname, rowdict) in updated:
+            self.tables[tabname].update(rowdict)
+
+    def things_in(self, dimension, placenames):
+        """Return the names of the things located in any of the places."""
+        location = self.tables["location"]
+        return location.values("thing", location.eq("dimension", dimension) &
+                               location.isin("place", placenames))
+
+    def things_between(self, dimension, lo, hi):
+        """Return the names of the things located in places whose names are
+from lo to hi."""
+        location = self.tables["location"]
+        return location.values("thing", location.eq("dimension", dimension) &
+                               location.between("place", lo, hi))
+
+    def portals_from(self, dimension, placename):
+        """Return the names of the portals out of the place."""
+        portal = self.tables["portal"]
+        return portal.values("name", portal.eq("dimension", dimension) &
+                             portal.eq("from_place", placename))
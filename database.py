@@ -1,11 +1,21 @@
 import sqlite3
 import sys
 import os
+import time
 from widgets import Color, MenuItem, Menu, Spot, Pawn, Board, Style
 from thing import Thing
 from graph import Dimension, Journey, Place, Portal
-from pyglet.resource import image
 from saveload import SaveableMetaclass
+from storage import (connect, is_memory, uses_wal, Checkpointer,
+                     SaveWriter)
+from syncplan import plan_sync, run_sync_plan
+from routing import Routes, RouteTable
+from tiles import TileAtlas
+from columns import ColumnStore
+from imgcache import (ImageCache, ImageDecoder, decode_rltile, decode_img,
+                      make_texture)
+from lazy import (LazyPlaces, LazyThings, LazyPortals, LazySpots,
+                  link_location)
 
 
 def start_new_map(nope):
@@ -479,7 +489,8 @@ table_classes = [Dimension,
                  Menu,
                  Spot,
                  Pawn,
-                 Board]
+                 Board,
+                 Routes]
 
 
 default = DefaultParameters()
@@ -488,6 +499,210 @@ default = DefaultParameters()
 sys.path.append(os.curdir)
 
 
+def union_select(stages):
+    """Build one query that gets the rows for several stages of a load.
+
+stages is a list of triples: a name for the stage, the list of columns
+to select, and the rest of a SELECT statement after the column
+list--FROM, WHERE, and so on. Each row of the result starts with the
+index of its stage, followed by that stage's columns, padded out with
+NULLs to the width of the widest stage.
+
+SQLite runs the arms of a UNION ALL in the order written, so the rows
+come out in stage order. I don't ORDER BY because then SQLite would
+sort the whole result in a temporary b-tree before giving me the first
+row.
+
+"""
+    width = max([len(stage[1]) for stage in stages])
+    selects = []
+    i = 0
+    for (name, cols, rest) in stages:
+        padded = list(cols) + ["NULL"] * (width - len(cols))
+        selects.append("SELECT %d, %s %s" % (i, ", ".join(padded), rest))
+        i += 1
+    return " UNION ALL ".join(selects)
+
+
+class LoadTimer:
+    """Keeps track of how long each stage of a load took, and how many
+rows it got.
+
+Call start(stage) when a stage begins; the previous stage, if any,
+stops then. Call stop() when the last stage is done.
+
+"""
+    def __init__(self):
+        self.stages = []
+        self.secs = {}
+        self.rows = {}
+        self.stage = None
+        self.started = None
+
+    def start(self, stage):
+        now = time.time()
+        self.stop(now)
+        if stage not in self.secs:
+            self.stages.append(stage)
+            self.secs[stage] = 0.0
+            self.rows[stage] = 0
+        self.stage = stage
+        self.started = now
+
+    def stop(self, now=None):
+        if self.stage is None:
+            return
+        if now is None:
+            now = time.time()
+        self.secs[self.stage] += now - self.started
+        self.stage = None
+        self.started = None
+
+    def count(self):
+        self.rows[self.stage] += 1
+
+    def total(self):
+        return sum(self.secs.itervalues())
+
+    def report(self):
+        """Return a list of triples: stage name, seconds, rows."""
+        return [(stage, self.secs[stage], self.rows[stage])
+                for stage in self.stages]
+
+    def __str__(self):
+        return "\n".join(["%s: %.2f ms, %d rows" % (
+            stage, secs * 1000, rows)
+            for (stage, secs, rows) in self.report()])
+
+
+def stream_stages(cursor, stages, handlers, timer):
+    """Feed each row of a union_select query to the handler for its
+stage, as the row comes off the cursor."""
+    i = -1
+    for row in cursor:
+        if row[0] != i:
+            if row[0] < i:
+                raise Exception("Rows arrived out of stage order")
+            i = row[0]
+            (name, cols, rest) = stages[i]
+            handler = handlers[name]
+            timer.start(name)
+        timer.count()
+        handler(dict(zip(cols, row[1:])))
+
+
+# The queries that load_board uses, in the order it uses them. Images
+# come first, because spots, pawns and boards need them in their
+# constructors. Then the menus, which need their styles, which need
+# their colors. Then everything in the dimension proper. Every query
+# takes the dimension as the named parameter :dimension.
+board_menus_qry = "SELECT menu FROM boardmenu WHERE board=:dimension"
+board_styles_qry = "SELECT style FROM menu WHERE name IN (%s)" % (
+    board_menus_qry,)
+board_colors_qry = " UNION ".join([
+    "SELECT %s FROM style WHERE name IN (%s)" % (col, board_styles_qry)
+    for col in ("bg_inactive", "bg_active", "fg_inactive", "fg_active")])
+board_imgs_qry = " UNION ".join([
+    "SELECT wallpaper FROM board WHERE dimension=:dimension",
+    "SELECT img FROM spot WHERE dimension=:dimension",
+    "SELECT img FROM pawn WHERE dimension=:dimension"])
+
+
+def dimension_stage(clas, tab):
+    return (tab, clas.colnames[tab],
+            "FROM %s WHERE dimension=:dimension" % (tab,))
+
+
+board_load_plan = [
+    [("img", Img.colnames["img"],
+      "FROM img WHERE name IN (%s)" % (board_imgs_qry,))],
+    [("color", Color.colnames["color"],
+      "FROM color WHERE name IN (%s)" % (board_colors_qry,)),
+     ("style", Style.colnames["style"],
+      "FROM style WHERE name IN (%s)" % (board_styles_qry,)),
+     ("menu", Menu.colnames["menu"],
+      "FROM menu WHERE name IN (%s)" % (board_menus_qry,)),
+     ("menuitem", MenuItem.colnames["menuitem"],
+      "FROM menuitem WHERE menu IN (%s)" % (board_menus_qry,))],
+    [dimension_stage(Place, "place"),
+     dimension_stage(Thing, "thing"),
+     dimension_stage(Thing, "location"),
+     dimension_stage(Thing, "containment"),
+     dimension_stage(Portal, "portal"),
+     dimension_stage(Journey, "journey"),
+     dimension_stage(Journey, "journeystep"),
+     dimension_stage(Spot, "spot"),
+     dimension_stage(Pawn, "pawn"),
+     dimension_stage(Board, "board")]]
+board_load_qrys = [union_select(stages) for stages in board_load_plan]
+
+
+# A lazy database loads the board with the menus, and then only what's
+# in view. The view is given by the named parameters :left, :bot,
+# :right and :top.
+view_places_qry = (
+    "SELECT place FROM spot WHERE dimension=:dimension AND "
+    "x BETWEEN :left AND :right AND y BETWEEN :bot AND :top")
+view_things_qry = (
+    "SELECT thing FROM location WHERE dimension=:dimension AND "
+    "place IN (%s)" % (view_places_qry,))
+
+
+def view_stage(clas, tab, keycol, qry):
+    return (tab, clas.colnames[tab],
+            "FROM %s WHERE dimension=:dimension AND %s IN (%s)" % (
+                tab, keycol, qry))
+
+
+lazy_board_load_plan = [
+    board_load_plan[0],
+    board_load_plan[1] + [dimension_stage(Board, "board")]]
+lazy_board_load_qrys = [union_select(stages)
+                        for stages in lazy_board_load_plan]
+view_load_plan = [
+    [view_stage(Spot, "spot", "place", view_places_qry),
+     view_stage(Pawn, "pawn", "thing", view_things_qry),
+     view_stage(Journey, "journey", "thing", view_things_qry),
+     view_stage(Journey, "journeystep", "thing", view_things_qry)]]
+view_load_qrys = [union_select(stages) for stages in view_load_plan]
+
+
+# Queries that run often enough that a full table scan in any of them
+# is a bug. Each is a name and a query. See Database.audit_query_plans.
+def lazy_select_qry(clas, tab, keycol):
+    return "SELECT %s FROM %s WHERE dimension=:dimension AND %s IN (:name)" % (
+        ", ".join(clas.colnames[tab]), tab, keycol)
+
+
+hot_queries = (
+    [("board_load_%d" % i, board_load_qrys[i])
+     for i in xrange(0, len(board_load_qrys))] +
+    [("lazy_board_load_%d" % i, lazy_board_load_qrys[i])
+     for i in xrange(0, len(lazy_board_load_qrys))] +
+    [("view_load_%d" % i, view_load_qrys[i])
+     for i in xrange(0, len(view_load_qrys))] +
+    [("lazy_%s_by_%s" % (tab, keycol), lazy_select_qry(clas, tab, keycol))
+     for (clas, tab, keycol) in [
+         (Place, "place", "name"),
+         (Portal, "portal", "name"),
+         (Portal, "portal", "from_place"),
+         (Thing, "thing", "name"),
+         (Thing, "location", "thing"),
+         (Thing, "location", "place"),
+         (Thing, "containment", "container"),
+         (Spot, "spot", "place")]])
+# Parameters to explain the hot queries with. The values don't matter.
+hot_query_params = {"dimension": "", "name": "",
+                    "left": 0, "bot": 0, "right": 0, "top": 0}
+
+
+def view_params(view):
+    if view is None:
+        view = (-sys.maxint, -sys.maxint, sys.maxint, sys.maxint)
+    (left, bot, right, top) = view
+    return {"left": left, "bot": bot, "right": right, "top": top}
+
+
 def untuple(list_o_tups):
     r = []
     for tup in list_o_tups:
@@ -544,6 +759,12 @@ def deep_lookup(dic, keylst):
     return ptr[key]
 
 
+def rows_per_sec(rows, secs):
+    if secs <= 0:
+        return float(rows)
+    return rows / secs
+
+
 def compile_tabdicts(objs):
     tabdicts = [o.tabdict for o in objs]
     mastertab = {}
@@ -552,21 +773,67 @@ def compile_tabdicts(objs):
             (tabname, rowdict) = item
             if tabname not in mastertab:
                 mastertab[tabname] = []
-            mastertab[tabname].append(rowdict)
+            if isinstance(rowdict, list):
+                mastertab[tabname].extend(rowdict)
+            else:
+                mastertab[tabname].append(rowdict)
     return mastertab
 
 
 class Database:
-    def __init__(self, dbfile):
-        self.conn = sqlite3.connect(dbfile)
+    def __init__(self, dbfile, lazy=False, profile="game",
+                 checkpoint_interval=1.0, async_save=False, save_queue=8,
+                 texture_budget=256 * 1024 * 1024, decode_threads=4):
+        """Open the database file.
+
+profile names one of the storage_profiles. If it puts the file in WAL
+mode, a Checkpointer thread writes the log back to the file every
+checkpoint_interval seconds.
+
+With async_save, sync hands its writes to a SaveWriter thread and
+returns at once. At most save_queue syncs wait to be written; after
+that, sync blocks. Call flush to wait for them all.
+
+Textures no loaded board uses are kept until they take up more than
+texture_budget bytes; see ImageCache.
+
+load_board decodes images on decode_threads threads while it goes on
+with its queries. With none, it decodes them as it goes.
+
+"""
+        if async_save and is_memory(dbfile):
+            raise ValueError(
+                "An in-memory database can't be saved from another thread")
+        self.dbfile = dbfile
+        self.conn = connect(dbfile, profile)
+        self.lazy = lazy
+        if not is_memory(dbfile) and uses_wal(self.conn):
+            self.checkpointer = Checkpointer(dbfile, checkpoint_interval)
+            self.checkpointer.start()
+        else:
+            self.checkpointer = None
+        if async_save:
+            self.writer = SaveWriter(dbfile, profile, save_queue)
+            self.writer.start()
+        else:
+            self.writer = None
         self.c = self.conn.cursor()
-        self.altered = set()
+        self.altered = {}
         self.removed = set()
+        self.dimensiondict = {}
+        # Dimensions whose every portal get_dimension has loaded.
+        self.whole_dimensions = set()
         self.placedict = {}
         self.portaldict = {}
         self.thingdict = {}
         self.spotdict = {}
-        self.imgdict = {}
+        self.imgdict = ImageCache(texture_budget)
+        self.decoder = ImageDecoder(decode_threads)
+        # The name and path of each img being decoded, and the
+        # dimension that wants it.
+        self.decoding = []
+        self.atlas = None
+        self.columns = None
         self.boarddict = {}
         self.menuitemdict = {}
         self.boardmenudict = {}
@@ -603,25 +870,83 @@ class Database:
                         "style": self.styledict,
                         "color": self.colordict,
                         "journey": self.journeydict}
+        self.load_timings = {}
+        self.loading_dimension = None
+        self.load_handlers = {"img": self.load_img_row,
+                              "color": self.load_color_row,
+                              "style": self.load_style_row,
+                              "menu": self.load_menu_row,
+                              "menuitem": self.load_menuitem_row,
+                              "place": self.load_place_row,
+                              "thing": self.load_thing_row,
+                              "location": self.load_location_row,
+                              "containment": self.load_containment_row,
+                              "portal": self.load_portal_row,
+                              "journey": self.load_journey_row,
+                              "journeystep": self.load_journeystep_row,
+                              "spot": self.load_spot_row,
+                              "pawn": self.load_pawn_row,
+                              "board": self.load_board_row}
         self.func = {'toggle_menu_visibility': self.toggle_menu_visibility}
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        # __init__ may have raised before there was a connection.
+        if getattr(self, "conn", None) is None:
+            return
         self.c.close()
         self.conn.commit()
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        self.decoder.close()
         self.conn.close()
+        self.conn = None
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
 
     def insert_defaults(self):
-        for clas in table_classes:
-            tabdict = default.tabdicts[clas]
-            for item in tabdict.iteritems():
-                (tabname, rowdicts) = item
-                self.insert_rowdict_table(rowdicts, clas, tabname)
+        """Write the default world to the database in one transaction.
+
+Returns the rate of insertion, in rows per second.
+
+"""
+        r = self.insert_tabdicts(default.tabdicts)
         for func in default.funcs:
             self.xfunc(func)
+        return r
+
+    def insert_tabdicts(self, tabdicts):
+        """Insert rows in one transaction and return the rate, in rows per
+second.
+
+tabdicts is shaped like DefaultParameters.tabdicts: a dict of dicts,
+keyed first by class and then by table name, of lists of rowdicts.
+
+"""
+        rows = 0
+        start = time.time()
+        with self.conn:
+            for clas in table_classes:
+                if clas not in tabdicts:
+                    continue
+                for item in tabdicts[clas].iteritems():
+                    (tabname, rowdicts) = item
+                    rows += self.insert_rowdict_table(
+                        rowdicts, clas, tabname)
+        return rows_per_sec(rows, time.time() - start)
 
     def insert_rowdict_table(self, rowdict, clas, tablename):
+        """Insert the rowdicts into the table. Return how many there
+were."""
         if rowdict != []:
-            clas.dbop['insert'](self, rowdict, tablename)
+            (rows, secs) = clas.dbop['insert'](self, rowdict, tablename)
+            return rows
+        else:
+            return 0
 
     def delete_keydict_table(self, keydict, clas, tablename):
         if keydict != []:
@@ -678,14 +1003,22 @@ class Database:
             objs = [obj]
         clas = objs[0].__class__
         mastertab = compile_tabdicts(objs)
-        for tabname in mastertab.iterkeys():
-            self.insert_rowdict_table(mastertab[tabname], clas, tabname)
+        rows = 0
+        start = time.time()
+        with self.conn:
+            for tabname in mastertab.iterkeys():
+                rows += self.insert_rowdict_table(
+                    mastertab[tabname], clas, tabname)
+        return rows_per_sec(rows, time.time() - start)
 
     def delete_obj(self, obj):
         if isinstance(obj, list):
             objs = obj
         else:
             objs = [obj]
+        for it in objs:
+            if isinstance(it, Portal):
+                self.unlink_portal(it)
         clas = objs[0].__class__
         mastertab = compile_tabdicts(objs)
         for tabname in mastertab.iterkeys():
@@ -723,6 +1056,26 @@ class Database:
                 self.c.execute(tab)
         self.conn.commit()
 
+    def audit_query_plans(self, queries=None):
+        """Explain each of the queries, and return a list of pairs of the
+query's name and each step of its plan that scans a whole table.
+
+queries is a list of (name, query) pairs, and defaults to
+hot_queries. An empty list means every step uses an index.
+
+"""
+        if queries is None:
+            queries = hot_queries
+        r = []
+        for (name, qrystr) in queries:
+            self.c.execute("EXPLAIN QUERY PLAN " + qrystr, hot_query_params)
+            for row in self.c.fetchall():
+                detail = row[-1]
+                if (detail.startswith("SCAN ") and
+                        detail != "SCAN CONSTANT ROW"):
+                    r.append((name, detail))
+        return r
+
     def initialized(self):
         try:
             for tab in ["thing", "place", "attribute", "img"]:
@@ -738,246 +1091,372 @@ class Database:
     def call_func(self, fname, farg):
         return self.func[fname](farg)
 
-    def load_board(self, dimension):
-        # I'll be fetching all the *rows* I need, then turning them
-        # into Python objects, starting with the ones that don't have
-        # foreign keys.
-        def genselect(clas, tab):
-            tabcol = clas.colnames[tab]
-            return ("SELECT " + ", ".join(tabcol) +
-                    " FROM " + tab + " WHERE dimension=?")
-        # fetch all the place rows
-        qrystr = genselect(Place, "place")
-        qrytup = (dimension,)
-        self.c.execute(qrystr, qrytup)
-        place_rows = self.c.fetchall()
-        place_rowdicts = [
-            dictify_row(row, Place.colnames["place"])
-            for row in place_rows]
-        # fetch all the thing rows
-        qrystr = genselect(Thing, "thing")
-        self.c.execute(qrystr, qrytup)
-        thing_rows = self.c.fetchall()
-        thing_rowdicts = [
-            dictify_row(row, Thing.colnames["thing"])
-            for row in thing_rows]
-        # fetch all the portal rows
-        qrystr = genselect(Portal, "portal")
-        self.c.execute(qrystr, qrytup)
-        portal_rows = self.c.fetchall()
-        portal_rowdicts = [
-            dictify_row(row, Portal.colnames["portal"])
-            for row in portal_rows]
-        # fetch all containment rows
-        qrystr = genselect(Thing, "containment")
-        self.c.execute(qrystr, qrytup)
-        containment_rows = self.c.fetchall()
-        containment_rowdicts = [
-            dictify_row(row, Thing.colnames["containment"])
-            for row in containment_rows]
-        # fetch all location rows
-        qrystr = genselect(Thing, "location")
-        self.c.execute(qrystr, qrytup)
-        location_rows = self.c.fetchall()
-        location_rowdicts = [
-            dictify_row(row, Thing.colnames["location"])
-            for row in location_rows]
-        # fetch all journey step rows
-        qrystr = genselect(Journey, "journeystep")
-        self.c.execute(qrystr, qrytup)
-        journey_step_rows = self.c.fetchall()
-        journey_step_rowdicts = [
-            dictify_row(row, Journey.colnames["journeystep"])
-            for row in journey_step_rows]
-        # fetch all journey rows
-        qrystr = genselect(Journey, "journey")
-        self.c.execute(qrystr, qrytup)
-        journey_rows = self.c.fetchall()
-        journey_rowdicts = [
-            dictify_row(row, Journey.colnames["journey"])
-            for row in journey_rows]
-        # fetch all spot rows
-        qrystr = genselect(Spot, "spot")
-        self.c.execute(qrystr, qrytup)
-        spot_rows = self.c.fetchall()
-        spot_rowdicts = [dictify_row(row, Spot.colnames["spot"])
-                         for row in spot_rows]
-        # fetch all pawn rows
-        qrystr = genselect(Pawn, "pawn")
-        self.c.execute(qrystr, qrytup)
-        pawn_rows = self.c.fetchall()
-        pawn_rowdicts = [dictify_row(row, Pawn.colnames["pawn"])
-                         for row in pawn_rows]
-        # Dimension is no longer an adequate key; stop using genselect
-
-        # find out what menus this board has
-        qrystr = "SELECT menu FROM boardmenu WHERE board=?"
-        self.c.execute(qrystr, qrytup)
-        menutups = self.c.fetchall()
-        menunames = [tup[0] for tup in menutups]
-        # load them
-        qrystr = ("SELECT " + ", ".join(Menu.colnames["menu"]) +
-                  " FROM menu WHERE name IN (" +
-                  ", ".join(["?"] * len(menunames)) + ")")
-        qrytup = tuple(menunames)
-        self.c.execute(qrystr, qrytup)
-        menu_rows = self.c.fetchall()
-        menu_rowdicts = [dictify_row(row, Menu.colnames["menu"])
-                         for row in menu_rows]
-        # load the menus' items
-        qrystr = ("SELECT " + ", ".join(MenuItem.colnames["menuitem"]) +
-                  " FROM menuitem WHERE menu IN (" +
-                  ", ".join(["?"] * len(menunames)) + ")")
-        self.c.execute(qrystr, qrytup)
-        menu_item_rows = self.c.fetchall()
-        menu_item_rowdicts = [dictify_row(row, MenuItem.colnames["menuitem"])
-                              for row in menu_item_rows]
-        stylenames = [rowdict["style"] for rowdict in menu_rowdicts]
-        # load the styles in the menus
-        qrystr = ("SELECT " + ", ".join(Style.colnames["style"]) +
-                  " FROM style WHERE name IN (" +
-                  ", ".join(["?"] * len(stylenames)) + ")")
-        qrytup = tuple(stylenames)
-        self.c.execute(qrystr, qrytup)
-        style_rows = self.c.fetchall()
-        # load the colors in the styles
-        style_rowdicts = [dictify_row(row, Style.colnames["style"])
-                          for row in style_rows]
-        colornames = []
-        for rowdict in style_rowdicts:
-            colornames.extend([rowdict["bg_inactive"], rowdict["bg_active"],
-                               rowdict["fg_inactive"], rowdict["fg_active"]])
-        # load the colors
-        qrystr = ("SELECT " + ", ".join(Color.colnames["color"]) +
-                  " FROM color WHERE name IN (" +
-                  ", ".join(["?"] * len(colornames)) + ")")
-        qrytup = tuple(colornames)
-        self.c.execute(qrystr, qrytup)
-        color_rows = self.c.fetchall()
-        color_rowdicts = [
-            dictify_row(row, Color.colnames["color"])
-            for row in color_rows]
-        # load the imgs
-        imgs2load = set()
-        qrystr = genselect(Board, "board")
-        self.c.execute(qrystr, (dimension,))
-        board_rowdict = dictify_row(self.c.fetchone(), Board.colnames["board"])
-        imgs2load.add(board_rowdict["wallpaper"])
-        for row in spot_rowdicts:
-            imgs2load.add(row["img"])
-        for row in pawn_rowdicts:
-            imgs2load.add(row["img"])
-        imgnames = list(imgs2load)
-        qrystr = ("SELECT " + ", ".join(Img.colnames["img"]) +
-                  " FROM img WHERE name IN (" +
-                  ", ".join(["?"] * len(imgnames)) + ")")
-        qrytup = tuple(imgnames)
-        self.c.execute(qrystr, qrytup)
-        img_rows = self.c.fetchall()
-        img_rowdicts = [dictify_row(row, Img.colnames["img"])
-                        for row in img_rows]
-        for row in img_rowdicts:
-            if row["rltile"]:
-                self.load_rltile(row["name"], row["path"])
-            else:
-                self.load_regular_img(row["name"], row["path"])
-        # OK, all the data is loaded. Now construct Python objects of it all.
-
-        for row in color_rowdicts:
-            color = Color(self, row)
-            self.colordict[row["name"]] = color
-        for row in style_rowdicts:
-            style = Style(self, row)
-            self.styledict[row["name"]] = style
-        if dimension not in self.boardmenudict:
-            self.boardmenudict[dimension] = {}
-        for row in menu_rowdicts:
-            menu = Menu(self, row)
-            self.boardmenudict[dimension][row["name"]] = menu
-        for row in menu_item_rowdicts:
-            menuitem = MenuItem(self, row, dimension)
-            menu = self.boardmenudict[dimension][row["menu"]]
-            while row["idx"] >= len(menu.items):
-                menu.items.append(None)
-            menu.items[row["idx"]] = menuitem
-        if dimension not in self.placedict:
-            self.placedict[dimension] = {}
-        for row in place_rowdicts:
-            pl = Place(self, row)
-            self.placedict[dimension][row["name"]] = pl
-        if dimension not in self.thingdict:
-            self.thingdict[dimension] = {}
-        for row in thing_rowdicts:
-            th = Thing(self, row)
-            self.thingdict[dimension][row["name"]] = th
-        # Places and things depend on one another. Only now I've
-        # loaded them both may I link them to one another.
-        for row in location_rowdicts:
-            thing = self.thingdict[dimension][row["thing"]]
-            place = self.placedict[dimension][row["place"]]
-            thing.location = place
-            place.contents.append(thing)
-        if dimension not in self.containerdict:
-            self.containerdict[dimension] = {}
-        if dimension not in self.contentsdict:
-            self.contentsdict[dimension] = {}
-        for row in containment_rowdicts:
-            inner = self.thingdict[dimension][row["contained"]]
-            outer = self.thingdict[dimension][row["container"]]
-            outer.contents.append(inner)
-        if dimension not in self.portaldict:
-            self.portaldict[dimension] = {}
-        for row in portal_rowdicts:
-            portal = Portal(self, row)
-            self.portaldict[dimension][row["name"]] = portal
-            self.placedict[dimension][row["from_place"]].portals.append(portal)
-        if dimension not in self.journeydict:
-            self.journeydict[dimension] = {}
-        for row in journey_rowdicts:
-            journey = Journey(self, row)
-            self.journeydict[dimension][row["thing"]] = journey
-        for row in journey_step_rowdicts:
-            journey = self.journeydict[dimension][row["thing"]]
-            portal = self.portaldict[dimension][row["portal"]]
-            journey.set_step(portal, row["idx"])
-        if dimension not in self.spotdict:
-            self.spotdict[dimension] = {}
-        for row in spot_rowdicts:
-            spot = Spot(self, row)
-            self.spotdict[dimension][row["place"]] = spot
-            self.placedict[dimension][row["place"]].spot = spot
-        if dimension not in self.pawndict:
-            self.pawndict[dimension] = {}
-        for row in pawn_rowdicts:
-            pawn = Pawn(self, row)
-            self.pawndict[dimension][row["thing"]] = pawn
-            self.thingdict[dimension][row["thing"]].pawn = pawn
-        board = Board(self, board_rowdict)
+    def load_board(self, dimension, view=None):
+        """Load everything needed to show the board for the dimension,
+and return the board, or None if there is no such board.
+
+This takes one query for the images, one for the menus, and one for
+the contents of the dimension; see board_load_plan. Each row becomes
+an object as soon as it comes off the cursor. Time spent in each
+stage is kept in self.load_timings[dimension].
+
+Image files are decoded on other threads from when their rows arrive
+until the first spot, pawn or board needs them, so the decoding
+happens while the menus, places, things, portals and journeys load.
+
+If the database is lazy, only the spots in view, and the pawns on
+them, are loaded; view is a tuple of (left, bottom, right, top) and
+defaults to the whole board. Places, things and portals are loaded
+when something looks them up. Call load_view to load more of the
+board.
+
+"""
+        self.init_dimension(dimension)
+        timer = LoadTimer()
+        qrydict = {"dimension": dimension}
+        if self.lazy:
+            self.run_load_plan(lazy_board_load_plan, lazy_board_load_qrys,
+                               qrydict, timer)
+            qrydict.update(view_params(view))
+            self.run_load_plan(view_load_plan, view_load_qrys,
+                               qrydict, timer)
+        else:
+            self.run_load_plan(board_load_plan, board_load_qrys,
+                               qrydict, timer)
+        timer.stop()
+        self.load_timings[dimension] = timer
+        if dimension not in self.boarddict:
+            return None
+        board = self.boarddict[dimension]
         for pawn in board.pawns:
-            pawn.board = board
+            board.add_pawn(pawn)
         for spot in board.spots:
             spot.board = board
         for menu in board.menus:
             menu.board = board
-        self.boarddict[dimension] = board
         return board
 
+    def load_view(self, dimension, view):
+        """Load the spots in the view, and the pawns on them, that haven't
+been loaded already. Only makes sense if the database is lazy and
+load_board has been called for the dimension."""
+        timer = LoadTimer()
+        qrydict = {"dimension": dimension}
+        qrydict.update(view_params(view))
+        self.run_load_plan(view_load_plan, view_load_qrys, qrydict, timer)
+        timer.stop()
+        board = self.boarddict[dimension]
+        for pawn in board.pawns:
+            board.add_pawn(pawn)
+        for spot in board.spots:
+            spot.board = board
+        return timer
+
+    def unload_board(self, dimension):
+        """Forget the board, its spots, pawns and menus, and let go of the
+images they used. Return the names of the images evicted as a result.
+
+The places, things and portals stay loaded. Loading the board again
+makes new spots and pawns, with whatever textures are in the cache by
+then.
+
+"""
+        if dimension in self.boarddict:
+            del self.boarddict[dimension]
+        if dimension in self.pawndict:
+            for thingname in self.pawndict[dimension].iterkeys():
+                thing = self.thingdict[dimension].get(thingname)
+                if thing is not None and hasattr(thing, "pawn"):
+                    del thing.pawn
+        for d in (self.spotdict, self.pawndict, self.boardmenudict):
+            if dimension in d:
+                del d[dimension]
+        self.init_dimension(dimension)
+        return self.imgdict.release(dimension)
+
+    def init_dimension(self, dimension):
+        """Make empty dicts to hold the dimension's objects, if they aren't
+there already."""
+        if self.lazy:
+            lazydicts = ((self.placedict, LazyPlaces),
+                         (self.thingdict, LazyThings),
+                         (self.portaldict, LazyPortals),
+                         (self.spotdict, LazySpots))
+        else:
+            lazydicts = ()
+        for (d, lazyclas) in lazydicts:
+            if dimension not in d:
+                d[dimension] = lazyclas(self, dimension)
+        if dimension not in self.dimensiondict:
+            self.dimensiondict[dimension] = Dimension(
+                self, {"name": dimension})
+        for d in (self.placedict, self.thingdict, self.portaldict,
+                  self.journeydict, self.spotdict, self.pawndict,
+                  self.boardmenudict, self.containerdict,
+                  self.contentsdict):
+            if dimension not in d:
+                d[dimension] = {}
+
+    def get_dimension(self, dimension):
+        """Return the Dimension, with every portal in it, for routing.
+
+This loads the portals that haven't been loaded, but not the places at
+their ends.
+
+"""
+        self.init_dimension(dimension)
+        if self.lazy:
+            self.portaldict[dimension].fault_all()
+        elif dimension not in self.whole_dimensions:
+            self.load_dimension_portals(dimension)
+            self.whole_dimensions.add(dimension)
+        return self.dimensiondict[dimension]
+
+    def load_dimension_portals(self, dimension):
+        """Load every portal in the dimension that isn't loaded, and put it
+in the Dimension. Portals out of places that are loaded go in their
+portals too."""
+        cols = Portal.colnames["portal"]
+        qrystr = "SELECT %s FROM portal WHERE dimension=?" % (
+            ", ".join(cols),)
+        portals = self.portaldict[dimension]
+        places = self.placedict[dimension]
+        dim = self.dimensiondict[dimension]
+        for row in self.conn.execute(qrystr, (dimension,)):
+            rowdict = dict(zip(cols, row))
+            if rowdict["name"] in portals:
+                continue
+            portal = Portal(self, rowdict)
+            portals[rowdict["name"]] = portal
+            dim.add_portal(portal)
+            if rowdict["from_place"] in places:
+                places[rowdict["from_place"]].add_portal(portal)
+
+    def link_portal(self, portal):
+        """Put a new portal in portaldict, the portals of the place it leads
+from, if that's loaded, and the Dimension, which tells the route
+table."""
+        dimension = portal.dimension
+        self.init_dimension(dimension)
+        portals = self.portaldict[dimension]
+        if dict.get(portals, portal.name) is not portal:
+            dict.__setitem__(portals, portal.name, portal)
+        place = dict.get(self.placedict[dimension], portal.origname)
+        if place is not None and portal not in place.portals:
+            place.add_portal(portal)
+        self.dimensiondict[dimension].add_portal(portal)
+        self.forget_saved_routes(dimension)
+
+    def unlink_portal(self, portal):
+        """Take the portal out of portaldict, the portals of the place it
+leads from, and the Dimension, which tells the route table."""
+        dimension = portal.dimension
+        portals = self.portaldict.get(dimension, {})
+        if dict.get(portals, portal.name) is portal:
+            del portals[portal.name]
+        place = dict.get(self.placedict.get(dimension, {}), portal.origname)
+        if place is not None and portal in place.portals:
+            place.remove_portal(portal)
+        if dimension in self.dimensiondict:
+            self.dimensiondict[dimension].remove_portal(portal)
+            self.forget_saved_routes(dimension)
+
+    def forget_saved_routes(self, dimension):
+        """If the dimension has no RouteTable to keep its saved routes up
+to date, delete them all at the next sync. Saving the whole Dimension
+does that."""
+        dim = self.dimensiondict[dimension]
+        if dim.routes is None:
+            self.remember(dim)
+
+    def get_routes(self, dimension):
+        """Return the RouteTable for the dimension, with whatever routes
+were saved, making it if need be."""
+        dim = self.get_dimension(dimension)
+        if dim.routes is None:
+            dim.routes = RouteTable(self, dim)
+            # If the saved routes are to be deleted, they're stale.
+            if not (dim in self.altered and self.altered[dim] is None):
+                self.flush()
+                dim.routes.load()
+        return dim.routes
+
+    def run_load_plan(self, plan, qrys, qrydict, timer):
+        """Run each query of the plan and hand its rows to
+load_handlers."""
+        self.loading_dimension = qrydict["dimension"]
+        i = 0
+        while i < len(plan):
+            stages = plan[i]
+            # Execution time counts toward the first stage of the
+            # query, since SQLite does some of its work before it
+            # gives up the first row.
+            timer.start(stages[0][0])
+            self.c.execute(qrys[i], qrydict)
+            stream_stages(self.c, stages, self.load_handlers, timer)
+            i += 1
+        self.finish_imgs()
+
+    def load_img_row(self, row):
+        # The img may be loaded for another board already, or another
+        # img may have been loaded from the same file. Otherwise its
+        # file is decoded while the rest of the board loads, and
+        # finish_imgs makes the texture.
+        name = row["name"]
+        path = row["path"]
+        if (name in self.imgdict or self.alias_img(name, path) or
+                self.load_from_atlas(name, path) is not None):
+            self.imgdict.acquire(name, self.loading_dimension)
+        else:
+            self.decoder.submit(path, row["rltile"])
+            self.decoding.append((name, path, self.loading_dimension))
+
+    def alias_img(self, name, path):
+        """If there's a texture from the path already, give the img a
+region of it, and return True."""
+        tex = self.imgdict.texture_from(path)
+        if tex is None:
+            return False
+        alias = tex.get_region(0, 0, tex.width, tex.height)
+        alias.name = name
+        self.imgdict.put(name, path, alias)
+        return True
+
+    def finish_imgs(self):
+        """Wait for the imgs being decoded, and make their textures.
+
+Spots, pawns and boards need their imgs, so their rows call this
+first. It's quick when there's nothing to wait for.
+
+"""
+        if len(self.decoding) == 0:
+            return
+        # Take the list first, so that if anything below raises, the
+        # next call doesn't wait for the same imgs again.
+        decoding = self.decoding
+        self.decoding = []
+        decoded = self.decoder.finish()
+        for (name, path, dimension) in decoding:
+            if name not in self.imgdict and not self.alias_img(name, path):
+                tex = make_texture(decoded[path])
+                tex.name = name
+                self.imgdict.put(name, path, tex)
+            self.imgdict.acquire(name, dimension)
+
+    def load_color_row(self, row):
+        self.colordict[row["name"]] = Color(self, row)
+
+    def load_style_row(self, row):
+        self.styledict[row["name"]] = Style(self, row)
+
+    def load_menu_row(self, row):
+        # Menus don't have a dimension column. They belong to
+        # whatever board is loading.
+        dimension = self.loading_dimension
+        self.boardmenudict[dimension][row["name"]] = Menu(self, row)
+
+    def load_menuitem_row(self, row):
+        dimension = self.loading_dimension
+        menuitem = MenuItem(self, row, dimension)
+        menu = self.boardmenudict[dimension][row["menu"]]
+        while row["idx"] >= len(menu.items):
+            menu.items.append(None)
+        menu.items[row["idx"]] = menuitem
+
+    def load_place_row(self, row):
+        self.placedict[row["dimension"]][row["name"]] = Place(self, row)
+
+    def load_thing_row(self, row):
+        self.thingdict[row["dimension"]][row["name"]] = Thing(self, row)
+
+    # Places and things depend on one another. The plan loads them
+    # both before any of these links.
+    def load_location_row(self, row):
+        dimension = row["dimension"]
+        thing = self.thingdict[dimension][row["thing"]]
+        place = self.placedict[dimension][row["place"]]
+        link_location(thing, place)
+
+    def load_containment_row(self, row):
+        dimension = row["dimension"]
+        inner = self.thingdict[dimension][row["contained"]]
+        outer = self.thingdict[dimension][row["container"]]
+        outer.add_content(inner)
+
+    def load_portal_row(self, row):
+        # get_dimension may have loaded the portal already.
+        dimension = row["dimension"]
+        portal = dict.get(self.portaldict[dimension], row["name"])
+        if portal is None:
+            portal = Portal(self, row)
+            self.portaldict[dimension][row["name"]] = portal
+            self.dimensiondict[dimension].add_portal(portal)
+        self.placedict[dimension][row["from_place"]].add_portal(portal)
+
+    def load_journey_row(self, row):
+        journeys = self.journeydict[row["dimension"]]
+        if row["thing"] not in journeys:
+            journeys[row["thing"]] = Journey(self, row)
+
+    def load_journeystep_row(self, row):
+        dimension = row["dimension"]
+        journey = self.journeydict[dimension][row["thing"]]
+        portal = self.portaldict[dimension][row["portal"]]
+        journey.set_step(portal, row["idx"])
+
+    def load_spot_row(self, row):
+        self.finish_imgs()
+        spots = self.spotdict[row["dimension"]]
+        if row["place"] not in spots:
+            spots[row["place"]] = Spot(self, row)
+
+    def load_pawn_row(self, row):
+        self.finish_imgs()
+        dimension = row["dimension"]
+        pawns = self.pawndict[dimension]
+        if row["thing"] not in pawns:
+            pawn = Pawn(self, row)
+            pawns[row["thing"]] = pawn
+            self.thingdict[dimension][row["thing"]].pawn = pawn
+
+    def load_board_row(self, row):
+        self.finish_imgs()
+        self.boarddict[row["dimension"]] = Board(self, row)
+
+    def use_tile_atlas(self, cachepath, rootdir="rltiles"):
+        """Load rltiles out of the atlas in the cache file from now on,
+building it first if need be."""
+        self.atlas = TileAtlas.load(cachepath, rootdir)
+
+    def load_from_atlas(self, name, path):
+        """Return the img's texture out of the atlas, or None if it isn't
+there."""
+        if self.atlas is None or path not in self.atlas:
+            return None
+        atlas = self.atlas
+        page = atlas.page_of(path)
+        tex = atlas.texture(path)
+        tex.name = name
+        self.imgdict.put(name, path, tex, ("atlas", page),
+                         atlas.page_bytes(), lambda: atlas.drop(page))
+        return tex
+
     def load_rltile(self, name, path):
-        badimg = image(path)
-        badimgd = badimg.get_image_data()
-        bad_rgba = badimgd.get_data('RGBA', badimgd.pitch)
-        good_data = bad_rgba.replace('\xffGll', '\x00Gll')
-        good_data = good_data.replace('\xff.', '\x00.')
-        badimgd.set_data('RGBA', badimgd.pitch, good_data)
-        rtex = badimgd.get_texture()
+        rtex = self.load_from_atlas(name, path)
+        if rtex is not None:
+            return rtex
+        rtex = make_texture(decode_rltile(path))
         rtex.name = name
-        self.imgdict[name] = rtex
+        self.imgdict.put(name, path, rtex)
         return rtex
 
     def load_regular_img(self, name, path):
-        tex = image(path).get_image_data().get_texture()
+        tex = self.load_from_atlas(name, path)
+        if tex is not None:
+            return tex
+        tex = make_texture(decode_img(path))
         tex.name = name
-        self.imgdict[name] = tex
+        self.imgdict.put(name, path, tex)
         return tex
 
     def toggle_menu_visibility(self, stringly):
@@ -1003,152 +1482,142 @@ visibility of the given menu on the given board.
                         else:
                             raise Exception("Unable to disambiguate"
                                             "the menu identifier: " + stringly)
-            menu.toggle_visibility()
         else:
             # Nice. Toggle that.
             (boardname, menuname) = splot
-            self.boardmenudict[boardname][menuname].toggle_visibility()
+            menu = self.boardmenudict[boardname][menuname]
+        menu.toggle_visibility()
+        self.remember(menu, "visible")
+
+    def remember(self, obj, *cols):
+        """Save the object at the next sync.
 
-    def remember(self, obj):
-        self.altered.add(obj)
+If you name some columns, only those will be written, with an UPDATE;
+the object has to be in the database already. Otherwise the whole
+object will be written, whether it's in the database or not.
+
+"""
+        for col in cols:
+            if not any([col in valnames
+                        for valnames in obj.valnames.itervalues()]):
+                raise ValueError(
+                    "%s has no column %s that can change" % (
+                        obj.__class__.__name__, col))
+        self.removed.discard(obj)
+        if len(cols) == 0:
+            self.altered[obj] = None
+        elif obj not in self.altered:
+            self.altered[obj] = set(cols)
+        elif self.altered[obj] is not None:
+            self.altered[obj].update(cols)
+        if isinstance(obj, Portal) and len(cols) == 0:
+            self.link_portal(obj)
 
     def forget(self, obj):
+        """Delete the object from the database at the next sync. Portals
+are taken out of the map at once."""
+        if obj in self.altered:
+            del self.altered[obj]
         self.removed.add(obj)
+        if isinstance(obj, Portal):
+            self.unlink_portal(obj)
 
     def sync(self):
-        """Write all altered objects to disk. Delete all deleted objects from
-disk.
-
-        """
-        # Handle additions and changes first.
-        #
-        # To sort the objects into known, unknown, and changed, I'll
-        # need to query all their tables with their respective
-        # keys. To do that I need to group these objects according to
-        # what table they go in.
-
-        tabdict = {}
-        for obj in iter(self.altered):
-            if obj.tabname not in tabdict:
-                tabdict[obj.tabname] = []
-            tabdict[obj.tabname].append(obj)
-        # get known objects for each table
-        knowndict = {}
-        for tabset in tabdict.iteritems():
-            (tabname, objs) = tabset
-            clas = objs[0].__class__
-            keynames = clas.keynames
-            qmstr = clas.keys_qm(len(objs))
-            keystr = ", ".join(keynames)
-            qrystr = "SELECT %s FROM %s WHERE (%s) IN (%s)" % (
-                keystr, tabname, keystr, qmstr)
-            keys = []
-            for obj in objs:
-                keys.extend([getattr(obj, keyname) for keyname in keynames])
-            qrytup = tuple(keys)
-            self.c.execute(qrystr, qrytup)
-            knowndict[tabname] = self.c.fetchall()
-        knownobjs = {}
-        for item in knowndict.iteritems():
-            (tabname, rows) = item
-            knownobjs[tabname] = set(rows)
-        # Get changed objects for each table. For this I need only
-        # consider objects that are known.
-        changeddict = {}
-        for known in knownobjs.iteritems():
-            (table, objs) = known
-            clas = objs[0].__class__
-            colnames = clas.colnames
-            qmstr = clas.rows_qm(len(objs))
-            colstr = ", ".join(colnames)
-            qrystr = "SELECT %s FROM %s WHERE (%s) NOT IN (%s)" % (
-                colstr, tabname, colstr, qmstr)
-            cols = []
-            for obj in objs:
-                cols.extend([getattr(obj, colname) for colname in colnames])
-            qrytup = tuple(cols)
-            self.c.execute(qrystr, qrytup)
-            changeddict[tabname] = self.c.fetchall()
-        changedobjs = {}
-        for item in changeddict.iteritems():
-            (tabname, rows) = item
-            # The objects represented here are going to be the same
-            # kind as are always represented by this table, so grab
-            # the keynames from knownobjs--they're the same
-            keynames = knownobjs[tabname][0].keynames
-            keylen = len(keynames)
-            keys = [row[:keylen] for row in rows]
-            objlst = [tabdict[tabname][key] for key in keys]
-            changedobjs[tabname] = set(objlst)
-        # I can find the unknown objects without touching the
-        # database, using set differences
-        tabsetdict = {}
-        for item in tabdict.iteritems():
-            if item[0] not in tabsetdict:
-                tabsetdict[item[0]] = item[1].viewvalues()
-        unknownobjs = {}
-        for item in tabsetdict.iteritems():
-            (table, objset) = item
-            unknownobjs[table] = objset - unknownobjs[table]
-        deletions_by_table = {}
-        insertions_by_table = {}
-        changel = [
-            (item[0], list(item[1])) for item in changedobjs.iteritems()]
-        # changel is pairs where the first item is the table name and
-        # the last item is a list of objects changed in that table
-        for pair in changel:
-            (table, objs) = pair
-            # invariant: all the objs are of the same class
-            # list of tuples representing keys to delete
-            dellst = [obj.key for obj in objs]
-            deletions_by_table[table] = dellst
-            # list of tuples representing rows to insert
-            inslst = [obj.key + obj.val for obj in objs]
-            insertions_by_table[table] = inslst
-        newl = [
-            (item[0], list(item[1])) for item in unknownobjs.iteritems]
-        for pair in newl:
-            (table, objs) = pair
-            inslst = [obj.key + obj.val for obj in objs]
-            if table in insertions_by_table:
-                insertions_by_table[table].extend(inslst)
-            else:
-                insertions_by_table[table] = inslst
-        # Now handle things that have actually been deleted from the
-        # world.
-        #
-        # If and when I get my own special-snowflake journal
-        # system working, journal entries should not be included here.
-        #
-        # Invariant: No object is in both self.altered and self.removed.
-        for obj in self.removed:
-            deletions_by_table[obj.tabname].append(obj)
-        # delete things to be changed, and things to be actually deleted
-        for item in deletions_by_table.iteritems():
-            (table, keys) = item
-            keynamestr = ", ".join(keys[0].keynames)
-            qmstr = keys[0].keys_qm(len(keys))
-            keylst = []
-            for key in keys:
-                keylst.extend(key)
-            qrystr = "DELETE FROM %s WHERE (%s) IN (%s)" % (
-                table, keynamestr, qmstr)
-            qrytup = tuple(keylst)
-            self.c.execute(qrystr, qrytup)
-        # insert things whether they're changed or new
-        for item in insertions_by_table.iteritems():
-            (table, rows) = item
-            qmstr = rows[0].rows_qm(len(rows))
-            vallst = []
-            for row in rows:
-                vallst.extend(row)
-            qrystr = "INSERT INTO %s VALUES (%s)" % (
-                table, qmstr)
-            qrytup = tuple(vallst)
-            self.c.execute(qrystr, qrytup)
-        # that'll do.
-        self.altered = set()
+        """Write all altered objects to disk. Delete all forgotten objects
+from disk. Do it in one transaction, and return a SyncStats.
+
+If saving is asynchronous, the objects' rows are copied now and
+written later, and this returns None. flush returns the SyncStats.
+
+If the transaction fails, nothing is forgotten: the objects are still
+to be saved at the next sync.
+
+"""
+        if self.writer is not None:
+            self.take_back_failed()
+        changes = None
+        if self.columns is not None:
+            changes = self.columns.changes(self.altered, self.removed)
+        plan = plan_sync(self.altered, self.removed)
+        if self.writer is not None:
+            self.writer.submit(plan, (self.altered, self.removed, changes))
+            self.altered = {}
+            self.removed = set()
+            self.apply_saved()
+            return None
+        stats = run_sync_plan(self.conn, plan)
+        self.altered = {}
         self.removed = set()
+        if changes is not None:
+            self.columns.apply(changes)
+        return stats
+
+    def apply_saved(self):
+        """Put the changes the writer has saved since last time into the
+ColumnStore."""
+        saved = self.writer.saved
+        while len(saved) > 0:
+            (altered, removed, changes) = saved.popleft()
+            if self.columns is not None:
+                self.columns.apply(changes)
+
+    def take_back_failed(self):
+        """If the writer failed to save something, wait for it to get
+through its queue, and raise what went wrong--but first, put the
+objects of every plan it didn't save back in altered and removed, to
+be saved at the next sync.
+
+They go in oldest first, with what's been remembered and forgotten
+since on top, as if every remember and forget had been done again in
+order.
+
+"""
+        if self.writer.error is None:
+            return
+        self.writer.wait()
+        failed = self.writer.failed
+        batches = list(failed) + [(self.altered, self.removed, None)]
+        failed.clear()
+        altered = {}
+        removed = set()
+        for (batch_altered, batch_removed, changes) in batches:
+            for obj in batch_removed:
+                altered.pop(obj, None)
+                removed.add(obj)
+            for (obj, cols) in batch_altered.iteritems():
+                removed.discard(obj)
+                if cols is None or (obj in altered and altered[obj] is None):
+                    altered[obj] = None
+                else:
+                    altered[obj] = altered.get(obj, set()) | cols
+        self.altered = altered
+        self.removed = removed
+        self.apply_saved()
+        self.writer.check()
+
+    def load_columns(self):
+        """Read every table into a ColumnStore, with one query each, and
+return it. From now on, sync keeps it up to date with what it writes.
+Changes go into it only once they're on disk: after sync, or with
+asynchronous saving, after the next sync or flush that finds them
+written."""
+        self.flush()
+        self.columns = ColumnStore(table_classes)
+        self.columns.load(self.conn)
+        return self.columns
+
+    def flush(self):
+        """Wait for asynchronous saves to finish. Return the SyncStats of
+the last one, or None if there weren't any.
+
+If one failed, raise what went wrong. Whatever didn't get saved is to
+be saved at the next sync."""
+        if self.writer is None:
+            return None
+        self.writer.wait()
+        self.take_back_failed()
+        self.apply_saved()
+        return self.writer.last_stats
 
     def things_in_place(self, place):
         dim = place.dimension
@@ -2,6 +2,7 @@ import pyglet
 from database import Database
 from state import GameState
 from widgets import Menu, MenuItem, Spot, Pawn
+from spatial import HitGrid
 
 
 def point_is_in(x, y, listener):
@@ -13,6 +14,94 @@ def point_is_between(x, y, x1, y1, x2, y2):
     return x >= x1 and x <= x2 and y >= y1 and y <= y2
 
 
+class PortalEdges:
+    """Every portal between two spots on the board, as a line, in one
+vertex list.
+
+Portal number i has vertices 2i and 2i+1. For each place, touching
+lists the portals that start or end there, so moving a spot rewrites
+the vertices of just those portals.
+
+Only portals with a spot at both ends are drawn. Others are ignored,
+so the Dimension can pass on every portal it gets.
+
+"""
+    def __init__(self, batch, group, spots, portals):
+        self.batch = batch
+        self.group = group
+        self.spots = spots
+        self.portals = []
+        self.slot = {}
+        self.touching = {}
+        self.vlist = None
+        for portal in portals:
+            if self.drawable(portal):
+                self.index(portal)
+        verts = []
+        for portal in self.portals:
+            verts.extend(self.vertices(portal))
+        if len(self.portals) > 0:
+            self.vlist = batch.add(len(verts) / 2, pyglet.graphics.GL_LINES,
+                                   group, ('v2i', verts))
+
+    def drawable(self, portal):
+        return (portal.origname in self.spots and
+                portal.destname in self.spots)
+
+    def index(self, portal):
+        self.slot[portal.name] = len(self.portals)
+        self.portals.append(portal)
+        for placename in (portal.origname, portal.destname):
+            if placename not in self.touching:
+                self.touching[placename] = []
+            self.touching[placename].append(portal)
+
+    def vertices(self, portal):
+        orig = portal.orig.spot
+        dest = portal.dest.spot
+        return [orig.x, orig.y, dest.x, dest.y]
+
+    def write(self, portal):
+        i = self.slot[portal.name] * 4
+        self.vlist.vertices[i:i + 4] = self.vertices(portal)
+
+    def spot_moved(self, spot):
+        for portal in self.touching.get(spot.place.name, ()):
+            self.write(portal)
+
+    def add_portal(self, portal):
+        if portal.name in self.slot or not self.drawable(portal):
+            return
+        self.index(portal)
+        if self.vlist is None:
+            self.vlist = self.batch.add(
+                2, pyglet.graphics.GL_LINES, self.group,
+                ('v2i', self.vertices(portal)))
+        else:
+            self.vlist.resize(len(self.portals) * 2)
+            self.write(portal)
+
+    def remove_portal(self, portal):
+        """Take the portal out, and put the last portal in its place."""
+        if portal.name not in self.slot:
+            return
+        i = self.slot.pop(portal.name)
+        for placename in (portal.origname, portal.destname):
+            self.touching[placename] = [
+                port for port in self.touching[placename]
+                if port.name != portal.name]
+        last = self.portals.pop()
+        if last is not portal:
+            self.portals[i] = last
+            self.slot[last.name] = i
+            self.write(last)
+        if len(self.portals) == 0:
+            self.vlist.delete()
+            self.vlist = None
+        else:
+            self.vlist.resize(len(self.portals) * 2)
+
+
 class GameWindow:
     # One window, batch, and WidgetFactory per board.
     def __init__(self, db, gamestate, boardname, batch=None):
@@ -22,6 +111,7 @@ class GameWindow:
         self.board = self.db.load_board(boardname)
         if self.board is None:
             raise Exception("No board by the name %s" % (boardname,))
+        self.board.pawn_positions.set_engine(self.gamestate.engine)
 
         self.boardgroup = pyglet.graphics.OrderedGroup(0)
         self.edgegroup = pyglet.graphics.OrderedGroup(1)
@@ -44,16 +134,16 @@ class GameWindow:
         self.view_left = 0
         self.view_bot = 0
 
-        self.to_mouse = list(self.board.pawns) + list(self.board.spots)
-        for menu in self.board.menus:
-            self.to_mouse.extend(menu.items)
-
         window = pyglet.window.Window()
         if batch is None:
             batch = pyglet.graphics.Batch()
 
         @window.event
         def on_draw():
+            self.board.pawn_positions.update()
+            for pawn in self.board.pawn_positions.moved_cells(
+                    self.hitgrid.cellsize):
+                self.hitgrid.move(pawn)
             self.add_stuff_to_batch()
 
         @window.event
@@ -83,77 +173,121 @@ class GameWindow:
             if menu.main_for_window:
                 self.mainmenu = menu
 
-        self.drawn = {"edges": {}}
+        # Layers for the hit grid go in the order things are drawn,
+        # so whatever's on top gets the mouse.
+        self.hitgrid = HitGrid()
+        for spot in self.board.spots:
+            self.hitgrid.add(spot, 0)
+        for pawn in self.board.pawns:
+            self.hitgrid.add(pawn, 1)
+        for menu in self.board.menus:
+            for item in menu.items:
+                if item is not None:
+                    self.hitgrid.add(item, 2)
+
+        # Sprites, labels and vertex lists stay in the batch from one
+        # frame to the next. Each frame, only the ones for widgets
+        # that changed are moved, recoloured, shown or hidden.
+        self.drawn = {}
+        self.boardsprite = None
+        self.color_images = {}
+        spots = self.db.spotdict[self.board.dimension]
+        self.edges = PortalEdges(
+            self.batch, self.edgegroup, spots,
+            [portal for spot in self.board.spots
+             for portal in spot.place.portals])
+        # Portals made or destroyed from now on come and go from the
+        # board the same way they do from the route table.
+        self.db.dimensiondict[self.board.dimension].edges = self.edges
+        self.calendar = None
+        self.calendar_changed = False
 
         self.menus_changed = [menu for menu in self.board.menus]
         self.pawns_changed = [pawn for pawn in self.board.pawns]
         self.spots_changed = [spot for spot in self.board.spots]
 
     def add_stuff_to_batch(self):
-        self.window.clear()
-        old = set()
-        newmenus = []
-        newmenuitems = []
-        newpawns = []
-        newspots = []
-        newcal = None
-        newbricks = []
+        """Update the batch for whatever changed since the last frame, and
+draw it."""
+        self.pawns_changed.extend(self.board.pawn_positions.moved())
         while len(self.menus_changed) > 0:
             menu = self.menus_changed.pop()
-            if menu in self.drawn:
-                old.add(self.drawn[menu])
-            newmenus.append(menu)
+            self.add_menu_to_batch(menu)
             for item in menu.items:
-                if item in self.drawn:
-                    old.add(self.drawn[item])
-                newmenuitems.append(item)
+                if item is not None:
+                    self.add_menu_item_to_batch(item)
         if self.calendar_changed:
-            cal = self.calendar
-            if cal in self.drawn:
-                old.add(self.drawn[cal])
-            newcal = cal
-            for brick in cal.bricks:
-                if brick in self.drawn:
-                    old.add(self.drawn[brick])
-                    newbricks.append(brick)
+            self.add_calendar_wall_to_batch(self.calendar)
+            for brick in self.calendar.bricks:
+                self.add_calendar_brick_to_batch(brick)
+            self.calendar_changed = False
         while len(self.pawns_changed) > 0:
-            pawn = self.pawns_changed.pop()
-            if pawn in self.drawn:
-                old.add(self.drawn[pawn])
-            newpawns.append(pawn)
+            self.add_pawn_to_batch(self.pawns_changed.pop())
+        moved = set()
         while len(self.spots_changed) > 0:
             spot = self.spots_changed.pop()
-            if spot in self.drawn:
-                old.add(self.drawn[spot])
-            newspots.append(spot)
-
-        if hasattr(self, 'boardsprite'):
-            old.add(self.boardsprite)
-        for trash in iter(old):
-            try:
-                trash.delete()
-            except AttributeError:
-                pass
-        for vex in self.drawn["edges"].itervalues():
-            vex.delete()
-
-        if newcal is not None:
-            self.add_calendar_wall_to_batch(newcal)
-            for brick in newbricks:
-                self.add_calendar_brick_to_batch(brick)
-        for menu in newmenus:
-            self.add_menu_to_batch(menu)
-        for item in newmenuitems:
-            self.add_menu_item_to_batch(item)
-        for pawn in newpawns:
-            self.add_pawn_to_batch(pawn)
-        for spot in newspots:
             self.add_spot_to_batch(spot)
-        for spot in self.board.spots:
-            self.add_spot_edges_to_batch(spot)
+            moved.add(spot)
+        for spot in moved:
+            self.edges.spot_moved(spot)
         self.add_board_to_batch()
+        self.window.clear()
         self.batch.draw()
 
+    def color_image(self, color, w, h):
+        """Return an image of the color, w by h, making it only the first
+time it's asked for."""
+        key = (color.tup, w, h)
+        if key not in self.color_images:
+            pattern = pyglet.image.SolidColorImagePattern(color.tup)
+            self.color_images[key] = pattern.create_image(w, h)
+        return self.color_images[key]
+
+    def put_sprite(self, key, image, x, y, group, visible=True):
+        """Make a sprite for the key, or move the one it has, and show or
+hide it."""
+        if key in self.drawn:
+            s = self.drawn[key]
+            if s.image is not image:
+                s.image = image
+            if s.x != x or s.y != y:
+                s.set_position(x, y)
+        else:
+            s = pyglet.sprite.Sprite(image, x, y,
+                                     batch=self.batch, group=group)
+            self.drawn[key] = s
+        if s.visible != visible:
+            s.visible = visible
+        return s
+
+    def put_label(self, key, text, style, color, x, y):
+        """Make a label for the key, or change the one it has."""
+        if key in self.drawn:
+            l = self.drawn[key]
+            l.begin_update()
+            if l.text != text:
+                l.text = text
+            if l.color != color.tup:
+                l.color = color.tup
+            if l.x != x or l.y != y:
+                (l.x, l.y) = (x, y)
+            l.end_update()
+        else:
+            l = pyglet.text.Label(text, style.fontface, style.fontsize,
+                                  color=color.tup, x=x, y=y,
+                                  batch=self.batch, group=self.labelgroup)
+            self.drawn[key] = l
+        return l
+
+    def drop_label(self, key):
+        if key in self.drawn:
+            self.drawn.pop(key).delete()
+
+    def autosave(self, ts):
+        # With an asynchronous database this only copies the altered
+        # rows; the writing happens on another thread.
+        self.db.sync()
+
     def toggle_menu_visibility_by_name(self, name):
         self.db.toggle_menu_visibility(self.board.dimension + '.' + name)
         return self.db.boardmenudict[self.board.dimension][name]
@@ -168,6 +302,7 @@ class GameWindow:
             self.menus_changed.append(it)
         elif isinstance(it, Spot):
             self.spots_changed.append(it)
+            self.board.pawn_positions.spot_moved(it)
             alsopawns = self.db.pawns_on_spot(it)
             self.pawns_changed.extend(alsopawns)
         elif isinstance(it, Pawn):
@@ -177,13 +312,10 @@ class GameWindow:
 
     def on_mouse_motion(self, x, y, dx, dy):
         if self.hovered is None:
-            for moused in self.to_mouse:
-                if moused is not None\
-                   and moused.interactive\
-                   and point_is_in(x, y, moused):
-                    self.hovered = moused
-                    self.change(moused)
-                    break
+            moused = self.hitgrid.at(x, y)
+            if moused is not None:
+                self.hovered = moused
+                self.change(moused)
         else:
             if not point_is_in(x, y, self.hovered):
                 self.change(self.hovered)
@@ -193,16 +325,17 @@ class GameWindow:
         if self.hovered is not None:
             self.change(self.hovered)
             self.hovered = None
-        for moused in self.to_mouse:
-            if point_is_in(x, y, moused):
-                self.change(moused)
-                self.pressed = moused
-                break
+        moused = self.hitgrid.at(x, y, interactive=False)
+        if moused is not None:
+            self.change(moused)
+            self.pressed = moused
 
     def on_mouse_release(self, x, y, button, modifiers):
         if self.grabbed is not None:
             self.change(self.grabbed)
             self.grabbed.dropped(x, y, button, modifiers)
+            if isinstance(self.grabbed, Spot):
+                self.db.remember(self.grabbed, "x", "y")
             self.grabbed = None
         elif self.pressed is not None:
             if point_is_in(x, y, self.pressed)\
@@ -220,6 +353,7 @@ class GameWindow:
     def on_mouse_drag(self, x, y, dx, dy, buttons, modifiers):
         if self.grabbed is not None:
             self.grabbed.move_with_mouse(x, y, dx, dy, buttons, modifiers)
+            self.hitgrid.move(self.grabbed)
             self.change(self.grabbed)
             if isinstance(self.grabbed, Spot):
                 for pawn in self.pawns_on(self.grabbed):
@@ -228,6 +362,7 @@ class GameWindow:
         elif self.pressed is not None:
             if hasattr(self.pressed, 'move_with_mouse'):
                 self.pressed.move_with_mouse(x, y, dx, dy, buttons, modifiers)
+                self.hitgrid.move(self.pressed)
                 self.grabbed = self.pressed
                 self.change(self.grabbed)
                 self.pressed = None
@@ -238,127 +373,72 @@ class GameWindow:
     def add_board_to_batch(self):
         x = -1 * self.view_left
         y = -1 * self.view_bot
-        s = pyglet.sprite.Sprite(self.board.img, x, y,
-                                 batch=self.batch, group=self.boardgroup)
-        self.boardsprite = s
+        if self.boardsprite is None:
+            self.boardsprite = pyglet.sprite.Sprite(
+                self.board.img, x, y,
+                batch=self.batch, group=self.boardgroup)
+        elif self.boardsprite.x != x or self.boardsprite.y != y:
+            self.boardsprite.set_position(x, y)
 
     def add_menu_to_batch(self, menu):
-        if menu.visible:
-            color = menu.style.bg_inactive
-            w = menu.getwidth()
-            h = menu.getheight()
-            pattern = pyglet.image.SolidColorImagePattern(color.tup)
-            image = pattern.create_image(w, h)
-            s = pyglet.sprite.Sprite(image, menu.getleft(), menu.getbot(),
-                                     batch=self.batch, group=self.menugroup)
-            self.drawn[menu] = s
+        image = self.color_image(menu.style.bg_inactive,
+                                 menu.getwidth(), menu.getheight())
+        self.put_sprite(menu, image, menu.getleft(), menu.getbot(),
+                        self.menugroup, menu.visible)
 
     def add_menu_item_to_batch(self, mi):
-        if mi.visible and mi.menu.visible:
-            sty = mi.menu.style
-            if self.hovered is mi:
-                color = sty.fg_active
-            else:
-                color = sty.fg_inactive
-            left = mi.getleft()
-            bot = mi.getbot()
-            l = pyglet.text.Label(mi.text, sty.fontface, sty.fontsize,
-                                  color=color.tup, x=left, y=bot,
-                                  batch=self.batch, group=self.labelgroup)
-            self.drawn[mi] = l
+        if not (mi.visible and mi.menu.visible):
+            self.drop_label(mi)
+            return
+        sty = mi.menu.style
+        if self.hovered is mi:
+            color = sty.fg_active
+        else:
+            color = sty.fg_inactive
+        self.put_label(mi, mi.text, sty, color, mi.getleft(), mi.getbot())
 
     def add_calendar_wall_to_batch(self, wall):
-        if wall.visible:
-            color = wall.style.bg_inactive
-            w = wall.getwidth()
-            h = wall.getheight()
-            pattern = pyglet.image.SolidColorImagePattern(color.tup)
-            image = pattern.create_image(w, h)
-            s = pyglet.sprite.Sprite(image, wall.getleft(), wall.getbot(),
-                                     batch=self.batch,
-                                     group=self.calendargroup)
-            self.drawn[wall] = s
+        image = self.color_image(wall.style.bg_inactive,
+                                 wall.getwidth(), wall.getheight())
+        self.put_sprite(wall, image, wall.getleft(), wall.getbot(),
+                        self.calendargroup, wall.visible)
 
     def add_calendar_brick_to_batch(self, brick):
-        if brick.visible and brick.wall.visible:
-            sty = brick.wall.style
-            if self.hovered is brick:
-                bgcolor = sty.bg_active
-                fgcolor = sty.fg_active
-            else:
-                bgcolor = sty.bg_inactive
-                fgcolor = sty.fg_inactive
-            pattern = pyglet.image.SolidColorImagePattern(bgcolor.tup)
-            w = brick.getwidth()
-            h = brick.getheight()
-            image = pattern.create_image(w, h)
-            brickleft = brick.getleft()
-            brickbot = brick.getbot()
-            bricktop = brick.gettop()
-            # Assuming one-line labels, and one label per brick.
-            # Not a sturdy assumption, fix later.
-            labelbot = bricktop - sty.fontsize - sty.spacing
-            labelleft = brickleft + sty.spacing
-            s = pyglet.sprite.Sprite(image, brickleft, brickbot,
-                                     batch=self.batch, group=self.brickgroup)
-            l = pyglet.text.Label(brick.text, sty.fontface, sty.fontsize,
-                                  color=fgcolor.tup, x=labelleft, y=labelbot,
-                                  batch=self.batch, group=self.labelgroup)
-            self.drawn[brick] = (s, l)
+        sty = brick.wall.style
+        visible = brick.visible and brick.wall.visible
+        if self.hovered is brick:
+            bgcolor = sty.bg_active
+            fgcolor = sty.fg_active
+        else:
+            bgcolor = sty.bg_inactive
+            fgcolor = sty.fg_inactive
+        image = self.color_image(bgcolor, brick.getwidth(), brick.getheight())
+        brickleft = brick.getleft()
+        brickbot = brick.getbot()
+        bricktop = brick.gettop()
+        self.put_sprite(brick, image, brickleft, brickbot,
+                        self.brickgroup, visible)
+        # Assuming one-line labels, and one label per brick.
+        # Not a sturdy assumption, fix later.
+        labelbot = bricktop - sty.fontsize - sty.spacing
+        labelleft = brickleft + sty.spacing
+        if visible:
+            self.put_label((brick, "label"), brick.text, sty, fgcolor,
+                           labelleft, labelbot)
+        else:
+            self.drop_label((brick, "label"))
 
     def add_spot_to_batch(self, spot):
-        if spot.visible:
-            s = pyglet.sprite.Sprite(spot.img, spot.x - spot.r, spot.y -
-                                     spot.r, batch=self.batch,
-                                     group=self.spotgroup)
-            self.drawn[spot] = s
-
-    def add_spot_edges_to_batch(self, spot):
-        e = []
-        for portal in spot.place.portals:
-            otherspot = portal.dest.spot
-            e.extend([spot.x, spot.y, otherspot.x, otherspot.y])
-        if len(e) > 0:
-            ee = self.batch.add(len(e) / 2, pyglet.graphics.GL_LINES,
-                                self.edgegroup, ('v2i', e))
-            self.drawn["edges"][spot] = ee
+        self.put_sprite(spot, spot.img, spot.x - spot.r, spot.y - spot.r,
+                        self.spotgroup, spot.visible)
 
     def add_pawn_to_batch(self, pawn):
-        # Getting the window coordinates whereupon to put the pawn
-        # will not be simple.  I'll first need the two places the
-        # thing stands between now; or, if it is not on a journey,
-        # then just its location. That's an easy case: draw the pawn
-        # on top of the spot for the location. But otherwise, I must
-        # find the spots to represent the beginning and the end of the
-        # portal in which the thing stands, and find the point the
-        # correct proportion of the distance between them.
-        if hasattr(pawn, 'journey'):
-            port = pawn.thing.journey.getstep(0)
-            prog = pawn.thing.progress
-            whence = self.db.spotdict[port.orig.name]
-            thence = self.db.spotdict[port.dest.name]
-            # a line between them
-            rise = thence.y - whence.y
-            run = thence.x - whence.x
-            # a point on the line, at prog * its length
-            x = whence.x + prog * run
-            y = whence.y + prog * rise
-            # this may put it off the bounds of the screen
-            s = pyglet.sprite.Sprite(pawn.img, x - pawn.r, y,
-                                     batch=self.batch, group=self.pawngroup)
-        else:
-            dim = pawn.board.dimension
-            locn = pawn.thing.location.name
-            spot = self.db.spotdict[dim][locn]
-            # Pawns are centered horizontally, but not vertically, on
-            # the spot they stand.  This prevents them from covering
-            # the spot overmuch while still making them look like
-            # they're "on top" of the spot.
-            x = spot.x
-            y = spot.y
-            s = pyglet.sprite.Sprite(pawn.img, x - pawn.r, y,
-                                     batch=self.batch, group=self.pawngroup)
-        self.drawn[pawn] = s
+        # Pawns are centered horizontally, but not vertically, on the
+        # point where they stand. board.pawn_positions worked that out
+        # at the start of the frame, for every pawn at once.
+        (x, y) = pawn.getcoords()
+        self.put_sprite(pawn, pawn.img, x - pawn.r, y, self.pawngroup,
+                        pawn.visible and pawn.is_placed())
 
     def pawns_on(self, spot):
         return [thing.pawn
@@ -366,14 +446,19 @@ class GameWindow:
 
 
 db = Database(":memory:")
+db.use_tile_atlas("rltiles.atlas")
 db.mkschema()
 db.insert_defaults()
 gamestate = GameState(db)
 gw = GameWindow(db, gamestate, 'Physical')
+gamestate.start_journeys(gw.board.dimension)
 
 
 gamespeed = 1/60.0
+autosave_interval = 1.0
 
-# pyglet.clock.schedule_interval(gamestate.update, gamespeed, gamespeed)
+pyglet.clock.schedule_interval(gamestate.update, gamespeed, gamespeed)
+pyglet.clock.schedule_interval(gw.autosave, autosave_interval)
 
 pyglet.app.run()
+db.flush()
@@ -0,0 +1,189 @@
+"""Keeping the textures that boards use, sharing them between boards,
+and letting go of them when no board needs them. Also decoding the
+images they're made from, on other threads."""
+import ctypes
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from pyglet import resource
+from pyglet.image import ImageData, load
+from tiles import read_bmp, key_rgba
+
+
+def texture_bytes(tex):
+    return tex.width * tex.height * 4
+
+
+def decode_rltile(path):
+    """Return the width, height and RGBA pixels of the tile, with its key
+colours made transparent.
+
+The pixels are a ctypes array over the bytearray read_bmp made, which
+pyglet takes as it is, so they're never copied.
+
+"""
+    (width, height, data) = read_bmp(path)
+    key_rgba(data, width)
+    return (width, height, (ctypes.c_ubyte * len(data)).from_buffer(data))
+
+
+def decode_img(path, f=None):
+    """Return the width, height and RGBA pixels of the image. f is the
+file, already open, if you like; it gets closed."""
+    if f is None:
+        f = resource.file(path)
+    try:
+        imgd = load(path, file=f).get_image_data()
+    finally:
+        f.close()
+    return (imgd.width, imgd.height, imgd.get_data('RGBA', imgd.width * 4))
+
+
+def make_texture(decoded):
+    """Make a texture of what decode_rltile or decode_img returned. Only
+on the thread with the GL context."""
+    (width, height, data) = decoded
+    return ImageData(width, height, 'RGBA', data, width * 4).get_texture()
+
+
+class ImageCache(dict):
+    """Textures by img name, counted by the file they came from.
+
+Each file's texture is loaded once. Another img with the same path gets
+a region of the same texture, so it can have its own name.
+
+Boards acquire the imgs they use and release them all when they're
+unloaded. A file none of whose imgs any board uses is idle. When the
+textures take up more than budget bytes, idle files are forgotten,
+least recently used first, and their textures go when the last
+reference to them does.
+
+Bytes are counted by source: the texture a file's imgs are regions of.
+That's usually the file's own, but tiles in an atlas share the page
+they're on, which is counted once, and let go of--by calling the free
+function it was put with--when the last of its files is forgotten.
+
+"""
+    def __init__(self, budget=256 * 1024 * 1024):
+        dict.__init__(self)
+        self.budget = budget
+        self.bytes = 0
+        self.paths = {}
+        self.names = {}
+        self.users = {}
+        self.sources = {}
+        self.source_paths = {}
+        self.sizes = {}
+        self.frees = {}
+        self.idle = OrderedDict()
+
+    def texture_from(self, path):
+        """Return a texture already loaded from the path, or None."""
+        if path not in self.names:
+            return None
+        for name in self.names[path]:
+            return self[name]
+
+    def put(self, name, path, tex, source=None, size=None, free=None):
+        """Keep the texture for the img. If it's the first from the path,
+source is what it's a region of, if not its own texture, and size the
+bytes that takes up."""
+        self[name] = tex
+        self.paths[name] = path
+        if path not in self.names:
+            if source is None:
+                (source, size) = (path, texture_bytes(tex))
+            self.names[path] = set()
+            self.users[path] = set()
+            self.sources[path] = source
+            if source not in self.source_paths:
+                self.source_paths[source] = set()
+                self.sizes[source] = size
+                self.frees[source] = free
+                self.bytes += size
+            self.source_paths[source].add(path)
+            self.idle[path] = None
+        self.names[path].add(name)
+
+    def acquire(self, name, user):
+        path = self.paths[name]
+        self.users[path].add(user)
+        if path in self.idle:
+            del self.idle[path]
+
+    def release(self, user):
+        """Stop counting the user against anything, then evict. Return the
+names of the imgs evicted."""
+        for (path, users) in self.users.iteritems():
+            if user in users:
+                users.remove(user)
+                if len(users) == 0:
+                    self.idle[path] = None
+        return self.evict()
+
+    def evict(self):
+        r = []
+        while self.bytes > self.budget and len(self.idle) > 0:
+            (path, none) = self.idle.popitem(last=False)
+            for name in self.names.pop(path):
+                del self[name]
+                del self.paths[name]
+                r.append(name)
+            del self.users[path]
+            source = self.sources.pop(path)
+            self.source_paths[source].remove(path)
+            if len(self.source_paths[source]) == 0:
+                del self.source_paths[source]
+                self.bytes -= self.sizes.pop(source)
+                free = self.frees.pop(source)
+                if free is not None:
+                    free()
+        return r
+
+
+class ImageDecoder:
+    """Decodes image files on a pool of threads.
+
+submit starts decoding a file and returns at once. finish waits for
+everything submitted since the last time, and returns a dict mapping
+the paths to what decode_rltile or decode_img returned, raising
+whatever one of them raised.
+
+Only decoding happens on the pool. Files are opened through
+pyglet.resource, which isn't safe to share between threads, before
+they're submitted, and textures are made by the caller. With no
+threads, files are decoded as they're submitted.
+
+"""
+    def __init__(self, threads=4):
+        self.threads = threads
+        self.pool = None
+        self.pending = {}
+
+    def __contains__(self, path):
+        return path in self.pending
+
+    def submit(self, path, rltile):
+        if path in self.pending:
+            return
+        if rltile:
+            (func, args) = (decode_rltile, (path,))
+        else:
+            (func, args) = (decode_img, (path, resource.file(path)))
+        if self.threads == 0:
+            decoded = func(*args)
+            self.pending[path] = lambda: decoded
+            return
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        self.pending[path] = self.pool.apply_async(func, args).get
+
+    def finish(self):
+        pending = self.pending
+        self.pending = {}
+        return dict([(path, get()) for (path, get) in pending.iteritems()])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
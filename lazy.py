@@ -0,0 +1,163 @@
+"""Mappings that load a dimension's places, things, portals and spots
+from the database the first time they're looked up.
+
+Database uses these in place of plain dicts when it's opened with
+lazy=True. Then load_board only loads what's on screen, and everything
+else is faulted in as it's needed.
+
+"""
+from graph import Place, Portal
+from thing import Thing
+from widgets import Spot
+from saveload import max_host_params, chunks
+
+
+def link_location(thing, place):
+    """Put the thing in the place, unless it's there already."""
+    if thing.location is place:
+        return
+    thing.location = place
+    place.add_content(thing)
+
+
+class LazyTable(dict):
+    """A dict of one kind of object in one dimension, keyed by name, that
+loads whatever it's missing from the database.
+
+Only lookups with [] fault. get(), in, and iteration see just what's
+been loaded so far.
+
+"""
+    def __init__(self, db, dimension):
+        dict.__init__(self)
+        self.db = db
+        self.dimension = dimension
+
+    def __missing__(self, name):
+        self.fault([name])
+        if not dict.__contains__(self, name):
+            raise KeyError(name)
+        return dict.__getitem__(self, name)
+
+    def missing(self, names):
+        return [name for name in names if not dict.__contains__(self, name)]
+
+    def select(self, clas, tabname, keycol, names):
+        """Return rowdicts from the table, for this dimension, where keycol
+is one of the names."""
+        cols = clas.colnames[tabname]
+        names = list(names)
+        r = []
+        # The dimension takes up one host parameter.
+        for chunk in chunks(names, max_host_params - 1):
+            qrystr = "SELECT %s FROM %s WHERE dimension=? AND %s IN (%s)" % (
+                ", ".join(cols), tabname, keycol,
+                ", ".join(["?"] * len(chunk)))
+            # A fresh cursor, in case db.c is in the middle of a load.
+            cursor = self.db.conn.execute(
+                qrystr, tuple([self.dimension] + chunk))
+            r.extend([dict(zip(cols, row)) for row in cursor])
+        return r
+
+    def fault(self, names):
+        raise NotImplementedError("Abstract")
+
+
+class LazyPlaces(LazyTable):
+    """Places, loaded with their portals and contents.
+
+Faulting a place prefetches its neighbors--the places its portals lead
+to--since whoever wanted the place is likely to want to go somewhere
+from it.
+
+"""
+    def fault(self, names):
+        db = self.db
+        names = set(self.missing(names))
+        if len(names) == 0:
+            return
+        portrows = self.select(Portal, "portal", "from_place", names)
+        batch = set(names)
+        for row in portrows:
+            batch.add(row["to_place"])
+        batch = set(self.missing(batch))
+        portrows.extend(
+            self.select(Portal, "portal", "from_place", batch - names))
+        for row in self.select(Place, "place", "name", batch):
+            dict.__setitem__(self, row["name"], Place(db, row))
+        portals = db.portaldict[self.dimension]
+        for row in portrows:
+            portal = dict.get(portals, row["name"])
+            if portal is None:
+                portal = Portal(db, row)
+                dict.__setitem__(portals, row["name"], portal)
+                db.dimensiondict[self.dimension].add_portal(portal)
+            self[row["from_place"]].add_portal(portal)
+        locrows = self.select(Thing, "location", "place", batch)
+        things = db.thingdict[self.dimension]
+        things.fault([row["thing"] for row in locrows])
+        for row in locrows:
+            link_location(things[row["thing"]], self[row["place"]])
+
+
+class LazyThings(LazyTable):
+    """Things, loaded with their locations and contents."""
+    def fault(self, names):
+        db = self.db
+        names = self.missing(names)
+        if len(names) == 0:
+            return
+        for row in self.select(Thing, "thing", "name", names):
+            dict.__setitem__(self, row["name"], Thing(db, row))
+        # Looking up the place may fault it, and faulting a place links
+        # its contents, so link_location has to tolerate being told
+        # twice.
+        places = db.placedict[self.dimension]
+        for row in self.select(Thing, "location", "thing", names):
+            link_location(self[row["thing"]], places[row["place"]])
+        for row in self.select(Thing, "containment", "container", names):
+            self[row["container"]].add_content(self[row["contained"]])
+
+
+class LazyPortals(LazyTable):
+    """Portals whose origins haven't been loaded yet.
+
+A portal from a place that's been loaded was loaded along with it, so
+this only queries for portals out of places that haven't been.
+
+"""
+    def __init__(self, db, dimension):
+        LazyTable.__init__(self, db, dimension)
+        self.complete = False
+
+    def fault(self, names):
+        self.load_rows(
+            self.select(Portal, "portal", "name", self.missing(names)))
+
+    def fault_all(self):
+        """Load every portal in the dimension that isn't loaded."""
+        if self.complete:
+            return
+        cols = Portal.colnames["portal"]
+        qrystr = "SELECT %s FROM portal WHERE dimension=?" % (
+            ", ".join(cols),)
+        cursor = self.db.conn.execute(qrystr, (self.dimension,))
+        rows = [dict(zip(cols, row)) for row in cursor]
+        self.load_rows([row for row in rows
+                        if not dict.__contains__(self, row["name"])])
+        self.complete = True
+
+    def load_rows(self, rows):
+        db = self.db
+        for row in rows:
+            portal = Portal(db, row)
+            dict.__setitem__(self, row["name"], portal)
+            db.dimensiondict[self.dimension].add_portal(portal)
+
+
+class LazySpots(LazyTable):
+    """Spots, keyed by the name of the place they represent."""
+    def fault(self, names):
+        db = self.db
+        for row in self.select(Spot, "spot", "place", self.missing(names)):
+            dict.__setitem__(self, row["place"], Spot(db, row))
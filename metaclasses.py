@@ -1,3 +1,51 @@
+import json
+import time
+
+
+# SQLite refuses statements with more host parameters than
+# SQLITE_MAX_VARIABLE_NUMBER. That's 999 in builds older than 3.32.0
+# and 32766 after, but I can't tell which one I'll get, so assume the
+# worst.
+max_host_params = 999
+# executemany takes any number of rows, but I'd rather not build a
+# list of a hundred thousand tuples all at once.
+insert_chunk_rows = 4096
+
+
+def chunks(lst, size):
+    """Yield successive slices of lst, each at most size long."""
+    i = 0
+    while i < len(lst):
+        yield lst[i:i+size]
+        i += size
+
+
+def index_stmts(tablename, coldecl, pkey, fkeys, indexes):
+    """Return CREATE INDEX statements for the table.
+
+Every foreign key gets an index, since those are the columns things
+get looked up by. So does every tuple of columns in indexes. Indexes
+that the primary key already covers--those whose columns are the first
+ones in the primary key--are left out, as are duplicates and foreign
+keys on columns the table doesn't have.
+
+"""
+    wanted = []
+    for fkey in fkeys.iterkeys():
+        wanted.append(tuple([col.strip() for col in fkey.split(",")]))
+    wanted.extend([tuple(idx) for idx in indexes])
+    r = []
+    seen = set()
+    for cols in wanted:
+        if (cols in seen or tuple(pkey[:len(cols)]) == cols or
+                not all([col in coldecl for col in cols])):
+            continue
+        seen.add(cols)
+        r.append("CREATE INDEX %s_%s_idx ON %s (%s);" % (
+            tablename, "_".join(cols), tablename, ", ".join(cols)))
+    return r
+
+
 def deep_lookup(dic, keylst):
     key = keylst.pop()
     ptr = dic
@@ -24,20 +72,30 @@ class SaveableMetaclass(type):
             checks = attrs['checks']
         else:
             checks = {}
+        if 'indexes' in attrs:
+            indexes = attrs['indexes']
+        else:
+            indexes = {}
+        if 'ownedrows' in attrs:
+            ownedrows = attrs['ownedrows']
+        else:
+            ownedrows = {}
         for d in foreignkeys, checks:
             for tablename in tablenames:
                 if tablename not in d:
                     d[tablename] = {}
+        for tablename in tablenames:
+            if tablename not in indexes:
+                indexes[tablename] = []
         schemata = []
+        indexdecls = []
         inserts = {}
         deletes = {}
-        detects = {}
-        missings = {}
+        probes = {}
         keylen = {}
         rowlen = {}
         keyqms = {}
         rowqms = {}
-        keystrs = {}
         rowstrs = {}
         keynames = {}
         valnames = {}
@@ -47,7 +105,6 @@ class SaveableMetaclass(type):
             keynames[tablename] = sorted(pkey)
             keylen[tablename] = len(pkey)
             keyqms[tablename] = ", ".join(["?"] * keylen[tablename])
-            keystrs[tablename] = "(" + keyqms[tablename] + ")"
         for item in coldecls.iteritems():
             (tablename, coldict) = item
             valnames[tablename] = sorted(
@@ -75,9 +132,6 @@ class SaveableMetaclass(type):
             pkeys = [keyname for (keyname, typ) in coldecl.iteritems()
                      if keyname in pkey]
             pkeynamestr = ", ".join(sorted(pkeys))
-            vals = [valname for (valname, typ) in coldecl.iteritems()
-                    if valname not in pkey]
-            colnamestr = ", ".join(sorted(pkeys) + sorted(vals))
             pkeystr = "PRIMARY KEY (%s)" % (pkeycolstr,)
             fkeystrs = ["FOREIGN KEY (%s) REFERENCES %s(%s)" %
                         (item[0], item[1][0], item[1][1])
@@ -91,19 +145,29 @@ class SaveableMetaclass(type):
                 table_decl_data.append(chkstr)
             table_decl = ", ".join(table_decl_data)
             create_stmt = "CREATE TABLE %s (%s);" % (tablename, table_decl)
-            insert_stmt_start = "INSERT INTO %s VALUES " % (
-                tablename,)
-            inserts[tablename] = insert_stmt_start
-            delete_stmt_start = "DELETE FROM %s WHERE (%s) IN " % (
-                tablename, pkeycolstr)
-            deletes[tablename] = delete_stmt_start
-            detect_stmt_start = "SELECT %s FROM %s WHERE (%s) IN " % (
-                colnamestr, tablename, pkeynamestr)
-            detects[tablename] = detect_stmt_start
-            missing_stmt_start = "SELECT %s FROM %s WHERE (%s) NOT IN " % (
-                colnamestr, tablename, pkeynamestr)
-            missings[tablename] = missing_stmt_start
+            insert_stmt = "INSERT INTO %s (%s) VALUES %s" % (
+                tablename, ", ".join(colnames[tablename]),
+                rowstrs[tablename])
+            inserts[tablename] = insert_stmt
+            # delete, detect and missing get the keys they're given as
+            # one JSON array of arrays, which json_each turns into rows,
+            # so that any number of keys takes one statement and one
+            # parameter.
+            probe_keys = "SELECT %s FROM json_each(?)" % (", ".join(
+                ["json_extract(value, '$[%d]')" % (i,)
+                 for i in xrange(0, len(keynames[tablename]))]),)
+            probe_start = "SELECT %s FROM %s WHERE (%s) " % (
+                ", ".join(colnames[tablename]), tablename, pkeynamestr)
+            probes[tablename] = {
+                'detect': probe_start + "IN (%s)" % (probe_keys,),
+                'missing': probe_start + "NOT IN (%s)" % (probe_keys,)}
+            deletes[tablename] = "DELETE FROM %s WHERE (%s) IN (%s)" % (
+                tablename, pkeynamestr, probe_keys)
             schemata.append(create_stmt)
+            indexdecls.extend(index_stmts(
+                tablename, coldecl, pkey, fkeys, indexes[tablename]))
+        # Indexes go after all the tables.
+        schemata.extend(indexdecls)
 
         def dictify_rows(cols, rows):
             r = []
@@ -120,58 +184,130 @@ class SaveableMetaclass(type):
             return r
 
         def insert_rowdicts_table(db, rowdicts, tabname):
-            rowstr = rowstrs[tabname]
-            qrystr = inserts[tabname] + ", ".join([rowstr] * len(rowdicts))
-            qrylst = []
-            for rowdict in rowdicts:
-                qrylst.extend([rowdict[col] for col in colnames[tabname]])
-            qrytup = tuple(qrylst)
-            db.c.execute(qrystr, qrytup)
+            """Insert the rowdicts into the table in chunks, using the
+same prepared statement for every row.
+
+Doesn't commit. Call it inside a transaction so that all the chunks
+go to disk together.
+
+Returns a pair of the number of rows inserted and the seconds it
+took.
+
+"""
+            qrystr = inserts[tabname]
+            cols = colnames[tabname]
+            start = time.time()
+            for chunk in chunks(rowdicts, insert_chunk_rows):
+                db.c.executemany(
+                    qrystr,
+                    [tuple([rowdict[col] for col in cols])
+                     for rowdict in chunk])
+            return (len(rowdicts), time.time() - start)
 
         def delete_keydicts_table(db, keydicts, tabname):
-            keystr = keystrs[tabname]
-            qrystr = deletes[tabname] + ", ".join([keystr] * len(keydicts))
-            qrylst = []
-            for keydict in keydicts:
-                qrylst.extend([keydict[col] for col in keynames[tabname]])
-            qrytup = tuple(qrylst)
-            db.c.execute(qrystr, qrytup)
+            cols = keynames[tabname]
+            keys = json.dumps([[keydict[col] for col in cols]
+                               for keydict in keydicts])
+            db.c.execute(deletes[tabname], (keys,))
 
-        def detect_keydicts_table(db, keydicts, tabname):
-            keystr = keystrs[tabname]
-            qrystr = detects[tabname] + ", ".join([keystr] * len(keydicts))
-            qrylst = []
-            for keydict in keydicts:
-                qrylst.extend([keydict[col] for col in keynames[tabname]])
-            qrytup = tuple(qrylst)
-            db.c.execute(qrystr, qrytup)
+        def probe_keydicts_table(db, keydicts, tabname, kind):
+            """Run the probe of the kind, and return the rows.
+
+It's one SELECT, so it neither opens a transaction nor ends one the
+caller has open. Python 2's sqlite3 commits before anything that isn't
+a SELECT or DML, SAVEPOINT and CREATE TEMP TABLE included, so the
+probe doesn't write anywhere, not even to a temporary table.
+
+"""
+            cols = keynames[tabname]
+            keys = json.dumps([[keydict[col] for col in cols]
+                               for keydict in keydicts])
+            db.c.execute(probes[tabname][kind], (keys,))
             return db.c.fetchall()
 
+        def detect_keydicts_table(db, keydicts, tabname):
+            """Return the rows of the table whose keys are among the
+keydicts."""
+            return probe_keydicts_table(db, keydicts, tabname, 'detect')
+
         def missing_keydicts_table(db, keydicts, tabname):
-            keystr = keystrs[tabname]
-            qrystr = missings[tabname] + ", ".join([keystr] * len(keydicts))
-            qrylst = []
-            for keydict in keydicts:
-                qrylst.extend([keydict[col] for col in keynames[tabname]])
-            qrytup = tuple(qrylst)
-            db.c.execute(qrystr, qrytup)
-            return db.c.fetchall()
+            """Return the rows of the table whose keys are not among the
+keydicts."""
+            return probe_keydicts_table(db, keydicts, tabname, 'missing')
+
+        updates = {}
+        upserts = {}
+
+        def update_stmt(tabname, cols):
+            """Return a statement that updates the given columns of one row
+of the table, and the names of its parameters, in order."""
+            setcols = sorted(cols)
+            key = (tabname, tuple(setcols))
+            if key not in updates:
+                qrystr = "UPDATE %s SET %s WHERE %s" % (
+                    tabname,
+                    ", ".join([col + "=?" for col in setcols]),
+                    " AND ".join([col + "=?" for col in keynames[tabname]]))
+                updates[key] = (qrystr, setcols + keynames[tabname])
+            return updates[key]
+
+        def upsert_stmt(tabname):
+            """Return a statement that inserts one row into the table, or
+updates it if it's there already, and the names of its parameters, in
+order."""
+            if tabname not in upserts:
+                if len(valnames[tabname]) == 0:
+                    onconflict = "DO NOTHING"
+                else:
+                    onconflict = "DO UPDATE SET " + ", ".join(
+                        ["%s=excluded.%s" % (col, col)
+                         for col in valnames[tabname]])
+                qrystr = "%s ON CONFLICT (%s) %s" % (
+                    inserts[tabname], ", ".join(keynames[tabname]),
+                    onconflict)
+                upserts[tabname] = (qrystr, colnames[tabname])
+            return upserts[tabname]
+
+        def delete_stmt(tabname):
+            """Return a statement that deletes one row from the table, and
+the names of its parameters, in order."""
+            qrystr = "DELETE FROM %s WHERE %s" % (
+                tabname,
+                " AND ".join([col + "=?" for col in keynames[tabname]]))
+            return (qrystr, keynames[tabname])
+
+        def disown_stmt(tabname):
+            """Return a statement that deletes every row one object owns in
+the table, and the names of its parameters, in order."""
+            (parent, cols) = ownedrows[tabname]
+            qrystr = "DELETE FROM %s WHERE %s" % (
+                tabname, " AND ".join([col + "=?" for col in cols]))
+            return (qrystr, list(cols))
 
         dbop = {'insert': insert_rowdicts_table,
                 'delete': delete_keydicts_table,
                 'detect': detect_keydicts_table,
                 'missing': missing_keydicts_table}
+        syncstmt = {'update': update_stmt,
+                    'upsert': upsert_stmt,
+                    'delete': delete_stmt,
+                    'disown': disown_stmt}
         atrdic = {'coldecls': coldecls,
                   'colnames': colnames,
+                  'keynames': keynames,
+                  'valnames': valnames,
                   'primarykeys': primarykeys,
                   'foreignkeys': foreignkeys,
                   'checks': checks,
+                  'indexes': indexes,
+                  'ownedrows': ownedrows,
                   'schemata': schemata,
                   'keylen': keylen,
                   'rowlen': rowlen,
                   'keyqms': keyqms,
                   'rowqms': rowqms,
-                  'dbop': dbop}
+                  'dbop': dbop,
+                  'syncstmt': syncstmt}
         atrdic.update(attrs)
 
         return type.__new__(metaclass, clas, parents, atrdic)
@@ -0,0 +1,364 @@
+"""Finding the way from one place to another through portals.
+
+The searches work on a Dimension's vertex indices, and give back lists
+of portals, which journey_steps turns into rows for the journeystep
+table and plan_journey turns into a Journey.
+
+For dimensions where routes are wanted all the time, RouteTable keeps
+the first portal on the cheapest way from each place to every other,
+in the route table, so that a route is a walk of one lookup per step.
+
+"""
+import heapq
+from graph import Journey
+from saveload import SaveableMetaclass
+
+
+def placename_of(place):
+    if isinstance(place, basestring):
+        return place
+    else:
+        return place.name
+
+
+def shortest_path(dimension, orig, dest, traveler=None, heuristic=None):
+    """Return the list of portals on the cheapest way from orig to dest,
+or None if there's no way.
+
+orig and dest are places or their names. The cost of a portal is its
+get_weight(). If there's a traveler, only portals that admit it are
+used.
+
+With a heuristic, this is A*. The heuristic takes the names of two
+places and returns a lower bound on the cost of getting from the one
+to the other. Without, it's Dijkstra's algorithm.
+
+"""
+    origname = placename_of(orig)
+    destname = placename_of(dest)
+    if (origname not in dimension.placeidx or
+            destname not in dimension.placeidx):
+        return None
+    origi = dimension.placeidx[origname]
+    desti = dimension.placeidx[destname]
+    placenames = dimension.placenames
+    out = dimension.out
+    if heuristic is None:
+        def estimate(i):
+            return 0
+    else:
+        def estimate(i):
+            return heuristic(placenames[i], destname)
+    cost = {origi: 0}
+    # The portal each place was reached by, on the cheapest way so far.
+    via = {origi: None}
+    done = set()
+    heap = [(estimate(origi), origi)]
+    while len(heap) > 0:
+        (est, i) = heapq.heappop(heap)
+        if i in done:
+            continue
+        if i == desti:
+            break
+        done.add(i)
+        for (j, portal) in out[i]:
+            if j in done:
+                continue
+            if traveler is not None and not portal.admits(traveler):
+                continue
+            c = cost[i] + portal.get_weight()
+            if j not in cost or c < cost[j]:
+                cost[j] = c
+                via[j] = (i, portal)
+                heapq.heappush(heap, (c + estimate(j), j))
+    if desti not in via:
+        return None
+    path = []
+    i = desti
+    while via[i] is not None:
+        (i, portal) = via[i]
+        path.append(portal)
+    path.reverse()
+    return path
+
+
+def first_steps(dimension, orig):
+    """Return a dict mapping the name of each place reachable from orig
+to a pair: the first portal on the cheapest way there, and the cost of
+the way. Every portal is used, whatever its admits() says."""
+    origi = dimension.placeidx[placename_of(orig)]
+    placenames = dimension.placenames
+    out = dimension.out
+    cost = {origi: 0}
+    first = {origi: None}
+    done = set()
+    heap = [(0, origi)]
+    while len(heap) > 0:
+        (c, i) = heapq.heappop(heap)
+        if i in done:
+            continue
+        done.add(i)
+        for (j, portal) in out[i]:
+            if j in done:
+                continue
+            cj = c + portal.get_weight()
+            if j not in cost or cj < cost[j]:
+                cost[j] = cj
+                if i == origi:
+                    first[j] = portal
+                else:
+                    first[j] = first[i]
+                heapq.heappush(heap, (cj, j))
+    return dict([(placenames[j], (first[j], cost[j]))
+                 for j in done if j != origi])
+
+
+def journey_steps(dimension, thing, path):
+    """Return rowdicts for the journeystep table, for a thing to follow
+the path."""
+    thingname = placename_of(thing)
+    return [{"dimension": dimension,
+             "thing": thingname,
+             "idx": i,
+             "portal": path[i].name}
+            for i in xrange(0, len(path))]
+
+
+def plan_journey(db, thing, dest, heuristic=None):
+    """Make a Journey for the thing, from where it is to dest, and put it
+in db.journeydict in place of any journey the thing had. Return the
+Journey, or None if the thing is nowhere or there's no way.
+
+The new journey is remembered and the old one forgotten, so the next
+sync saves the change. Saving the whole journey deletes whatever
+steps it had before, whether or not they were loaded.
+
+"""
+    if thing.location is None:
+        return None
+    dimension = db.get_dimension(thing.dimension)
+    path = shortest_path(dimension, thing.location, dest, thing, heuristic)
+    if path is None:
+        return None
+    journey = Journey(db, {"dimension": thing.dimension,
+                           "thing": thing.name,
+                           "curstep": 0,
+                           "progress": 0.0})
+    i = 0
+    while i < len(path):
+        journey.set_step(path[i], i)
+        i += 1
+    journeys = db.journeydict[thing.dimension]
+    if thing.name in journeys:
+        db.forget(journeys[thing.name])
+    journeys[thing.name] = journey
+    db.remember(journey)
+    return journey
+
+
+def spot_distance(db, dimension, per_pixel):
+    """Return a heuristic for shortest_path: the straight-line distance
+between the spots of two places, times per_pixel.
+
+It's only admissible if no portal costs less than per_pixel for each
+pixel between its ends' spots. Places without spots count as no
+distance from anywhere.
+
+"""
+    spots = db.spotdict[dimension]
+
+    def heuristic(origname, destname):
+        if origname not in spots or destname not in spots:
+            return 0
+        orig = spots[origname]
+        dest = spots[destname]
+        return per_pixel * ((orig.x - dest.x) ** 2 +
+                            (orig.y - dest.y) ** 2) ** 0.5
+    return heuristic
+
+
+class Routes:
+    """The rows of the route table for one place: the first portal and
+the cost of the cheapest way to every place it can get to.
+
+The rows never change. When they go stale, RouteTable forgets the
+whole Routes and makes another.
+
+"""
+    coldecls = {"route":
+                {"dimension": "text",
+                 "orig": "text",
+                 "dest": "text",
+                 "portal": "text",
+                 "cost": "float"}}
+    primarykeys = {"route": ("dimension", "orig", "dest")}
+    foreignkeys = {"route":
+                   {"dimension, orig": ("place", "dimension, name"),
+                    "dimension, dest": ("place", "dimension, name"),
+                    "dimension, portal": ("portal", "dimension, name")}}
+    __metaclass__ = SaveableMetaclass
+
+    def __init__(self, dimension, orig, hops):
+        self.dimension = dimension
+        self.orig = orig
+        # Maps each destination to a pair of the name of the first
+        # portal and the cost.
+        self.hops = hops
+
+    @property
+    def tabdict(self):
+        return {"route": [{"dimension": self.dimension,
+                           "orig": self.orig,
+                           "dest": dest,
+                           "portal": portalname,
+                           "cost": cost}
+                          for (dest, (portalname, cost))
+                          in self.hops.iteritems()]}
+
+
+class RouteTable:
+    """Next-hop routing for a whole dimension.
+
+Each place's Routes are found the first time a route from it is asked
+for, or all at once by precompute, and remembered so the next sync
+saves them. load reads back what was saved.
+
+When the dimension gains or loses a portal, only the places whose
+routes it could change are forgotten:
+
+    - a new portal from u to v can only help places whose way to v
+      gets cheaper by going through u;
+    - a portal from u to v that's removed can only hurt places whose
+      cheapest way to v goes through it.
+
+Routes don't know about admits(). route checks each portal on the way
+against the traveler, and searches afresh if one won't let it through.
+
+"""
+    def __init__(self, db, dimension):
+        self.db = db
+        self.dimension = dimension
+        self.origins = {}
+
+    def load(self):
+        """Read the dimension's saved routes from the database.
+
+A place whose routes start with a portal the dimension hasn't got, or
+one that doesn't lead out of it, has its routes forgotten, to be found
+again when they're wanted.
+
+"""
+        cols = Routes.colnames["route"]
+        qrystr = "SELECT %s FROM route WHERE dimension=?" % (
+            ", ".join(cols),)
+        hopdicts = {}
+        for row in self.db.conn.execute(qrystr, (self.dimension.name,)):
+            rowdict = dict(zip(cols, row))
+            orig = rowdict["orig"]
+            if orig not in hopdicts:
+                hopdicts[orig] = {}
+            hopdicts[orig][rowdict["dest"]] = (
+                rowdict["portal"], rowdict["cost"])
+        portals = self.dimension.portals
+        for (orig, hops) in hopdicts.iteritems():
+            routes = Routes(self.dimension.name, orig, hops)
+            if all([portalname in portals and
+                    portals[portalname].origname == orig
+                    for (portalname, cost) in hops.itervalues()]):
+                self.origins[orig] = routes
+            else:
+                self.db.forget(routes)
+
+    def routes_from(self, origname):
+        if origname not in self.origins:
+            hops = {}
+            for (dest, (portal, cost)) in first_steps(
+                    self.dimension, origname).iteritems():
+                hops[dest] = (portal.name, cost)
+            routes = Routes(self.dimension.name, origname, hops)
+            self.origins[origname] = routes
+            self.db.remember(routes)
+        return self.origins[origname]
+
+    def precompute(self):
+        """Find the routes from every place there are none for yet."""
+        for placename in self.dimension.placenames:
+            self.routes_from(placename)
+
+    def next_hop(self, orig, dest):
+        """Return the first portal on the way from orig to dest, or None if
+there's no way."""
+        hops = self.routes_from(placename_of(orig)).hops
+        destname = placename_of(dest)
+        if destname not in hops:
+            return None
+        return self.dimension.portals[hops[destname][0]]
+
+    def cost(self, orig, dest):
+        hops = self.routes_from(placename_of(orig)).hops
+        destname = placename_of(dest)
+        if destname not in hops:
+            return None
+        return hops[destname][1]
+
+    def route(self, orig, dest, traveler=None):
+        """Return the list of portals on the cheapest way from orig to dest,
+like shortest_path, by following next hops."""
+        origname = placename_of(orig)
+        destname = placename_of(dest)
+        if origname not in self.dimension.placeidx:
+            return None
+        path = []
+        here = origname
+        while here != destname:
+            portal = self.next_hop(here, destname)
+            if portal is None:
+                return None
+            if traveler is not None and not portal.admits(traveler):
+                return shortest_path(
+                    self.dimension, origname, destname, traveler)
+            path.append(portal)
+            here = portal.destname
+        return path
+
+    def invalidate(self, origname):
+        self.db.forget(self.origins[origname])
+        del self.origins[origname]
+
+    def portal_added(self, portal):
+        u = portal.origname
+        v = portal.destname
+        w = portal.get_weight()
+        stale = []
+        for (origname, routes) in self.origins.iteritems():
+            if origname == u:
+                to_u = 0
+            elif u in routes.hops:
+                to_u = routes.hops[u][1]
+            else:
+                continue
+            if origname == v:
+                continue
+            if v not in routes.hops or to_u + w < routes.hops[v][1]:
+                stale.append(origname)
+        for origname in stale:
+            self.invalidate(origname)
+
+    def portal_removed(self, portal):
+        u = portal.origname
+        v = portal.destname
+        w = portal.get_weight()
+        stale = []
+        for (origname, routes) in self.origins.iteritems():
+            if origname == u:
+                to_u = 0
+            elif u in routes.hops:
+                to_u = routes.hops[u][1]
+            else:
+                continue
+            # If the portal is on any cheapest way from here, it's on
+            # a cheapest way to v. Ties are forgotten too, to be safe.
+            if v in routes.hops and to_u + w == routes.hops[v][1]:
+                stale.append(origname)
+        for origname in stale:
+            self.invalidate(origname)
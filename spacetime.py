@@ -5,6 +5,41 @@ from saveload import SaveableMetaclass
 __metaclass__ = SaveableMetaclass
 
 
+# Most places have nothing in them, and most things have no
+# permissions and the like. They all share this tuple until they get
+# something, and go back to it when they've nothing left.
+empty = ()
+
+
+def plus(seq, item):
+    """Append the item to seq, unless seq is empty, in which case make a
+new list. Return the list."""
+    if seq is empty:
+        return [item]
+    seq.append(item)
+    return seq
+
+
+def minus(seq, item):
+    """Remove the item from seq. Return seq, or empty if nothing's left."""
+    if seq is empty:
+        raise ValueError("{0} isn't there".format(item))
+    seq.remove(item)
+    if len(seq) == 0:
+        return empty
+    return seq
+
+
+# SQLite gives back a new unicode object for every name and dimension
+# in every row. intern() won't take unicode, so they're made to share
+# through this instead.
+strings = {}
+
+
+def share(s):
+    return strings.setdefault(s, s)
+
+
 class Journey:
     """Series of steps taken by a Thing to get to a Place.
 
@@ -49,6 +84,12 @@ class Journey:
                 {"dimension, thing": ("thing", "dimension, name"),
                  "dimension, portal": ("portal", "dimension, name")}}
     checks = {"journey": ["progress>=0.0", "progress<1.0"]}
+    # The steps are the journey's, by its key in journey.
+    ownedrows = {"journeystep": ("journey", ("dimension", "thing"))}
+    # While a JourneyEngine is moving the journey, curstep and progress
+    # live in its arrays, at index slot.
+    engine = None
+    slot = None
 
     def __init__(self, db, rowdict):
         self.dimension = rowdict["dimension"]
@@ -57,6 +98,49 @@ class Journey:
         self.progress = rowdict["progress"]
         self.steplist = []
 
+    @property
+    def curstep(self):
+        if self.engine is None:
+            return self._curstep
+        return int(self.engine.curstep[self.slot])
+
+    @curstep.setter
+    def curstep(self, v):
+        if self.engine is None:
+            self._curstep = v
+        else:
+            self.engine.curstep[self.slot] = v
+
+    @property
+    def progress(self):
+        if self.engine is None:
+            return self._progress
+        return float(self.engine.progress[self.slot])
+
+    @progress.setter
+    def progress(self, v):
+        if self.engine is None:
+            self._progress = v
+        else:
+            self.engine.progress[self.slot] = v
+
+    @property
+    def tabdict(self):
+        steps = []
+        i = 0
+        while i < len(self.steplist):
+            if self.steplist[i] is not None:
+                steps.append({"dimension": self.dimension,
+                              "thing": self.thing.name,
+                              "idx": i,
+                              "portal": self.steplist[i].name})
+            i += 1
+        return {"journey": {"dimension": self.dimension,
+                            "thing": self.thing.name,
+                            "curstep": self.curstep,
+                            "progress": self.progress},
+                "journeystep": steps}
+
     def steps(self):
         """Get the number of steps in the Journey.
 
@@ -149,21 +233,52 @@ class Portal:
                  "from_place": "text",
                  "to_place": "text"}}
     primarykeys = {"portal": ("dimension", "name")}
+    # There's no weight column yet, so every portal is as far across
+    # as every other.
+    weight = 1.0
     foreignkeys = {"portal":
                    {"dimension, name": ("item", "dimension, name"),
                     "dimension, from_place": ("place", "dimension, name"),
                     "dimension, to_place": ("place", "dimension, name")}}
 
+    __slots__ = ("db", "dimension", "name", "hsh", "origname", "destname",
+                 "_orig", "_dest")
+
     def __init__(self, db, rowdict):
-        self.dimension = rowdict["dimension"]
+        self.db = db
+        self.dimension = share(rowdict["dimension"])
         self.name = rowdict["name"]
         self.hsh = hash(self.dimension + self.name)
-        self.dest = db.placedict[self.dimension][rowdict["to_place"]]
-        self.orig = db.placedict[self.dimension][rowdict["from_place"]]
+        self.origname = share(rowdict["from_place"])
+        self.destname = share(rowdict["to_place"])
+        self._orig = None
+        self._dest = None
 
     def __hash__(self):
         return self.hsh
 
+    @property
+    def tabdict(self):
+        return {"portal": {"dimension": self.dimension,
+                           "name": self.name,
+                           "from_place": self.origname,
+                           "to_place": self.destname}}
+
+    # The places at either end are looked up the first time they're
+    # wanted, so that loading a portal doesn't load the places, which
+    # would load their portals, which would load the whole map.
+    @property
+    def orig(self):
+        if self._orig is None:
+            self._orig = self.db.placedict[self.dimension][self.origname]
+        return self._orig
+
+    @property
+    def dest(self):
+        if self._dest is None:
+            self._dest = self.db.placedict[self.dimension][self.destname]
+        return self._dest
+
     def get_weight(self):
         return self.weight
 
@@ -192,7 +307,7 @@ class Portal:
         return self.orig is place or self.dest is place
 
     def find_neighboring_portals(self):
-        return self.orig.portals + self.dest.portals
+        return list(self.orig.portals) + list(self.dest.portals)
 
 
 class Place:
@@ -200,14 +315,35 @@ class Place:
                 {"dimension": "text",
                  "name": "text"}}
     primarykeys = {"place": ("dimension", "name")}
+    __slots__ = ("db", "dimension", "name", "contents", "portals")
 
     def __init__(self, db, rowdict):
         self.db = db
-        self.rowdict = rowdict
-        self.name = self.rowdict["name"]
-        self.dimension = self.rowdict["dimension"]
-        self.contents = []
-        self.portals = []
+        self.name = share(rowdict["name"])
+        self.dimension = share(rowdict["dimension"])
+        self.contents = empty
+        self.portals = empty
+
+    def add_content(self, thing):
+        self.contents = plus(self.contents, thing)
+
+    def remove_content(self, thing):
+        self.contents = minus(self.contents, thing)
+
+    def add_portal(self, portal):
+        self.portals = plus(self.portals, portal)
+
+    def remove_portal(self, portal):
+        self.portals = minus(self.portals, portal)
+
+    @property
+    def tabdict(self):
+        return {"place": {"dimension": self.dimension,
+                          "name": self.name}}
+
+    @property
+    def spot(self):
+        return self.db.spotdict[self.dimension][self.name]
 
     def __eq__(self, other):
         if not isinstance(other, Place):
@@ -218,47 +354,102 @@ class Place:
 
 
 class Dimension:
+    """The graph of places and portals in one dimension, for routing.
+
+Each place that's been added, by itself or as the end of a portal,
+has a vertex index, which never changes. Portals are kept in
+out[origi], a list of (desti, portal) pairs, so finding where you can
+go from a place is O(degree), and adding or removing a portal doesn't
+rebuild anything.
+
+Places are known by name, so that adding a portal doesn't load the
+places at its ends.
+
+If the dimension has a RouteTable in routes, it's told about every
+portal added or removed. So are the PortalEdges in edges, if a board
+is drawing them.
+
+The saved routes are the dimension's. Saving the whole dimension
+deletes them, which is how Database forgets them when a portal comes
+or goes while there's no RouteTable to do it.
+
+"""
     coldecls = {"dimension":
                 {"name": "text"}}
     primarykeys = {"dimension": ("name",)}
+    ownedrows = {"route": ("dimension", ("dimension",))}
 
     def __init__(self, db, rowdict):
+        self.db = db
         self.name = rowdict["name"]
-        self.places = []
-        self.portals = []
+        self.placenames = []
+        self.placeidx = {}
+        self.out = []
+        self.portals = {}
+        self.ends = {}
+        self.routes = None
+        self.edges = None
+
+    @property
+    def tabdict(self):
+        return {"dimension": {"name": self.name}}
+
+    def index_place(self, placename):
+        """Return the vertex index of the place, giving it one if it
+hasn't got one."""
+        if placename not in self.placeidx:
+            self.placeidx[placename] = len(self.placenames)
+            self.placenames.append(placename)
+            self.out.append([])
+        return self.placeidx[placename]
 
     def add_place(self, place):
-        self.places.append(place)
+        self.index_place(place.name)
 
     def add_portal(self, portal):
-        self.portals.append(portal)
+        if portal.name in self.portals:
+            return
+        origi = self.index_place(portal.origname)
+        desti = self.index_place(portal.destname)
+        self.portals[portal.name] = portal
+        self.ends[portal.name] = (origi, desti)
+        self.out[origi].append((desti, portal))
+        if self.routes is not None:
+            self.routes.portal_added(portal)
+        if self.edges is not None:
+            self.edges.add_portal(portal)
+
+    def remove_portal(self, portal):
+        if portal.name not in self.portals:
+            return
+        (origi, desti) = self.ends[portal.name]
+        self.out[origi] = [(i, port) for (i, port) in self.out[origi]
+                           if port.name != portal.name]
+        del self.portals[portal.name]
+        del self.ends[portal.name]
+        if self.routes is not None:
+            self.routes.portal_removed(portal)
+        if self.edges is not None:
+            self.edges.remove_portal(portal)
 
     def get_edge(self, portal):
-        origi = self.places.index(portal.orig)
-        desti = self.places.index(portal.dest)
-        return (origi, desti)
+        return self.ends[portal.name]
 
     def get_edges(self):
-        return [self.get_edge(port) for port in self.portals]
+        return self.ends.values()
 
     def get_edge_atts(self):
-        r = {}
-        for port in self.portals:
-            key = self.get_edge(port)
-            val = port.att.iteritems()
-            r[key] = val
-        return r
+        names = self.ends.keys()
+        return {"name": names,
+                "weight": [self.portals[name].get_weight()
+                           for name in names]}
 
     def get_vertex_atts(self):
-        r = {}
-        i = 0
-        while i < len(self.places):
-            r[i] = self.places[i].att.iteritems()
-            i += 1
-        return r
+        return {"name": self.placenames}
 
     def get_igraph_graph(self):
-        return igraph.Graph(edges=self.get_edges(), directed=True,
+        return igraph.Graph(n=len(self.placenames), edges=self.get_edges(),
+                            directed=True,
                             vertex_attrs=self.get_vertex_atts(),
                             edge_attrs=self.get_edge_atts())
 
@@ -302,17 +493,42 @@ class Thing:
                    {"thing": ("thing", "name"),
                     "kind": ("thing_kind", "name")}}
     checks = {"containment": ["contained<>container"]}
+    # Rows that are the thing's, by its key in thing. It has a location
+    # only while it's somewhere, and a containment row for each of its
+    # contents.
+    ownedrows = {"location": ("thing", ("dimension", "thing")),
+                 "containment": ("thing", ("dimension", "container"))}
+    # pawn and journey are only there once something sets them.
+    __slots__ = ("dimension", "name", "location", "contents", "permissions",
+                 "forbiddions", "permit_inspections", "forbid_inspections",
+                 "pawn", "journey")
 
     def __init__(self, db, rowdict):
-        self.dimension = rowdict["dimension"]
-        self.name = rowdict["name"]
+        self.dimension = share(rowdict["dimension"])
+        self.name = share(rowdict["name"])
         self.location = None
-        self.contents = []
-        self.permissions = []
-        self.forbiddions = []
-        self.permit_inspections = []
-        self.forbid_inspections = []
-
+        self.contents = empty
+        self.permissions = empty
+        self.forbiddions = empty
+        self.permit_inspections = empty
+        self.forbid_inspections = empty
+
+    def add_content(self, thing):
+        self.contents = plus(self.contents, thing)
+
+    @property
+    def tabdict(self):
+        r = {"thing": {"dimension": self.dimension,
+                       "name": self.name},
+             "containment": [{"dimension": self.dimension,
+                              "contained": inner.name,
+                              "container": self.name}
+                             for inner in self.contents]}
+        if self.location is not None:
+            r["location"] = {"dimension": self.dimension,
+                             "thing": self.name,
+                             "place": self.location.name}
+        return r
 
     def __str__(self):
         return "(%s, %s)" % (self.dimension, self.name)
@@ -342,12 +558,12 @@ class Thing:
             return False
 
     def permit_item(self, it):
-        self.forbiddions.remove(it)
-        self.permissions.append(it)
+        self.forbiddions = minus(self.forbiddions, it)
+        self.permissions = plus(self.permissions, it)
 
     def forbid_item(self, it):
-        self.permissions.remove(it)
-        self.forbiddions.append(it)
+        self.permissions = minus(self.permissions, it)
+        self.forbiddions = plus(self.forbiddions, it)
 
 
 class ThingKind:
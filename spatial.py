@@ -0,0 +1,88 @@
+"""Finding which widget is under the mouse without looking at them all."""
+
+
+class HitGrid:
+    """A uniform grid over the window, each cell holding the widgets whose
+boxes overlap it.
+
+Widgets are anything with getleft, getright, getbot, gettop and
+interactive. Each is added with a layer: where widgets overlap, the
+one in the highest layer--the one drawn on top--wins, and within a
+layer, the one added last.
+
+Call move when a widget's box changes. It only touches the grid if
+the widget ends up in different cells.
+
+"""
+    def __init__(self, cellsize=64):
+        self.cellsize = cellsize
+        self.cells = {}
+        # Maps id(widget) to (widget, (layer, serial), cell range).
+        self.entries = {}
+        self.serial = 0
+
+    def cellrange(self, widget):
+        size = self.cellsize
+        return (int(widget.getleft() // size),
+                int(widget.getbot() // size),
+                int(widget.getright() // size),
+                int(widget.gettop() // size))
+
+    def cells_in(self, cr):
+        (l, b, r, t) = cr
+        for cx in xrange(l, r + 1):
+            for cy in xrange(b, t + 1):
+                yield (cx, cy)
+
+    def add(self, widget, layer=0):
+        if id(widget) in self.entries:
+            self.remove(widget)
+        self.serial += 1
+        cr = self.cellrange(widget)
+        self.entries[id(widget)] = (widget, (layer, self.serial), cr)
+        for cell in self.cells_in(cr):
+            if cell not in self.cells:
+                self.cells[cell] = {}
+            self.cells[cell][id(widget)] = widget
+
+    def remove(self, widget):
+        (widget, rank, cr) = self.entries.pop(id(widget))
+        for cell in self.cells_in(cr):
+            del self.cells[cell][id(widget)]
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+
+    def move(self, widget):
+        (widget, rank, cr) = self.entries[id(widget)]
+        newcr = self.cellrange(widget)
+        if newcr == cr:
+            return
+        for cell in self.cells_in(cr):
+            del self.cells[cell][id(widget)]
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+        self.entries[id(widget)] = (widget, rank, newcr)
+        for cell in self.cells_in(newcr):
+            if cell not in self.cells:
+                self.cells[cell] = {}
+            self.cells[cell][id(widget)] = widget
+
+    def at(self, x, y, interactive=True):
+        """Return the topmost widget whose box has the point in it, or None.
+If interactive, only consider widgets that are."""
+        cell = (int(x // self.cellsize), int(y // self.cellsize))
+        if cell not in self.cells:
+            return None
+        best = None
+        bestrank = None
+        for (key, widget) in self.cells[cell].iteritems():
+            if interactive and not widget.interactive:
+                continue
+            if not (widget.getleft() <= x <= widget.getright() and
+                    widget.getbot() <= y <= widget.gettop()):
+                continue
+            rank = self.entries[key][1]
+            if bestrank is None or rank > bestrank:
+                best = widget
+                bestrank = rank
+        return best
@@ -1,9 +1,192 @@
+import numpy
+from lazy import link_location
+
+
+def relocate(thing, place):
+    """Take the thing out of wherever it is and put it in the place."""
+    if thing.location is place:
+        return
+    if thing.location is not None:
+        thing.location.remove_content(thing)
+    link_location(thing, place)
+
+
+class JourneyEngine:
+    """Moves every journey at once.
+
+Each journey that's moving has a slot in the arrays. curstep and
+progress hold its state--the Journey reads and writes them through its
+properties--and rate is how much progress it makes in a second: its
+speed divided by the weight of the portal it's in. A journey that's
+done, or stopped, has a rate of zero.
+
+advance moves all of them with a few array operations, and only deals
+with Journey objects whose step changed.
+
+serial counts how many journeys have had each slot, so that anything
+that remembers a slot can tell when it's been given to another.
+
+"""
+    # The least time it takes to cross a portal, for those of no weight.
+    fudge = 1e-9
+
+    def __init__(self, capacity=64):
+        self.journeys = []
+        self.free = []
+        self.curstep = numpy.zeros(capacity, dtype=numpy.int32)
+        self.progress = numpy.zeros(capacity, dtype=numpy.float64)
+        self.nsteps = numpy.zeros(capacity, dtype=numpy.int32)
+        self.speed = numpy.zeros(capacity, dtype=numpy.float64)
+        self.rate = numpy.zeros(capacity, dtype=numpy.float64)
+        self.serial = numpy.zeros(capacity, dtype=numpy.int32)
+
+    def __len__(self):
+        return len(self.journeys) - len(self.free)
+
+    def grow(self):
+        capacity = len(self.curstep) * 2
+        for name in ("curstep", "progress", "nsteps", "speed", "rate",
+                     "serial"):
+            old = getattr(self, name)
+            new = numpy.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, journey, speed=1.0):
+        """Start moving the journey at speed portals of weight 1.0 a
+second."""
+        if journey.engine is self:
+            self.set_speed(journey, speed)
+            return
+        (curstep, progress) = (journey.curstep, journey.progress)
+        if len(self.free) > 0:
+            slot = self.free.pop()
+            self.journeys[slot] = journey
+        else:
+            slot = len(self.journeys)
+            if slot == len(self.curstep):
+                self.grow()
+            self.journeys.append(journey)
+        journey.engine = self
+        journey.slot = slot
+        self.serial[slot] += 1
+        self.curstep[slot] = curstep
+        self.progress[slot] = progress
+        self.nsteps[slot] = len(journey.steplist)
+        self.set_speed(journey, speed)
+
+    def remove(self, journey):
+        """Stop moving the journey, and give it back its own curstep and
+progress."""
+        slot = journey.slot
+        (curstep, progress) = (journey.curstep, journey.progress)
+        journey.engine = None
+        journey.slot = None
+        journey.curstep = curstep
+        journey.progress = progress
+        self.journeys[slot] = None
+        self.rate[slot] = 0.0
+        self.speed[slot] = 0.0
+        self.free.append(slot)
+
+    def set_speed(self, journey, speed):
+        self.speed[journey.slot] = speed
+        self.update_rate(journey.slot)
+
+    def update_rate(self, slot):
+        """Work out the rate for the portal the journey in the slot is in.
+
+A journey whose step there is None--one that hasn't been loaded or set
+yet--waits where it is, at rate zero, until set_speed is called again.
+
+"""
+        journey = self.journeys[slot]
+        i = self.curstep[slot]
+        if i < 0 or i >= self.nsteps[slot]:
+            self.rate[slot] = 0.0
+            self.progress[slot] = 0.0
+            return
+        port = journey.steplist[i]
+        if port is None:
+            self.rate[slot] = 0.0
+            return
+        weight = port.get_weight()
+        if weight > 0:
+            self.rate[slot] = self.speed[slot] / weight
+        else:
+            # Portals of no weight are crossed at once.
+            self.rate[slot] = 1.0 / self.fudge
+
+    def advance(self, dt):
+        """Move every journey dt seconds further. Return a list of the
+journeys whose step changed.
+
+A journey that gets through its portal takes the time it had left into
+the next one, at the rate for that one's weight, and so on until the
+time runs out or the journey's done.
+
+"""
+        n = len(self.journeys)
+        if n == 0:
+            return []
+        progress = self.progress[:n]
+        progress += self.rate[:n] * dt
+        slots = numpy.flatnonzero(progress >= 1.0)
+        r = []
+        for slot in slots.tolist():
+            self.cross(slot)
+            r.append(self.journeys[slot])
+        return r
+
+    def cross(self, slot):
+        """Take the journey in the slot through as many portals as its
+progress pays for, one at a time."""
+        while self.progress[slot] >= 1.0:
+            # The time left over after getting through this portal.
+            spare = (self.progress[slot] - 1.0) / self.rate[slot]
+            self.curstep[slot] += 1
+            self.update_rate(slot)
+            self.progress[slot] = spare * self.rate[slot]
+
+
 class GameState:
     """
     Class to hold the state of the game, specifically not including the state of the interface.
     """
     def __init__(self, db):
         self.db = db
+        self.engine = JourneyEngine()
+
+    def start_journey(self, journey, speed=1.0):
+        thing = journey.thing
+        thing.journey = journey
+        self.engine.add(journey, speed)
+        pawn = getattr(thing, "pawn", None)
+        if pawn is not None and pawn.positions is not None:
+            pawn.positions.touch(pawn)
+
+    def start_journeys(self, dimension, speed=1.0):
+        """Start every journey loaded for the dimension."""
+        for journey in self.db.journeydict[dimension].itervalues():
+            self.start_journey(journey, speed)
+
+    def stop_journey(self, journey):
+        self.engine.remove(journey)
+
     def update(self, ts, st):
-        pass
-        
+        """Move every journey ts seconds along.
+
+Things that got through a portal are moved to the place at its end,
+and their journey and location are remembered. Journeys that are done
+stop.
+
+"""
+        for journey in self.engine.advance(ts):
+            curstep = journey.curstep
+            thing = journey.thing
+            if curstep > 0:
+                relocate(thing, journey.steplist[curstep - 1].dest)
+                self.db.remember(thing, "place")
+            self.db.remember(journey, "curstep", "progress")
+            if curstep >= len(journey.steplist):
+                self.engine.remove(journey)
@@ -0,0 +1,176 @@
+"""Opening the database file, and the threads that look after it while
+the game runs."""
+import sqlite3
+import threading
+from Queue import Queue
+from collections import deque
+from syncplan import run_sync_plan
+
+
+# Pragmas to set on every connection, by profile name. Values go into
+# the PRAGMA statements as they are.
+#
+# "game" is for play: the write-ahead log lets the game keep reading
+# while the disk catches up, and synchronous=NORMAL only fsyncs at
+# checkpoints, which the Checkpointer does off the main thread. A
+# crash can lose the last few saves but never corrupts the file.
+#
+# "durable" fsyncs every commit. "sqlite" leaves SQLite's defaults
+# alone.
+storage_profiles = {
+    "game": {"journal_mode": "WAL",
+             "synchronous": "NORMAL",
+             "wal_autocheckpoint": 0,
+             "mmap_size": 256 * 1024 * 1024,
+             "cache_size": -64 * 1024,
+             "temp_store": "MEMORY"},
+    "durable": {"journal_mode": "WAL",
+                "synchronous": "FULL",
+                "temp_store": "MEMORY"},
+    "sqlite": {}}
+# Pragmas that have to be set before anything else happens on the
+# connection.
+first_pragmas = ["journal_mode", "mmap_size"]
+
+
+def is_memory(dbfile):
+    return dbfile == ":memory:" or dbfile == ""
+
+
+def apply_pragmas(conn, pragmas):
+    names = ([name for name in first_pragmas if name in pragmas] +
+             sorted([name for name in pragmas if name not in first_pragmas]))
+    for name in names:
+        conn.execute("PRAGMA %s=%s" % (name, pragmas[name])).fetchall()
+
+
+def connect(dbfile, profile="game"):
+    """Open the file with the pragmas of the named storage profile."""
+    conn = sqlite3.connect(dbfile)
+    apply_pragmas(conn, storage_profiles[profile])
+    return conn
+
+
+def uses_wal(conn):
+    return conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+
+
+class Checkpointer(threading.Thread):
+    """Copies the write-ahead log back into the database file every so
+often, on its own thread and its own connection.
+
+The main connection has wal_autocheckpoint turned off, so this is the
+only thing that checkpoints. PASSIVE checkpoints never wait on readers
+or writers, so the main thread never waits on this.
+
+"""
+    def __init__(self, dbfile, interval=1.0, mode="PASSIVE"):
+        threading.Thread.__init__(self, name="Checkpointer")
+        self.daemon = True
+        self.dbfile = dbfile
+        self.interval = interval
+        self.mode = mode
+        self.stopping = threading.Event()
+        self.checkpoints = 0
+        # The (busy, log, checkpointed) triple that SQLite gave for the
+        # last checkpoint.
+        self.last = None
+
+    def run(self):
+        conn = sqlite3.connect(self.dbfile)
+        try:
+            while not self.stopping.wait(self.interval):
+                self.checkpoint(conn)
+            self.checkpoint(conn)
+        finally:
+            conn.close()
+
+    def checkpoint(self, conn):
+        self.last = conn.execute(
+            "PRAGMA wal_checkpoint(%s)" % (self.mode,)).fetchone()
+        self.checkpoints += 1
+
+    def stop(self):
+        """Do one last checkpoint, and wait for it."""
+        self.stopping.set()
+        self.join()
+
+
+class SaveWriter(threading.Thread):
+    """Runs sync plans on its own thread, with its own connection, so
+that saving never takes time out of a frame.
+
+Plans wait in a queue of at most maxsize. When it's full, submit
+blocks until the writer catches up; that way a game that saves faster
+than the disk can keep up slows down instead of eating memory.
+
+A plan can be submitted with a token, which goes into saved, in the
+order the plans were submitted, once the plan's on disk. When a plan
+fails, its token goes into failed instead, and so do the tokens of the
+plans after it, which aren't run, until check has raised the error.
+That way whoever submitted them can tell what didn't get saved, and
+submit it again.
+
+"""
+    def __init__(self, dbfile, profile="game", maxsize=8):
+        threading.Thread.__init__(self, name="SaveWriter")
+        self.daemon = True
+        self.dbfile = dbfile
+        self.profile = profile
+        self.queue = Queue(maxsize)
+        self.saved = deque()
+        self.failed = deque()
+        self.last_stats = None
+        self.error = None
+
+    def run(self):
+        conn = connect(self.dbfile, self.profile)
+        try:
+            while True:
+                item = self.queue.get()
+                try:
+                    if item is None:
+                        return
+                    (plan, token) = item
+                    if self.error is not None:
+                        self.failed.append(token)
+                        continue
+                    self.last_stats = run_sync_plan(conn, plan)
+                    if token is not None:
+                        self.saved.append(token)
+                except Exception as e:
+                    self.error = e
+                    self.failed.append(token)
+                finally:
+                    self.queue.task_done()
+        finally:
+            conn.close()
+
+    def check(self):
+        """Raise whatever went wrong in the last plan that failed."""
+        if self.error is not None:
+            e = self.error
+            self.error = None
+            raise e
+
+    def submit(self, plan, token=None):
+        """Queue the plan. Errors don't come out of here, but out of check
+and flush, so that there's only one place to take back what failed."""
+        if len(plan) > 0:
+            self.queue.put((plan, token))
+
+    def wait(self):
+        """Wait until every plan submitted so far has been run or
+skipped."""
+        self.queue.join()
+
+    def flush(self):
+        """Wait until every plan submitted so far is on disk. Return the
+SyncStats of the last one."""
+        self.wait()
+        self.check()
+        return self.last_stats
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
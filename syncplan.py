@@ -0,0 +1,163 @@
+"""Turning the objects that Database has been told to remember or
+forget into the statements that save them, and running those.
+
+The plan is built of tuples, not objects, so it can be run somewhere
+other than where it was built.
+
+"""
+import time
+
+
+class SyncStats:
+    """How many rows each table had written, and how long it took."""
+    def __init__(self):
+        self.tables = []
+        self.rows = {}
+        self.secs = {}
+
+    def add(self, tabname, rows, secs):
+        if tabname not in self.rows:
+            self.tables.append(tabname)
+            self.rows[tabname] = 0
+            self.secs[tabname] = 0.0
+        self.rows[tabname] += rows
+        self.secs[tabname] += secs
+
+    def ms(self, tabname):
+        return self.secs[tabname] * 1000
+
+    def total_rows(self):
+        return sum(self.rows.itervalues())
+
+    def total_ms(self):
+        return sum(self.secs.itervalues()) * 1000
+
+    def __str__(self):
+        lines = ["%s: %d rows in %.2f ms" % (
+            tabname, self.rows[tabname], self.ms(tabname))
+            for tabname in self.tables]
+        lines.append("total: %d rows in %.2f ms" % (
+            self.total_rows(), self.total_ms()))
+        return "\n".join(lines)
+
+
+def rows_of(tabdict, tabname):
+    """Return a list of the rowdicts an object has in the table. Most
+objects have one row per table, some have several."""
+    if tabname not in tabdict:
+        return []
+    rowdicts = tabdict[tabname]
+    if isinstance(rowdicts, list):
+        return rowdicts
+    else:
+        return [rowdicts]
+
+
+def owner_keys(obj, tabdict):
+    """Return a list of (tabname, keydict) for each table the object owns
+rows in, the keydict naming the object in that table's owner columns."""
+    r = []
+    for (tabname, (parent, cols)) in obj.ownedrows.iteritems():
+        row = tabdict[parent]
+        vals = [row[col] for col in obj.primarykeys[parent]]
+        r.append((tabname, dict(zip(cols, vals))))
+    return r
+
+
+def tuplify(rowdicts, cols):
+    return tuple([tuple([rowdict[col] for col in cols])
+                  for rowdict in rowdicts])
+
+
+def plan_sync(altered, removed):
+    """Return a list of triples--table name, statement, and a tuple of
+parameter tuples to executemany with it--that will save the altered
+objects and delete the removed ones.
+
+altered maps each object to the set of column names that changed, or
+to None if the whole object is to be written, whether or not it's in
+the database already. removed is a set of objects to delete.
+
+Deletions go first, so that an object forgotten and then replaced by
+another with the same key ends up saved.
+
+Some objects have any number of rows in a table, or none--a thing's
+contents, a journey's steps. Those tables are in the object's class's
+ownedrows. Removing an object, or writing the whole of it, deletes
+every row it owns in them by its key first, so that rows it doesn't
+have any more don't outlive it.
+
+"""
+    deletes = {}
+    disowns = {}
+    upserts = {}
+    updates = {}
+
+    def disown(obj, tabdict):
+        for (tabname, keydict) in owner_keys(obj, tabdict):
+            key = (obj.__class__, tabname)
+            if key not in disowns:
+                disowns[key] = []
+            disowns[key].append(keydict)
+    for obj in removed:
+        clas = obj.__class__
+        tabdict = obj.tabdict
+        disown(obj, tabdict)
+        for tabname in tabdict.iterkeys():
+            key = (clas, tabname)
+            if key not in deletes:
+                deletes[key] = []
+            deletes[key].extend(rows_of(tabdict, tabname))
+    for (obj, cols) in altered.iteritems():
+        clas = obj.__class__
+        tabdict = obj.tabdict
+        if cols is None:
+            disown(obj, tabdict)
+        for tabname in tabdict.iterkeys():
+            if cols is None:
+                key = (clas, tabname)
+                if key not in upserts:
+                    upserts[key] = []
+                upserts[key].extend(rows_of(tabdict, tabname))
+                continue
+            dirty = [col for col in clas.valnames[tabname] if col in cols]
+            if len(dirty) == 0:
+                continue
+            key = (clas, tabname, tuple(dirty))
+            if key not in updates:
+                updates[key] = []
+            updates[key].extend(rows_of(tabdict, tabname))
+    plan = []
+    # Objects with no rows in some table, like things that contain
+    # nothing, leave empty lists behind. They don't need statements.
+    for d in (deletes, disowns, upserts, updates):
+        for (key, rowdicts) in d.items():
+            if len(rowdicts) == 0:
+                del d[key]
+    for ((clas, tabname), rowdicts) in deletes.iteritems():
+        (qrystr, cols) = clas.syncstmt['delete'](tabname)
+        plan.append((tabname, qrystr, tuplify(rowdicts, cols)))
+    for ((clas, tabname), keydicts) in disowns.iteritems():
+        (qrystr, cols) = clas.syncstmt['disown'](tabname)
+        plan.append((tabname, qrystr, tuplify(keydicts, cols)))
+    for ((clas, tabname), rowdicts) in upserts.iteritems():
+        (qrystr, cols) = clas.syncstmt['upsert'](tabname)
+        plan.append((tabname, qrystr, tuplify(rowdicts, cols)))
+    for ((clas, tabname, dirty), rowdicts) in updates.iteritems():
+        (qrystr, cols) = clas.syncstmt['update'](tabname, dirty)
+        plan.append((tabname, qrystr, tuplify(rowdicts, cols)))
+    return plan
+
+
+def run_sync_plan(conn, plan):
+    """Run the plan on the connection in one transaction. Return a
+SyncStats."""
+    stats = SyncStats()
+    with conn:
+        c = conn.cursor()
+        for (tabname, qrystr, rows) in plan:
+            start = time.time()
+            c.executemany(qrystr, rows)
+            stats.add(tabname, len(rows), time.time() - start)
+        c.close()
+    return stats
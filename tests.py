@@ -1,10 +1,19 @@
-from database import Database
-from unittest import TestCase
-from parms import DefaultParameters
-from graph import Place, Portal
-from widgets import Color, Style
-from attrcheck import AttrCheck
+import os
+import shutil
+import sqlite3
+import tempfile
+from database import Database, DefaultParameters
+from unittest import TestCase, skip
+from graph import Journey, Place, Portal
+from widgets import Color, PawnPositions, Style
 from thing import Thing
+from tiles import TileAtlas, key_rgba, read_bmp, tile_entries
+from imgcache import decode_rltile
+from bench import SyntheticWorld
+from routing import plan_journey
+from state import JourneyEngine
+from columns import StringCodes
+from syncplan import plan_sync, run_sync_plan
 
 
 default = DefaultParameters()
@@ -24,6 +33,7 @@ class Attribution:
             self.hi == other.hi
 
 
+@skip("Database no longer has the know, write, save, del and load methods")
 class DatabaseTestCase(TestCase):
     def testSomething(self, db, suf, clas, keytup, valtup, testname):
         # clas is the class of object to test.  keytup is a tuple
@@ -69,7 +79,6 @@ class DatabaseTestCase(TestCase):
                   ('thing', default.things, Thing),
                   ('color', default.colors, Color),
                   ('style', default.styles, Style),
-                  ('attribute', default.attributes, AttrCheck),
                   ('attribution', default.attributions, Attribution)]
         for pair in tabkey:
             suf = pair[0]
@@ -79,6 +88,695 @@ class DatabaseTestCase(TestCase):
                     self.testSomething(db, suf, pair[2],
                                        val[0], val[1], test)
 
-db = Database(":memory:")
-db.mkschema()
-db.insert_defaults(default)
+
+class FileDatabaseTestCase(TestCase):
+    """A database in a file of its own, with the defaults in it."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.db")
+        self.db = Database(self.path)
+        self.db.mkschema()
+        self.db.insert_defaults()
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def write_elsewhere(self, name):
+        other = sqlite3.connect(self.path, timeout=0)
+        other.execute("INSERT INTO place (dimension, name) VALUES (?, ?)",
+                      ("Physical", name))
+        other.commit()
+        other.close()
+
+
+class ProbeTestCase(FileDatabaseTestCase):
+    def test_detect_and_missing(self):
+        here = Place(self.db, {"dimension": "Physical",
+                               "name": default.places[0]["name"]})
+        nowhere = Place(self.db, {"dimension": "Physical",
+                                  "name": "nowhere"})
+        self.assertEqual(len(self.db.detect_obj([here, nowhere])), 1)
+        missing = self.db.missing_obj([here])
+        self.assertEqual(len(missing), len(default.places) - 1)
+
+    def test_delete_many_keys(self):
+        self.db.conn.executemany(
+            "INSERT INTO place (dimension, name) VALUES ('Physical', ?)",
+            [("room%d" % (i,),) for i in xrange(0, 1500)])
+        keydicts = [{"dimension": "Physical", "name": "room%d" % (i,)}
+                    for i in xrange(0, 1500)]
+        self.db.delete_keydict_table(keydicts, Place, "place")
+        self.assertEqual(self.db.conn.execute(
+            "SELECT count(*) FROM place WHERE name LIKE 'room%'").fetchone(),
+            (0,))
+        self.assertEqual(self.db.conn.execute(
+            "SELECT count(*) FROM place").fetchone(), (len(default.places),))
+
+    def test_probe_leaves_no_transaction(self):
+        here = Place(self.db, {"dimension": "Physical",
+                               "name": default.places[0]["name"]})
+        self.db.detect_obj(here)
+        self.write_elsewhere("annex")
+        # A transaction left open would still be reading from before
+        # the other connection's write, and be refused the next one.
+        self.assertEqual(len(self.db.conn.execute(
+            "SELECT name FROM place WHERE name='annex'").fetchall()), 1)
+        self.db.conn.execute(
+            "INSERT INTO place (dimension, name) VALUES ('Physical', 'attic')")
+        self.db.conn.commit()
+        self.db.missing_obj(here)
+        self.write_elsewhere("cellar")
+
+    def test_probe_leaves_caller_transaction(self):
+        here = Place(self.db, {"dimension": "Physical",
+                               "name": default.places[0]["name"]})
+        self.db.conn.execute(
+            "INSERT INTO place (dimension, name) VALUES ('Physical', 'attic')")
+        self.db.detect_obj(here)
+        self.db.missing_obj(here)
+        other = sqlite3.connect(self.path)
+        self.assertEqual(other.execute(
+            "SELECT count(*) FROM place WHERE name='attic'").fetchone(), (0,))
+        self.db.conn.rollback()
+        other.close()
+        self.assertEqual(self.db.conn.execute(
+            "SELECT count(*) FROM place WHERE name='attic'").fetchone(), (0,))
+
+
+class ImageCacheTestCase(TestCase):
+    def mkdb(self, budget):
+        db = Database(":memory:", texture_budget=budget, decode_threads=0)
+        db.mkschema()
+        db.insert_defaults()
+        return db
+
+    def check_spots(self, db, dimension):
+        for spot in db.spotdict[dimension].itervalues():
+            self.assertIs(spot.img, db.imgdict[spot.img.name])
+        for pawn in db.pawndict[dimension].itervalues():
+            self.assertIs(pawn.img, db.imgdict[pawn.img.name])
+
+    def test_reload_reuses_textures(self):
+        db = self.mkdb(256 * 1024 * 1024)
+        db.load_board("Physical")
+        textures = dict(db.imgdict)
+        nbytes = db.imgdict.bytes
+        self.assertEqual(db.unload_board("Physical"), [])
+        self.assertEqual(len(db.spotdict["Physical"]), 0)
+        self.assertEqual(len(db.pawndict["Physical"]), 0)
+        db.load_board("Physical")
+        self.check_spots(db, "Physical")
+        self.assertEqual(db.imgdict.bytes, nbytes)
+        for (name, tex) in textures.iteritems():
+            self.assertIs(db.imgdict[name], tex)
+
+    def test_evict_and_reload(self):
+        db = self.mkdb(0)
+        db.load_board("Physical")
+        names = set(db.imgdict.keys())
+        nbytes = db.imgdict.bytes
+        self.assertEqual(set(db.unload_board("Physical")), names)
+        self.assertEqual(db.imgdict.bytes, 0)
+        self.assertEqual(len(db.imgdict), 0)
+        for thing in db.thingdict["Physical"].itervalues():
+            self.assertFalse(hasattr(thing, "pawn"))
+        db.load_board("Physical")
+        self.check_spots(db, "Physical")
+        self.assertEqual(db.imgdict.bytes, nbytes)
+
+    def test_atlas_page_counted_once(self):
+        db = self.mkdb(0)
+        size = 64
+        db.atlas = TileAtlas(size, [bytearray(size * size * 4)],
+                             {"a.bmp": (0, 0, 0, 32, 32),
+                              "b.bmp": (0, 32, 0, 32, 32)})
+        db.load_from_atlas("a", "a.bmp")
+        db.load_from_atlas("b", "b.bmp")
+        self.assertEqual(db.imgdict.bytes, size * size * 4)
+        self.assertIsNot(db.atlas.textures[0], None)
+        db.imgdict.acquire("a", "Physical")
+        db.imgdict.acquire("b", "Physical")
+        self.assertEqual(sorted(db.imgdict.release("Physical")), ["a", "b"])
+        self.assertEqual(db.imgdict.bytes, 0)
+        self.assertIs(db.atlas.textures[0], None)
+
+
+class SyntheticWorldTestCase(TestCase):
+    def test_things_need_spots(self):
+        self.assertRaises(ValueError, SyntheticWorld, places=10, spots=0,
+                          things=1)
+        world = SyntheticWorld(places=10, portals=0, spots=0, things=0,
+                               journeys=0, pawns=0)
+        self.assertEqual(world.things, [])
+
+
+def synthetic_db(lazy=False, **kwargs):
+    """Return an in-memory database with a SyntheticWorld in it."""
+    world = SyntheticWorld(**kwargs)
+    db = Database(":memory:", lazy=lazy, decode_threads=0)
+    db.mkschema()
+    db.insert_tabdicts(world.tabdicts)
+    return db
+
+
+class RouteTableTestCase(TestCase):
+    def setUp(self):
+        # A 3x3 grid with portals both ways between neighbors.
+        self.db = synthetic_db(places=9, portals=24, things=0, journeys=0,
+                               spots=0, pawns=0)
+        self.dim = "Dimension0"
+
+    def test_dimension_has_every_portal(self):
+        dimension = self.db.get_dimension(self.dim)
+        self.assertEqual(len(dimension.portals), 24)
+
+    def test_portal_added_and_removed(self):
+        routes = self.db.get_routes(self.dim)
+        (orig, dest) = ("place(0,0)", "place(2,2)")
+        self.assertEqual(routes.cost(orig, dest), 4)
+        shortcut = Portal(self.db, {"dimension": self.dim,
+                                    "name": "shortcut",
+                                    "from_place": orig,
+                                    "to_place": dest})
+        self.db.remember(shortcut)
+        self.assertIs(routes.next_hop(orig, dest), shortcut)
+        self.assertEqual(routes.route(orig, dest), [shortcut])
+        self.db.forget(shortcut)
+        self.assertNotIn("shortcut", self.db.get_dimension(self.dim).portals)
+        self.assertNotIn("shortcut", self.db.portaldict[self.dim])
+        self.assertIsNot(routes.next_hop(orig, dest), shortcut)
+        self.assertEqual(routes.cost(orig, dest), 4)
+        path = routes.route(orig, dest)
+        self.assertEqual(len(path), 4)
+        self.assertNotIn(shortcut, path)
+        self.db.sync()
+        self.assertEqual(self.saved("portal='shortcut'"), 0)
+
+    def test_edges_told(self):
+        dimension = self.db.get_dimension(self.dim)
+        told = []
+        dimension.edges = Stub(
+            add_portal=lambda portal: told.append(("add", portal.name)),
+            remove_portal=lambda portal: told.append(("rm", portal.name)))
+        shortcut = Portal(self.db, {"dimension": self.dim,
+                                    "name": "shortcut",
+                                    "from_place": "place(0,0)",
+                                    "to_place": "place(2,2)"})
+        self.db.remember(shortcut)
+        self.db.forget(shortcut)
+        self.assertEqual(told, [("add", "shortcut"), ("rm", "shortcut")])
+
+    def saved(self, where):
+        return self.db.conn.execute(
+            "SELECT count(*) FROM route WHERE dimension=? AND " + where,
+            (self.dim,)).fetchone()[0]
+
+    def detach(self):
+        # As in a later session, before anyone's asked for routes.
+        self.db.get_dimension(self.dim).routes = None
+
+    def test_changes_while_detached(self):
+        routes = self.db.get_routes(self.dim)
+        routes.precompute()
+        (orig, dest) = ("place(0,0)", "place(2,2)")
+        doomed = routes.next_hop(orig, dest)
+        self.db.sync()
+        self.assertNotEqual(self.saved("portal='%s'" % (doomed.name,)), 0)
+        self.detach()
+        self.db.forget(doomed)
+        self.db.sync()
+        self.assertEqual(self.saved("1"), 0)
+        routes = self.db.get_routes(self.dim)
+        path = routes.route(orig, dest)
+        self.assertEqual(len(path), 4)
+        self.assertNotIn(doomed, path)
+        self.db.sync()
+        self.detach()
+        shortcut = Portal(self.db, {"dimension": self.dim,
+                                    "name": "shortcut",
+                                    "from_place": orig,
+                                    "to_place": dest})
+        self.db.remember(shortcut)
+        self.db.sync()
+        routes = self.db.get_routes(self.dim)
+        self.assertEqual(routes.route(orig, dest), [shortcut])
+
+    def test_load_drops_bad_hops(self):
+        self.db.get_routes(self.dim).precompute()
+        self.db.sync()
+        self.detach()
+        with self.db.conn:
+            self.db.conn.execute(
+                "UPDATE route SET portal='gone' WHERE dimension=? AND "
+                "orig='place(0,0)' AND dest='place(2,2)'", (self.dim,))
+        routes = self.db.get_routes(self.dim)
+        portal = routes.next_hop("place(0,0)", "place(2,2)")
+        self.assertIs(
+            self.db.get_dimension(self.dim).portals[portal.name], portal)
+        self.assertEqual(portal.origname, "place(0,0)")
+        self.assertNotEqual(self.saved("orig='place(1,1)'"), 0)
+        self.db.sync()
+        self.assertEqual(self.saved("portal='gone'"), 0)
+
+
+class PlanJourneyTestCase(TestCase):
+    def setUp(self):
+        self.db = synthetic_db(lazy=True, places=100, portals=360, things=50,
+                               journeys=10, steps=8, spots=100, pawns=0)
+        self.dim = "Dimension0"
+        self.db.init_dimension(self.dim)
+
+    def saved_steps(self, thingname):
+        return self.db.conn.execute(
+            "SELECT idx FROM journeystep WHERE dimension=? AND thing=? "
+            "ORDER BY idx", (self.dim, thingname)).fetchall()
+
+    def test_nowhere(self):
+        thing = Thing(self.db, {"dimension": self.dim, "name": "lost"})
+        self.assertIs(plan_journey(self.db, thing, "place(0,0)"), None)
+
+    def test_unloaded_steps_are_replaced(self):
+        (thingname,) = self.db.conn.execute(
+            "SELECT thing FROM journeystep WHERE dimension=? AND idx=7",
+            (self.dim,)).fetchone()
+        self.assertEqual(len(self.saved_steps(thingname)), 8)
+        thing = self.db.thingdict[self.dim][thingname]
+        self.assertNotIn(thingname, self.db.journeydict[self.dim])
+        dimension = self.db.get_dimension(self.dim)
+        (desti, portal) = dimension.out[
+            dimension.placeidx[thing.location.name]][0]
+        journey = plan_journey(self.db, thing, portal.destname)
+        self.assertEqual(journey.steplist, [portal])
+        self.db.sync()
+        self.assertEqual(self.saved_steps(thingname), [(0,)])
+
+
+class Step:
+    def __init__(self, weight):
+        self.weight = weight
+
+    def get_weight(self):
+        return self.weight
+
+
+class Walk:
+    def __init__(self, *weights):
+        self.steplist = [Step(weight) for weight in weights]
+        self.curstep = 0
+        self.progress = 0.0
+        self.engine = None
+        self.slot = None
+
+
+class JourneyEngineTestCase(TestCase):
+    def start(self, *weights):
+        engine = JourneyEngine()
+        walk = Walk(*weights)
+        engine.add(walk)
+        return (engine, walk.slot)
+
+    def test_within_a_step(self):
+        (engine, slot) = self.start(2.0, 1.0)
+        self.assertEqual(engine.advance(1.0), [])
+        self.assertEqual(engine.curstep[slot], 0)
+        self.assertAlmostEqual(engine.progress[slot], 0.5)
+
+    def test_spare_time_rescaled(self):
+        (engine, slot) = self.start(1.0, 2.0, 1.0)
+        self.assertEqual(len(engine.advance(1.5)), 1)
+        self.assertEqual(engine.curstep[slot], 1)
+        self.assertAlmostEqual(engine.progress[slot], 0.25)
+
+    def test_weightless_portal(self):
+        (engine, slot) = self.start(0.0, 1.0, 1.0)
+        engine.advance(0.5)
+        self.assertEqual(engine.curstep[slot], 1)
+        self.assertAlmostEqual(engine.progress[slot], 0.5)
+
+    def test_several_portals(self):
+        (engine, slot) = self.start(1.0, 0.0, 0.5, 4.0)
+        engine.advance(2.0)
+        self.assertEqual(engine.curstep[slot], 3)
+        self.assertAlmostEqual(engine.progress[slot], 0.125)
+
+    def test_hole(self):
+        engine = JourneyEngine()
+        walk = Walk(1.0, 1.0, 1.0)
+        walk.steplist[1] = None
+        engine.add(walk)
+        self.assertEqual(engine.advance(5.0), [walk])
+        self.assertEqual(engine.curstep[walk.slot], 1)
+        self.assertEqual(engine.progress[walk.slot], 0.0)
+        self.assertEqual(engine.advance(1.0), [])
+        walk.steplist[1] = Step(2.0)
+        engine.set_speed(walk, 1.0)
+        engine.advance(2.5)
+        self.assertEqual(engine.curstep[walk.slot], 2)
+        self.assertAlmostEqual(engine.progress[walk.slot], 0.5)
+
+    def test_done(self):
+        (engine, slot) = self.start(1.0, 1.0)
+        engine.advance(5.0)
+        self.assertEqual(engine.curstep[slot], 2)
+        self.assertEqual(engine.progress[slot], 0.0)
+        self.assertEqual(engine.rate[slot], 0.0)
+        self.assertEqual(engine.advance(1.0), [])
+
+
+class DecodeTestCase(TestCase):
+    def test_rltile_keyed_in_place(self):
+        path = tile_entries("rltiles")[0][0]["path"]
+        (width, height, pixels) = read_bmp(path)
+        self.assertIsInstance(pixels, bytearray)
+        self.assertEqual(len(pixels), width * height * 4)
+        key_rgba(pixels, width)
+        (w, h, data) = decode_rltile(path)
+        self.assertEqual((w, h), (width, height))
+        self.assertEqual(bytearray(data), pixels)
+        self.assertEqual(len(data), len(pixels))
+
+
+class ColumnStoreTestCase(TestCase):
+    def test_codes_between(self):
+        strings = StringCodes()
+        names = ["place(%d,%d)" % (x, y)
+                 for x in xrange(12, 0, -1) for y in xrange(0, 12)]
+        strings.encode(names)
+        for (lo, hi) in (("place(10,0)", "place(3,5)"),
+                         ("place(2", "place(3"),
+                         ("a", "z"),
+                         ("z", "a")):
+            self.assertEqual(
+                sorted(strings.codes_between(lo, hi).tolist()),
+                sorted([strings.codes[s] for s in names if lo <= s <= hi]))
+        strings.code("place(2,5x)")
+        self.assertIn(strings.codes["place(2,5x)"],
+                      strings.codes_between("place(2", "place(3"))
+
+    def test_partial_updates(self):
+        db = Database(":memory:")
+        db.mkschema()
+        db.insert_defaults()
+        db.load_columns()
+
+        def portal(name, orig, dest):
+            return Portal(db, {"dimension": "Physical", "name": name,
+                               "from_place": orig, "to_place": dest})
+        db.remember(portal("door", "here", "there"))
+        db.sync()
+        db.remember(portal("door", "nowhere", "elsewhere"), "to_place")
+        db.remember(portal("hatch", "here", "there"), "to_place")
+        db.sync()
+        portals = db.columns["portal"]
+        self.assertEqual(portals.get("Physical", "door"),
+                         {"dimension": "Physical", "name": "door",
+                          "from_place": "here", "to_place": "elsewhere"})
+        self.assertIs(portals.get("Physical", "hatch"), None)
+        self.assertEqual(db.conn.execute(
+            "SELECT count(*) FROM portal WHERE name='hatch'").fetchone(),
+            (0,))
+
+    def test_failed_sync_not_applied(self):
+        db = Database(":memory:")
+        db.mkschema()
+        db.insert_defaults()
+        db.load_columns()
+        db.conn.execute(
+            "CREATE TEMP TRIGGER refuse BEFORE INSERT ON place "
+            "BEGIN SELECT RAISE(ABORT, 'refused'); END")
+        nowhere = Place(db, {"dimension": "Physical", "name": "nowhere"})
+        db.remember(nowhere)
+        self.assertRaises(sqlite3.DatabaseError, db.sync)
+        self.assertIs(db.columns["place"].get("Physical", "nowhere"), None)
+        self.assertEqual(db.altered, {nowhere: None})
+        db.conn.execute("DROP TRIGGER refuse")
+        db.sync()
+        self.assertEqual(db.altered, {})
+        self.assertEqual(db.columns["place"].get("Physical", "nowhere"),
+                         {"dimension": "Physical", "name": "nowhere"})
+
+
+class AsyncColumnsTestCase(FileDatabaseTestCase):
+    def test_applied_once_written(self):
+        self.db.close()
+        self.db = Database(self.path, async_save=True)
+        self.db.load_columns()
+        nowhere = Place(self.db, {"dimension": "Physical", "name": "nowhere"})
+        self.db.remember(nowhere)
+        self.assertIs(self.db.sync(), None)
+        self.assertIs(self.db.columns["place"].get("Physical", "nowhere"),
+                      None)
+        self.db.flush()
+        self.assertEqual(
+            self.db.columns["place"].get("Physical", "nowhere"),
+            {"dimension": "Physical", "name": "nowhere"})
+
+
+class LazyTestCase(TestCase):
+    def setUp(self):
+        self.db = synthetic_db(lazy=True, places=9, portals=24, things=6,
+                               journeys=0, spots=9, pawns=0)
+        self.dim = "Dimension0"
+        self.db.init_dimension(self.dim)
+
+    def count(self, qrystr, *args):
+        return self.db.conn.execute(qrystr, args).fetchone()[0]
+
+    def test_place_faults_neighbors(self):
+        places = self.db.placedict[self.dim]
+        self.assertNotIn("place(1,1)", places)
+        place = places["place(1,1)"]
+        self.assertEqual(
+            len(place.portals),
+            self.count("SELECT COUNT(*) FROM portal WHERE dimension=? AND "
+                       "from_place=?", self.dim, "place(1,1)"))
+        for portal in place.portals:
+            self.assertIn(portal.destname, places)
+            self.assertIn(portal.name, self.db.portaldict[self.dim])
+        self.assertEqual(
+            sorted([thing.name for thing in place.contents]),
+            sorted([row[0] for row in self.db.conn.execute(
+                "SELECT thing FROM location WHERE dimension=? AND place=?",
+                (self.dim, "place(1,1)"))]))
+
+    def test_missing(self):
+        places = self.db.placedict[self.dim]
+        self.assertRaises(KeyError, lambda: places["nowhere"])
+        self.assertNotIn("nowhere", places)
+        self.assertIs(self.db.thingdict[self.dim].get("thing0"), None)
+
+    def test_thing_linked_once(self):
+        things = self.db.thingdict[self.dim]
+        for i in xrange(0, 6):
+            thing = things["thing%d" % (i,)]
+            self.assertEqual(list(thing.location.contents).count(thing), 1)
+            self.assertIs(thing.location,
+                          self.db.placedict[self.dim][thing.location.name])
+
+    def test_fault_all(self):
+        portals = self.db.portaldict[self.dim]
+        self.db.placedict[self.dim]["place(0,0)"]
+        loaded = dict(portals)
+        portals.fault_all()
+        self.assertEqual(len(portals), 24)
+        for (name, portal) in loaded.iteritems():
+            self.assertIs(portals[name], portal)
+        self.assertEqual(len(self.db.dimensiondict[self.dim].portals), 24)
+
+
+class SyncPlanTestCase(FileDatabaseTestCase):
+    def place(self, name):
+        return Place(self.db, {"dimension": "Physical", "name": name})
+
+    def portal(self, name, orig, dest):
+        return Portal(self.db, {"dimension": "Physical",
+                                "name": name,
+                                "from_place": orig,
+                                "to_place": dest})
+
+    def fetch(self, qrystr, *args):
+        return self.db.conn.execute(qrystr, args).fetchall()
+
+    def test_deletes_first(self):
+        old = self.place("somewhere")
+        new = self.place("somewhere")
+        plan = plan_sync({new: None}, set([old]))
+        self.assertEqual([qrystr.split()[0] for (tabname, qrystr, rows)
+                          in plan], ["DELETE", "INSERT"])
+        run_sync_plan(self.db.conn, plan)
+        self.assertEqual(self.fetch(
+            "SELECT name FROM place WHERE name=?", "somewhere"),
+            [("somewhere",)])
+
+    def test_update_only_dirty(self):
+        for name in ("here", "there", "elsewhere"):
+            self.db.remember(self.place(name))
+        self.db.remember(self.portal("door", "here", "there"))
+        self.db.sync()
+        moved = self.portal("door", "nowhere", "elsewhere")
+        plan = plan_sync({moved: set(["to_place"])}, set())
+        self.assertEqual(len(plan), 1)
+        (tabname, qrystr, rows) = plan[0]
+        self.assertEqual(tabname, "portal")
+        self.assertTrue(qrystr.startswith("UPDATE"))
+        stats = run_sync_plan(self.db.conn, plan)
+        self.assertEqual(stats.rows, {"portal": 1})
+        self.assertEqual(self.fetch(
+            "SELECT from_place, to_place FROM portal WHERE name=?", "door"),
+            [("here", "elsewhere")])
+
+    def test_no_insert_for_no_rows(self):
+        lost = Thing(self.db, {"dimension": "Physical", "name": "lost"})
+        plan = plan_sync({lost: None}, set())
+        self.assertEqual([qrystr.split()[0] for (tabname, qrystr, rows)
+                          in plan if tabname == "containment"], ["DELETE"])
+        self.assertEqual(plan_sync({}, set()), [])
+
+    def test_owned_rows_replaced(self):
+        self.db.init_dimension("Physical")
+        self.db.load_columns()
+        things = self.db.thingdict["Physical"]
+        here = self.place("here")
+        self.db.remember(here)
+        self.db.remember(self.place("there"))
+        doors = [self.portal("door%d" % (i,), "here", "there")
+                 for i in xrange(0, 3)]
+        for door in doors:
+            self.db.remember(door)
+        for name in ("box", "a", "b"):
+            things[name] = Thing(self.db, {"dimension": "Physical",
+                                           "name": name})
+            things[name].location = here
+        box = things["box"]
+        box.add_content(things["a"])
+        box.add_content(things["b"])
+        journey = Journey(self.db, {"dimension": "Physical",
+                                    "thing": "box",
+                                    "curstep": 0,
+                                    "progress": 0.0})
+        for i in xrange(0, 3):
+            journey.set_step(doors[i], i)
+        for obj in things.values() + [journey]:
+            self.db.remember(obj)
+        self.db.sync()
+        self.assertEqual(len(self.fetch(
+            "SELECT * FROM containment WHERE container='box'")), 2)
+        self.assertEqual(len(self.fetch(
+            "SELECT * FROM journeystep WHERE thing='box'")), 3)
+        box.contents = []
+        box.location = None
+        journey.steplist = journey.steplist[:1]
+        self.db.remember(box)
+        self.db.remember(journey)
+        self.db.sync()
+        self.assertEqual(self.fetch(
+            "SELECT * FROM containment WHERE container='box'"), [])
+        self.assertEqual(self.fetch(
+            "SELECT * FROM location WHERE thing='box'"), [])
+        self.assertEqual(self.fetch(
+            "SELECT idx, portal FROM journeystep WHERE thing='box'"),
+            [(0, "door0")])
+        self.assertEqual(len(self.fetch(
+            "SELECT * FROM location WHERE thing IN ('a', 'b')")), 2)
+        steps = self.db.columns["journeystep"]
+        self.assertEqual(steps.values("portal", steps.eq("thing", "box")),
+                         ["door0"])
+        containment = self.db.columns["containment"]
+        self.assertFalse(containment.eq("container", "box").any())
+        location = self.db.columns["location"]
+        self.assertEqual(location.get("Physical", "box"), None)
+
+    def test_one_transaction(self):
+        plan = plan_sync({self.place("somewhere"): None}, set())
+        plan.append(("nope", "INSERT INTO nope VALUES (?)", ((1,),)))
+        self.assertRaises(sqlite3.OperationalError,
+                          run_sync_plan, self.db.conn, plan)
+        self.assertEqual(self.fetch(
+            "SELECT name FROM place WHERE name=?", "somewhere"), [])
+
+
+class AsyncFailureTestCase(FileDatabaseTestCase):
+    def test_failed_plans_taken_back(self):
+        self.db.close()
+        self.db = Database(self.path, async_save=True)
+        db = self.db
+        db.conn.execute(
+            "CREATE TRIGGER refuse BEFORE INSERT ON place "
+            "BEGIN SELECT RAISE(ABORT, 'refused'); END")
+        db.conn.commit()
+        nowhere = Place(db, {"dimension": "Physical", "name": "nowhere"})
+        elsewhere = Place(db, {"dimension": "Physical", "name": "elsewhere"})
+        db.remember(nowhere)
+        db.remember(elsewhere)
+        db.sync()
+        db.forget(elsewhere)
+        errors = 0
+        # The error comes out of whichever of these finds it first.
+        for f in (db.sync, db.flush):
+            try:
+                f()
+            except sqlite3.DatabaseError:
+                errors += 1
+        self.assertEqual(errors, 1)
+        self.assertEqual(db.altered, {nowhere: None})
+        self.assertEqual(db.removed, set([elsewhere]))
+        db.conn.execute("DROP TRIGGER refuse")
+        db.conn.commit()
+        db.sync()
+        db.flush()
+        self.assertEqual(db.altered, {})
+        self.assertEqual(db.conn.execute(
+            "SELECT name FROM place WHERE name IN (?, ?)",
+            ("nowhere", "elsewhere")).fetchall(), [("nowhere",)])
+
+
+class Stub:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Spotless:
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def spot(self):
+        raise KeyError(self.name)
+
+
+class PawnPositionsTestCase(TestCase):
+    def pawn(self, location):
+        return Stub(thing=Stub(location=location), r=4, img=Stub(height=8),
+                    positions=None, slot=None)
+
+    def place(self, name, x, y):
+        place = Stub(name=name)
+        place.spot = Stub(place=place, x=x, y=y)
+        return place
+
+    def test_nowhere_to_draw(self):
+        positions = PawnPositions()
+        there = self.place("there", 10, 20)
+        pawns = [self.pawn(None), self.pawn(Spotless("void")),
+                 self.pawn(there)]
+        for pawn in pawns:
+            positions.add(pawn)
+        positions.update()
+        self.assertEqual([positions.placed[pawn.slot] for pawn in pawns],
+                         [False, False, True])
+        self.assertEqual(positions.getcoords(pawns[2].slot), (10.0, 20.0))
+        self.assertEqual(positions.at, {"there": set([pawns[2].slot])})
+        self.assertEqual(positions.moved(), [pawns[2]])
+        pawns[0].thing.location = there
+        positions.touch(pawns[0])
+        positions.update()
+        self.assertTrue(positions.placed[pawns[0].slot])
+        self.assertEqual(positions.getcoords(pawns[0].slot), (10.0, 20.0))
+        self.assertEqual(positions.moved(), [pawns[0]])
+        pawns[2].thing.location = None
+        positions.touch(pawns[2])
+        positions.update()
+        self.assertFalse(positions.placed[pawns[2].slot])
+        self.assertEqual(positions.at, {"there": set([pawns[0].slot])})
+        self.assertEqual(positions.moved(), [pawns[2]])
@@ -0,0 +1,445 @@
+"""Packing the rltiles into a few big textures, and caching the result.
+
+The manifests in rltiles/--dc-*.txt and nh-*.txt--list the tiles, one
+to a line, as a file name without the .bmp, then the name of the tile
+in the game the tiles came from. Lines starting with % set things for
+the lines after them:
+
+    %sdir d       look for the files in d first
+    %subst f      if a file isn't found, use f instead
+    %rim n        whether to draw a black rim around the tile
+    %include m    read the manifest m here
+
+Paths are relative to the rltiles directory. Other directives have to
+do with the C tools' output, and are ignored.
+
+An atlas is a list of pages of RGBA pixels, and a dict mapping the
+path of each tile's file to the page it's on and where. The cache file
+holds both, along with the modification time of every manifest and
+tile that went into it; if any of those have changed, or any are gone,
+the atlas gets built over.
+
+The tiles are decoded here, not by pyglet, so an atlas can be built
+without a window:
+
+    python tiles.py pack [--rootdir rltiles] [--size 1024] rltiles.atlas
+
+The file starts with a header--the magic, then the page size, the
+number of pages, the length of the index, and the offset of the first
+page, as little-endian 32-bit ints. The index is JSON, and maps the
+paths to their regions and the tiles' names to their paths. The pages
+come after, each size * size RGBA pixels, the first at a multiple of
+page_align.
+
+The file is mapped into memory, not read. Each page is a ctypes array
+over the mapping, and goes to OpenGL from there, so only the pages
+that get used are ever read off the disk, and nothing is copied on
+the way.
+
+"""
+import argparse
+import ctypes
+import json
+import mmap
+import os
+import struct
+import sys
+from glob import glob
+import numpy
+from pyglet.image import ImageData
+
+
+# Pixels of these colours are transparent. Keying used to be string
+# replacement, which also replaced '\xff.': it cleared the alpha of any
+# pixel followed by one whose red was 0x2e, whatever its green and
+# blue. That wasn't a key colour, so it's not kept.
+key_colors = [(0x47, 0x6c, 0x6c)]
+# The colour the C tools draw rims in.
+rim_color = (0x10, 0x10, 0x10)
+atlas_magic = "LiSEatl2"
+atlas_header = struct.Struct("<IIII")
+page_size = 1024
+page_align = 4096
+
+
+def read_manifest(rootdir, manifest, entries=None, seen=None):
+    """Return a list of dicts describing the tiles in the manifest: the
+path to the tile's file, the name it's given, and its rim setting.
+
+Tiles that have no file are left out. So are manifests that are
+included more than once.
+
+"""
+    if entries is None:
+        entries = []
+    if seen is None:
+        seen = set()
+    if manifest in seen:
+        return entries
+    seen.add(manifest)
+    sdir = ""
+    subst = ""
+    rim = 0
+    f = open(os.path.join(rootdir, manifest))
+    for line in f:
+        line = line.strip()
+        if line == "" or line[0] == "#":
+            continue
+        if line[0] == "%":
+            words = line[1:].split(None, 1)
+            if len(words) < 2:
+                continue
+            (directive, arg) = (words[0], words[1].strip())
+            if directive == "sdir":
+                sdir = arg
+            elif directive == "subst":
+                subst = arg
+            elif directive == "rim":
+                rim = int(arg)
+            elif directive == "include":
+                read_manifest(rootdir, arg, entries, seen)
+            continue
+        words = line.split(None, 1)
+        fnam = words[0]
+        if len(words) > 1:
+            name = words[1].split("/*")[0].strip()
+        else:
+            name = ""
+        path = find_tile(rootdir, sdir, fnam, subst)
+        if path is not None:
+            entries.append({"path": path, "name": name, "rim": rim})
+    f.close()
+    return entries
+
+
+def find_tile(rootdir, sdir, fnam, subst):
+    """Look for the file the way the C tools do: in sdir, then at the
+top, then the same for subst."""
+    tries = [os.path.join(sdir, fnam), fnam]
+    if subst != "":
+        tries.extend([os.path.join(sdir, subst), subst])
+    for tri in tries:
+        path = os.path.normpath(os.path.join(rootdir, tri + ".bmp"))
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def manifests(rootdir):
+    return sorted([os.path.basename(path) for path in
+                   glob(os.path.join(rootdir, "dc-*.txt")) +
+                   glob(os.path.join(rootdir, "nh-*.txt"))])
+
+
+def tile_entries(rootdir):
+    """Return the entries for every tile in every manifest, the first for
+each path only, in the order they're listed. Also return a dict
+mapping the names given to the tiles to their paths."""
+    seen = set()
+    entries = []
+    for manifest in manifests(rootdir):
+        read_manifest(rootdir, manifest, entries, seen)
+    r = []
+    names = {}
+    done = set()
+    for entry in entries:
+        if entry["name"] != "" and entry["name"] not in names:
+            names[entry["name"]] = entry["path"]
+        if entry["path"] not in done:
+            done.add(entry["path"])
+            r.append(entry)
+    return (r, names)
+
+
+def tile_paths(rootdir):
+    """Return the path of every tile in every manifest, once each, in the
+order they're first listed."""
+    return [entry["path"] for entry in tile_entries(rootdir)[0]]
+
+
+def mtimes(rootdir, paths):
+    r = dict([(os.path.join(rootdir, manifest),
+               os.path.getmtime(os.path.join(rootdir, manifest)))
+              for manifest in manifests(rootdir)])
+    for path in paths:
+        r[path] = os.path.getmtime(path)
+    return r
+
+
+def key_rgba(data, width):
+    """Make every pixel of a key colour transparent, in place.
+
+data is a writable buffer, like a bytearray, of RGBA pixels in rows of
+width. It's looked at through an (height, width, 4) array, not copied.
+
+"""
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+        (-1, width, 4))
+    rgb = pixels[:, :, :3]
+    keyed = numpy.zeros(pixels.shape[:2], dtype=bool)
+    for color in key_colors:
+        keyed |= (rgb == color).all(axis=2)
+    pixels[:, :, 3][keyed] = 0
+
+
+def read_bmp(path):
+    """Decode an uncompressed BMP of 1, 4, 8, 24 or 32 bits a pixel.
+Return its width, its height, and a bytearray of its RGBA pixels, in
+rows from the bottom up, the way pyglet has them.
+
+"""
+    f = open(path, "rb")
+    data = f.read()
+    f.close()
+    if data[:2] != "BM":
+        raise ValueError("{0} is not a BMP".format(path))
+    (offset,) = struct.unpack("<I", data[10:14])
+    (hdrlen, width, height, planes, bpp, compression) = struct.unpack(
+        "<IiiHHI", data[14:34])
+    if compression not in (0, 3) or bpp not in (1, 4, 8, 24, 32):
+        raise ValueError("{0} is a kind of BMP I can't read".format(path))
+    # Rows are stored bottom up, unless the height is negative.
+    flip = height < 0
+    height = abs(height)
+    stride = (width * bpp + 31) // 32 * 4
+    rows = numpy.frombuffer(data, dtype=numpy.uint8, count=stride * height,
+                            offset=offset).reshape((height, stride))
+    if flip:
+        rows = rows[::-1]
+    # The pixels are written straight into the bytearray that's returned.
+    pixbuf = bytearray(height * width * 4)
+    rgba = numpy.frombuffer(pixbuf, dtype=numpy.uint8).reshape(
+        (height, width, 4))
+    if bpp <= 8:
+        (ncolors,) = struct.unpack("<I", data[46:50])
+        if ncolors == 0:
+            ncolors = 1 << bpp
+        start = 14 + hdrlen
+        # The palette is in BGR order, padded to four bytes a colour.
+        palette = numpy.frombuffer(
+            data, dtype=numpy.uint8, count=ncolors * 4,
+            offset=start).reshape((ncolors, 4))
+        lut = numpy.zeros((256, 4), dtype=numpy.uint8)
+        lut[:ncolors, :3] = palette[:, 2::-1]
+        lut[:, 3] = 255
+        bits = numpy.unpackbits(rows, axis=1).reshape((height, -1, bpp))
+        weights = 1 << numpy.arange(bpp - 1, -1, -1)
+        indices = (bits[:, :width] * weights).sum(axis=2)
+        rgba[:] = lut[indices]
+    else:
+        nbytes = bpp // 8
+        pixels = rows[:, :width * nbytes].reshape((height, width, nbytes))
+        rgba[:, :, :3] = pixels[:, :, 2::-1]
+        rgba[:, :, 3] = 255
+    return (width, height, pixbuf)
+
+
+def draw_rim(data, width):
+    """Draw a rim around the tile, the way the C tools do, in place: every
+pixel that's a key colour or black, and is next to one that isn't,
+becomes rim_color."""
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+        (-1, width, 4))
+    rgb = pixels[:, :, :3]
+    solid = ~(rgb == 0).all(axis=2)
+    for color in key_colors:
+        solid &= ~(rgb == color).all(axis=2)
+    near = numpy.zeros(solid.shape, dtype=bool)
+    near[1:, :] |= solid[:-1, :]
+    near[:-1, :] |= solid[1:, :]
+    near[:, 1:] |= solid[:, :-1]
+    near[:, :-1] |= solid[:, 1:]
+    rgb[near & ~solid] = rim_color
+
+
+def pack(sizes, size=page_size):
+    """Put rectangles of the given (width, height) on square pages, in
+shelves, tallest first. Return a list of (page, x, y), one for each
+size, and the number of pages."""
+    order = sorted(xrange(0, len(sizes)),
+                   key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    r = [None] * len(sizes)
+    page = 0
+    (x, y, shelf) = (0, 0, 0)
+    for i in order:
+        (w, h) = sizes[i]
+        if x + w > size:
+            (x, y, shelf) = (0, y + shelf, 0)
+        if y + h > size:
+            (page, x, y, shelf) = (page + 1, 0, 0, 0)
+        r[i] = (page, x, y)
+        x += w
+        shelf = max(shelf, h)
+    return (r, page + 1)
+
+
+def build_atlas(entries, size=page_size):
+    """Decode the tiles the entries describe, draw the rims that are
+wanted, and pack them. Return a list of pages, each a bytearray of
+size * size RGBA pixels, and a dict mapping each path to (page, x, y,
+width, height)."""
+    tiles = []
+    paths = []
+    for entry in entries:
+        (tw, th, pixels) = read_bmp(entry["path"])
+        if entry["rim"] == 1:
+            draw_rim(pixels, tw)
+        tiles.append((tw, th, pixels))
+        paths.append(entry["path"])
+    (places, npages) = pack([(tw, th) for (tw, th, pixels) in tiles], size)
+    pages = [bytearray(size * size * 4) for i in xrange(0, npages)]
+    regions = {}
+    pitch = size * 4
+    for i in xrange(0, len(paths)):
+        (tw, th, pixels) = tiles[i]
+        (page, x, y) = places[i]
+        pagebuf = pages[page]
+        rowlen = tw * 4
+        for row in xrange(0, th):
+            start = (y + row) * pitch + x * 4
+            pagebuf[start:start + rowlen] = pixels[row * rowlen:
+                                                   (row + 1) * rowlen]
+        regions[paths[i]] = (page, x, y, tw, th)
+    for pagebuf in pages:
+        key_rgba(pagebuf, size)
+    return (pages, regions)
+
+
+def write_atlas(cachepath, sources, size, pages, regions, names=None):
+    """Write the atlas to the file: the header, the index as JSON, and
+the pages one after another."""
+    if names is None:
+        names = {}
+    index = json.dumps({"sources": sources,
+                        "regions": regions,
+                        "names": names})
+    start = len(atlas_magic) + atlas_header.size + len(index)
+    start += -start % page_align
+    f = open(cachepath, "wb")
+    f.write(atlas_magic)
+    f.write(atlas_header.pack(size, len(pages), len(index), start))
+    f.write(index)
+    f.write("\0" * (start - f.tell()))
+    for buf in pages:
+        f.write(buf)
+    f.close()
+
+
+def read_atlas(cachepath):
+    """Map the file. Return the index and the pages, or None if it isn't
+an atlas.
+
+The mapping is copy-on-write, which ctypes needs to make arrays over
+it. The pages are never written to, so it's never copied.
+
+"""
+    f = open(cachepath, "rb")
+    hstart = len(atlas_magic)
+    istart = hstart + atlas_header.size
+    if os.fstat(f.fileno()).st_size < istart:
+        f.close()
+        return None
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    f.close()
+    if mm[:hstart] != atlas_magic:
+        mm.close()
+        return None
+    (size, npages, n, start) = atlas_header.unpack(mm[hstart:istart])
+    pagelen = size * size * 4
+    if len(mm) < start + npages * pagelen:
+        mm.close()
+        return None
+    index = json.loads(mm[istart:istart + n])
+    index["size"] = size
+    page = ctypes.c_ubyte * pagelen
+    pages = [page.from_buffer(mm, start + i * pagelen)
+             for i in xrange(0, npages)]
+    return (index, pages)
+
+
+class TileAtlas:
+    """Textures for every tile in rltiles, made from a few big pages.
+
+Each page becomes a texture the first time a tile on it is wanted.
+Tiles are regions of the page textures.
+
+names maps the names the manifests give the tiles to their paths.
+
+"""
+    def __init__(self, size, pages, regions, names=None):
+        self.size = size
+        self.pages = pages
+        self.regions = regions
+        if names is None:
+            names = {}
+        self.names = names
+        self.textures = [None] * len(pages)
+
+    def __contains__(self, path):
+        return os.path.normpath(path) in self.regions
+
+    def page_of(self, path):
+        return self.regions[os.path.normpath(path)][0]
+
+    def page_bytes(self):
+        return self.size * self.size * 4
+
+    def drop(self, page):
+        """Let go of the page's texture. It's made again, from the
+mapping, the next time a tile on it is wanted."""
+        self.textures[page] = None
+
+    def texture(self, path):
+        (page, x, y, w, h) = self.regions[os.path.normpath(path)]
+        if self.textures[page] is None:
+            self.textures[page] = ImageData(
+                self.size, self.size, 'RGBA', self.pages[page],
+                self.size * 4).get_texture()
+        return self.textures[page].get_region(x, y, w, h)
+
+    @classmethod
+    def load(cls, cachepath, rootdir="rltiles", size=page_size):
+        """Map the atlas in the cache file if it's up to date. Otherwise
+build it and write the cache first."""
+        (entries, names) = tile_entries(rootdir)
+        sources = mtimes(rootdir, [entry["path"] for entry in entries])
+        r = None
+        if os.path.exists(cachepath):
+            r = read_atlas(cachepath)
+            if r is not None and (r[0]["sources"] != sources or
+                                  r[0]["size"] != size):
+                # Let go of the old mapping before the file changes
+                # under it.
+                r = None
+        if r is None:
+            (pages, regions) = build_atlas(entries, size)
+            write_atlas(cachepath, sources, size, pages, regions, names)
+            del pages
+            r = read_atlas(cachepath)
+        (index, pages) = r
+        regions = dict([(path, tuple(region)) for (path, region)
+                        in index["regions"].iteritems()])
+        return cls(size, pages, regions, index["names"])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Pack the rltiles into an atlas.")
+    commands = parser.add_subparsers(dest="command")
+    packer = commands.add_parser(
+        "pack", help="build the atlas and write it to a file")
+    packer.add_argument("out", nargs="?", default="rltiles.atlas")
+    packer.add_argument("--rootdir", default="rltiles")
+    packer.add_argument("--size", type=int, default=page_size,
+                        help="width and height of each page, in pixels")
+    args = parser.parse_args(argv)
+    (entries, names) = tile_entries(args.rootdir)
+    sources = mtimes(args.rootdir, [entry["path"] for entry in entries])
+    (pages, regions) = build_atlas(entries, args.size)
+    write_atlas(args.out, sources, args.size, pages, regions, names)
+    print "{0} tiles on {1} pages of {2}x{2}, {3} names, in {4}".format(
+        len(regions), len(pages), args.size, len(names), args.out)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,6 @@
 # This file is for the controllers for the things that show up on the
 # screen when you play.
+import numpy
 import pyglet
 from saveload import SaveableMetaclass
 
@@ -36,6 +37,14 @@ tuples that Pyglet uses to identify colors.
         self.tup = (self.red, self.green, self.blue, self.alpha)
         self.pattern = pyglet.image.SolidColorImagePattern(self.tup)
 
+    @property
+    def tabdict(self):
+        return {"color": {"name": self.name,
+                          "red": self.red,
+                          "green": self.green,
+                          "blue": self.blue,
+                          "alpha": self.alpha}}
+
     def __eq__(self, other):
         return (
             isinstance(other, Color) and
@@ -76,6 +85,17 @@ class MenuItem:
         self.interactive = rowdict["interactive"]
         self.hsh = hash(self.menuname + str(self.idx))
 
+    @property
+    def tabdict(self):
+        return {"menuitem": {"menu": self.menuname,
+                             "idx": self.idx,
+                             "text": self.text,
+                             "onclick": self.onclick_core.__name__,
+                             "onclick_arg": self.onclick_arg,
+                             "closer": self.closer,
+                             "visible": self.visible,
+                             "interactive": self.interactive}}
+
     def __eq__(self, other):
         return (
             isinstance(other, MenuItem) and
@@ -190,6 +210,17 @@ class Menu:
         # pyglet kind. It isn't in the constructor because that would
         # make loading inconvenient.
 
+    @property
+    def tabdict(self):
+        return {"menu": {"name": self.name,
+                         "left": self.left,
+                         "bottom": self.bottom,
+                         "top": self.top,
+                         "right": self.right,
+                         "style": self.style.name,
+                         "main_for_window": self.main_for_window,
+                         "visible": self.visible}}
+
     def __eq__(self, other):
         if hasattr(self, 'gw'):
             return (
@@ -372,6 +403,8 @@ class Spot:
                  "visible": "boolean",
                  "interactive": "boolean"}}
     primarykeys = {"spot": ("dimension", "place")}
+    # For loading just the spots in view.
+    indexes = {"spot": [("dimension", "x", "y")]}
     foreignkeys = {"spot":
                    {"dimension, place": ("place", "dimension, name"),
                     "img": ("img", "name")}}
@@ -388,6 +421,16 @@ class Spot:
         self.grabpoint = None
         self.hsh = hash(self.dimension + self.place.name)
 
+    @property
+    def tabdict(self):
+        return {"spot": {"dimension": self.dimension,
+                         "place": self.place.name,
+                         "img": self.img.name,
+                         "x": self.x,
+                         "y": self.y,
+                         "visible": self.visible,
+                         "interactive": self.interactive}}
+
     def __repr__(self):
         return "spot(%i,%i)->%s" % (self.x, self.y, str(self.place))
 
@@ -472,7 +515,20 @@ class Pawn:
         self.visible = rowdict["visible"]
         self.interactive = rowdict["interactive"]
         self.r = self.img.width / 2
+        self.rx = self.r
+        self.ry = self.img.height / 2
         self.hsh = hash(self.dimension + self.thing.name)
+        # Set by PawnPositions.add.
+        self.positions = None
+        self.slot = None
+
+    @property
+    def tabdict(self):
+        return {"pawn": {"dimension": self.dimension,
+                         "thing": self.thingname,
+                         "img": self.img.name,
+                         "visible": self.visible,
+                         "interactive": self.interactive}}
 
     def __eq__(self, other):
         return (
@@ -484,6 +540,17 @@ class Pawn:
         return self.hsh
 
     def getcoords(self):
+        if self.positions is not None:
+            return self.positions.getcoords(self.slot)
+        return self.compute_coords()
+
+    def is_placed(self):
+        """Is there anywhere to draw me?"""
+        if self.positions is not None:
+            return bool(self.positions.placed[self.slot])
+        return True
+
+    def compute_coords(self):
         # Assume I've been provided a spotdict. Use it to get the
         # spot's x and y, as well as that of the spot for the next
         # step on my thing's journey. If my thing doesn't have a
@@ -542,6 +609,198 @@ class Pawn:
         pass
 
 
+def spot_of(place):
+    """Return the place's spot, or None if it hasn't got one."""
+    try:
+        return place.spot
+    except KeyError:
+        return None
+
+
+class PawnPositions:
+    """Where every pawn on a board is, worked out once a frame.
+
+Each pawn has a slot. For each slot there's the spot where the pawn's
+current portal starts and the one where it ends--both the same, if it
+isn't going anywhere--and the journey's slot in the JourneyEngine.
+update reads the progress of every journey out of the engine at once
+and puts each pawn the right fraction of the way along its portal, in
+coords. Pawn.getcoords reads its row of that.
+
+The ends only get looked up again for pawns whose journey changed step
+or got another engine slot, and for pawns at either end of a spot
+that's moved.
+
+A pawn whose thing is nowhere, or somewhere with no spot, has nowhere
+to be drawn. It keeps its slot, but it's not placed, and it's at
+neither end of anything until it's touched and has somewhere.
+
+"""
+    def __init__(self, engine=None, capacity=64):
+        self.engine = engine
+        self.pawns = []
+        self.start = numpy.zeros((capacity, 2), dtype=numpy.float64)
+        self.end = numpy.zeros((capacity, 2), dtype=numpy.float64)
+        # Progress of journeys that aren't in the engine.
+        self.progress = numpy.zeros(capacity, dtype=numpy.float64)
+        # The engine slot, or -1, and the curstep and serial it had at
+        # the last refresh.
+        self.eslot = numpy.zeros(capacity, dtype=numpy.int32) - 1
+        self.step = numpy.zeros(capacity, dtype=numpy.int32)
+        self.serial = numpy.zeros(capacity, dtype=numpy.int32)
+        self.coords = numpy.zeros((capacity, 2), dtype=numpy.float64)
+        # For moved_cells: each pawn's half width and height, and the
+        # grid cells its box covered last time.
+        self.rx = numpy.zeros(capacity, dtype=numpy.float64)
+        self.height = numpy.zeros(capacity, dtype=numpy.float64)
+        self.cells = numpy.zeros((capacity, 4), dtype=numpy.int32)
+        # For moved: coords and placed as of the last call.
+        self.shown = numpy.zeros((capacity, 2), dtype=numpy.float64)
+        self.placed = numpy.zeros(capacity, dtype=bool)
+        self.shownplaced = numpy.zeros(capacity, dtype=bool)
+        # Maps the name of a place to the set of slots of pawns whose
+        # portal starts or ends at its spot.
+        self.at = {}
+        self.ends = []
+        self.dirty = set()
+
+    def set_engine(self, engine):
+        """Read the progress of journeys out of the engine from now on."""
+        self.engine = engine
+        self.dirty.update(xrange(0, len(self.pawns)))
+
+    def grow(self):
+        capacity = len(self.pawns) * 2
+        for name in ("start", "end", "progress", "eslot", "step", "serial",
+                     "coords", "rx", "height", "cells", "shown", "placed",
+                     "shownplaced"):
+            old = getattr(self, name)
+            new = numpy.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, pawn):
+        if pawn.positions is self:
+            return
+        slot = len(self.pawns)
+        if slot == len(self.coords):
+            self.grow()
+        self.pawns.append(pawn)
+        self.ends.append(())
+        pawn.positions = self
+        pawn.slot = slot
+        self.rx[slot] = pawn.r
+        self.height[slot] = pawn.img.height
+        self.refresh(slot)
+        self.coords[slot] = self.start[slot]
+
+    def touch(self, pawn):
+        """Look up the ends of the pawn's portal again at the next
+update."""
+        self.dirty.add(pawn.slot)
+
+    def spot_moved(self, spot):
+        self.dirty.update(self.at.get(spot.place.name, ()))
+
+    def refresh(self, slot):
+        pawn = self.pawns[slot]
+        for placename in self.ends[slot]:
+            self.at[placename].discard(slot)
+        self.ends[slot] = ()
+        thing = pawn.thing
+        journey = getattr(thing, "journey", None)
+        self.eslot[slot] = -1
+        self.progress[slot] = 0.0
+        moving = (journey is not None and journey.stepsleft() > 0 and
+                  journey.getstep(0) is not None)
+        if moving:
+            port = journey.getstep(0)
+            ends = (spot_of(port.orig), spot_of(port.dest))
+        elif thing.location is not None:
+            spot = spot_of(thing.location)
+            ends = (spot, spot)
+        else:
+            ends = (None, None)
+        self.placed[slot] = ends[0] is not None and ends[1] is not None
+        if not self.placed[slot]:
+            self.start[slot] = self.end[slot] = (0.0, 0.0)
+            return
+        if moving:
+            if journey.engine is not None and journey.engine is self.engine:
+                self.eslot[slot] = journey.slot
+                self.step[slot] = journey.curstep
+                self.serial[slot] = self.engine.serial[journey.slot]
+            else:
+                self.progress[slot] = journey.progress
+        self.start[slot] = (ends[0].x, ends[0].y)
+        self.end[slot] = (ends[1].x, ends[1].y)
+        self.ends[slot] = tuple(set([end.place.name for end in ends]))
+        for placename in self.ends[slot]:
+            if placename not in self.at:
+                self.at[placename] = set()
+            self.at[placename].add(slot)
+
+    def update(self):
+        """Work out where every pawn is now."""
+        n = len(self.pawns)
+        if n == 0:
+            return
+        eslot = self.eslot[:n]
+        progress = self.progress[:n].copy()
+        moving = numpy.flatnonzero(eslot >= 0)
+        if len(moving) > 0:
+            engine = self.engine
+            es = eslot[moving]
+            stale = moving[(engine.curstep[es] != self.step[moving]) |
+                           (engine.serial[es] != self.serial[moving])]
+            self.dirty.update(stale.tolist())
+            progress[moving] = engine.progress[es]
+        if len(self.dirty) > 0:
+            dirty = sorted(self.dirty)
+            self.dirty = set()
+            for slot in dirty:
+                self.refresh(slot)
+            # Those pawns may have stopped moving, or started.
+            progress[dirty] = self.progress[dirty]
+            redo = [slot for slot in dirty if self.eslot[slot] >= 0]
+            if len(redo) > 0:
+                progress[redo] = self.engine.progress[self.eslot[redo]]
+        start = self.start[:n]
+        self.coords[:n] = start + (self.end[:n] - start) * progress[:, None]
+
+    def getcoords(self, slot):
+        (x, y) = self.coords[slot]
+        return (float(x), float(y))
+
+    def moved(self):
+        """Return the pawns whose coords changed since the last call, or
+that were placed or stopped being."""
+        n = len(self.pawns)
+        if n == 0:
+            return []
+        coords = self.coords[:n]
+        placed = self.placed[:n]
+        moved = numpy.flatnonzero((coords != self.shown[:n]).any(axis=1) |
+                                  (placed != self.shownplaced[:n]))
+        self.shown[:n] = coords
+        self.shownplaced[:n] = placed
+        return [self.pawns[slot] for slot in moved.tolist()]
+
+    def moved_cells(self, cellsize):
+        """Return the pawns whose boxes cover different cells of a grid of
+cellsize than they did at the last call."""
+        n = len(self.pawns)
+        if n == 0:
+            return []
+        (x, y) = (self.coords[:n, 0], self.coords[:n, 1])
+        boxes = numpy.column_stack(
+            (x - self.rx[:n], y, x + self.rx[:n], y + self.height[:n]))
+        cells = numpy.floor_divide(boxes, cellsize).astype(numpy.int32)
+        moved = numpy.flatnonzero((cells != self.cells[:n]).any(axis=1))
+        self.cells[:n] = cells
+        return [self.pawns[slot] for slot in moved.tolist()]
+
+
 class Board:
     coldecls = {"board":
                 {"dimension": "text",
@@ -559,6 +818,7 @@ class Board:
                    "boardmenu":
                    {"board": ("board", "name"),
                     "menu": ("menu", "name")}}
+    ownedrows = {"boardmenu": ("board", ("board",))}
 
     def __init__(self, db, rowdict):
         self.dimension = rowdict["dimension"]
@@ -568,8 +828,19 @@ class Board:
         self.spots = db.spotdict[self.dimension].viewvalues()
         self.pawns = db.pawndict[self.dimension].viewvalues()
         self.menus = db.boardmenudict[self.dimension].viewvalues()
+        self.pawn_positions = PawnPositions()
         self.hsh = hash(self.dimension)
 
+    @property
+    def tabdict(self):
+        return {"board": {"dimension": self.dimension,
+                          "width": self.width,
+                          "height": self.height,
+                          "wallpaper": self.img.name},
+                "boardmenu": [{"board": self.dimension,
+                               "menu": menu.name}
+                              for menu in self.menus]}
+
     def __eq__(self, other):
         return (
             isinstance(other, Board) and
@@ -584,6 +855,10 @@ class Board:
     def getheight(self):
         return self.height
 
+    def add_pawn(self, pawn):
+        pawn.board = self
+        self.pawn_positions.add(pawn)
+
     def __repr__(self):
         return "A board, %d pixels wide by %d tall, representing the "\
             "dimension %s, containing %d spots, %d pawns, and %d menus."\
@@ -619,6 +894,17 @@ class Style:
         self.fg_inactive = db.colordict[rowdict["fg_inactive"]]
         self.fg_active = db.colordict[rowdict["fg_active"]]
 
+    @property
+    def tabdict(self):
+        return {"style": {"name": self.name,
+                          "fontface": self.fontface,
+                          "fontsize": self.fontsize,
+                          "spacing": self.spacing,
+                          "bg_inactive": self.bg_inactive.name,
+                          "bg_active": self.bg_active.name,
+                          "fg_inactive": self.fg_inactive.name,
+                          "fg_active": self.fg_active.name}}
+
     def __eq__(self, other):
         return (
             isinstance(other, Style) and